@@ -3,13 +3,14 @@ Contains client functionality.
 """
 
 import atexit
+from collections import deque
 
 from tools import *
 from gui_elements import *
 
 
 class ConnectionThread(threading.Thread):
-    """Handles the incoming messages."""
+    """Holds the connection to the server, sends the queued outgoing messages and handles the incoming messages."""
 
     def __init__(self, controller):
         """Constructor.
@@ -19,64 +20,236 @@ class ConnectionThread(threading.Thread):
         """
         threading.Thread.__init__(self)
         self.controller = controller
+        self.loop = asyncio.new_event_loop()
+        self.outbox = None
+        self.replies = deque()
+        self.protocol = TextProtocol
 
     def run(self):
-        """Exchanges the Diffie-Hellman key with the server and forms the connection after login."""
-        self.controller.connection_key = asyncio.new_event_loop().run_until_complete(
-            Encryption.diffie_hellman_to_server(
-                self.controller.connection_id, self.controller.connection_secret_key, self.controller.ws_uri))
-        while not self.controller.username:
-            time.sleep(0.1)
-        asyncio.new_event_loop().run_until_complete(self.connect())
+        """Runs the event loop that the connection uses."""
+        asyncio.set_event_loop(self.loop)
+        self.outbox = asyncio.Queue()
+        self.loop.run_until_complete(self.connect())
+
+    def send(self, msg_type, receiver, sender, message=""):
+        """Queues a message that is sent to the server. Can be called from any thread.
+
+        Args:
+            msg_type: The message type.
+            receiver: The receiver of the message.
+            sender: The sender of the message.
+            message: The message.
+        """
+        self.loop.call_soon_threadsafe(self.queue_message, (msg_type, receiver, sender, message), None)
+
+    def request(self, msg_type, receiver, sender, message=""):
+        """Queues a message that is sent to the server and waits for the reply. Can be called from any thread.
+
+        Args:
+            msg_type: The message type.
+            receiver: The receiver of the message.
+            sender: The sender of the message.
+            message: The message.
+        Returns:
+            A concurrent.futures.Future that is resolved with the reply of the server.
+        """
+        return asyncio.run_coroutine_threadsafe(self.send_request(msg_type, receiver, sender, message), self.loop)
+
+    def queue_message(self, message, reply):
+        """Adds a message to the outgoing queue. Must be called from the event loop of the connection.
+
+        Args:
+            message: A tuple of the message type, the receiver, the sender and the message.
+            reply: A future that is resolved with the reply of the server, or None if no reply is expected.
+        """
+        self.outbox.put_nowait((message, reply))
+
+    async def send_request(self, msg_type, receiver, sender, message=""):
+        """Sends a message to the server and returns the reply.
+
+        Args:
+            msg_type: The message type.
+            receiver: The receiver of the message.
+            sender: The sender of the message.
+            message: The message.
+        Returns:
+            The reply of the server.
+        """
+        reply = self.loop.create_future()
+        self.queue_message((msg_type, receiver, sender, message), reply)
+        return await reply
+
+    async def write(self, websocket):
+        """Sends the queued messages in order.
+
+        Args:
+            websocket: The connection to the server.
+        """
+        while True:
+            message, reply = await self.outbox.get()
+            if reply is not None:
+                self.replies.append(reply)
+            await websocket.send(self.protocol.encode(*message))
+            self.outbox.task_done()
 
     async def connect(self):
-        """Forms the connection to the server after login and handles incoming messages."""
-        async with websockets.connect(self.controller.ws_uri) as websocket:
-            await websocket.send("c;;" + self.controller.username + ";")
-            res = await websocket.recv()
+        """Exchanges the Diffie-Hellman key with the server and forms the connection after login."""
+        async with websockets.connect(self.controller.ws_uri, subprotocols=[BinaryProtocol.name], compression=None,
+                                      extensions=[Compression()]) as websocket:
+            self.protocol = PROTOCOLS[websocket.subprotocol]
+            writer = asyncio.ensure_future(self.write(websocket))
+            reader = asyncio.ensure_future(self.read(websocket))
 
-            self.controller.friends = pickle.loads(res)
-            self.controller.chat_window.add_sidebar_buttons()
+            resumption = RESUMPTION_HEADER in websocket.response_headers
+            if resumption:
+                self.controller.connection_key = await self.resume_session()
+            if self.controller.connection_key is None:
+                x25519 = Encryption.supports_x25519(websocket.response_headers.get(KEY_EXCHANGE_HEADER, ""))
+                self.controller.connection_key = await Encryption.diffie_hellman_to_server(
+                    self.controller.connection_id, self.controller.connection_secret_key, self.send_request, x25519)
+            self.controller.chat_window.events.post_call(self.controller.connection_ready)
+            while not self.controller.username:
+                await asyncio.sleep(0.1)
+            if resumption:
+                await self.renew_ticket()
 
+            # The keys are needed before the connection message, which is followed by the queued messages
             self.controller.file_manager.load()
-            a = AutoSaver(1800, self.controller.file_manager)
-            a.daemon = True
-            a.start()
+            friends = await self.send_request("c", "", self.controller.username)
+            self.controller.chat_window.events.post_call(self.set_friends, friends)
+
+            self.controller.autosaver = AutoSaver(self.controller.autosave_interval, self.controller.file_manager)
+            self.controller.autosaver.daemon = True
+            self.controller.autosaver.start()
 
+            try:
+                await reader
+            finally:
+                writer.cancel()
+
+    async def resume_session(self):
+        """Resumes a session with the stored ticket instead of a key exchange.
+
+        Returns:
+            The shared key of the session, None if there is no ticket or the server rejected it.
+        """
+        ticket = self.controller.file_manager.load_ticket()
+        if ticket is None:
+            return None
+        client_nonce = urandom(16)
+        reply = await self.send_request("t", "", self.controller.connection_id,
+                                        ticket[0] + ":" + base64.urlsafe_b64encode(client_nonce).decode())
+        if reply == "0" or reply in REJECTED:
+            return None
+        return Encryption.resumed_key(ticket[1], client_nonce, base64.urlsafe_b64decode(reply))
+
+    async def renew_ticket(self):
+        """Requests a new session resumption ticket after logging in and stores it."""
+        reply = await self.send_request("t", "", self.controller.username)
+        if reply != "0" and reply not in REJECTED:
+            self.controller.file_manager.save_ticket(
+                reply, Encryption.resumption_secret(self.controller.connection_key))
+
+    async def read(self, websocket):
+        """Handles the incoming messages. The replies are matched to the requests in order.
+
+        Args:
+            websocket: The connection to the server.
+        """
+        try:
             while True:
-                message = await websocket.recv()
-                sender, parsed_message = message.split(";", 1)
-
-                if sender[:2] == "c+":
-                    self.controller.friends[sender[2:]] = int(parsed_message)
-                    self.controller.chat_window.add_sidebar_buttons()
-                elif sender[:2] == "a+":
-                    await websocket.send("d;" + sender[2:] + ";" + self.controller.username + ";"
-                                         + Encryption.get_diffie_hellman(sender[2:]))
-                elif sender[:2] == "d+":
-                    self.controller.keys[sender[2:]] = Encryption.receive_diffie_hellman(sender[2:], parsed_message)
-                    self.controller.friends[sender[2:]] = 1
-                    self.controller.chats[sender[2:]] = []
-                    self.controller.chat_window.add_sidebar_buttons()
-                    self.controller.to_user = sender[2:]
-                else:
-                    from_user, to_cht = sender.split(">", 1)
-                    self.controller.chats[to_cht].append(
-                        from_user + ": " + Encryption.decrypt(parsed_message, self.controller.keys[to_cht]))
-                    if self.controller.to_user:
-                        self.controller.chat_window.update_chat()
+                for frame in self.protocol.unpack(await websocket.recv()):
+                    self.handle(self.protocol.parse(frame))
+        finally:
+            while self.replies:
+                self.replies.popleft().cancel()
+
+    def handle(self, message):
+        """Handles one incoming message.
+
+        Args:
+            message: The parsed message. See TextProtocol.parse.
+        """
+        kind = message[0]
+        events = self.controller.chat_window.events
+
+        if kind == "reply":
+            self.replies.popleft().set_result(message[1])
+        elif kind == "c":
+            events.post_call(self.set_online, message[1], int(message[2]))
+        elif kind == "a":
+            # The other user started the pairing and listed its key exchanges
+            self.queue_message(("d", message[1], self.controller.username, Encryption.get_diffie_hellman(
+                message[1], Encryption.supports_x25519(message[2]))), None)
+        elif kind == "d":
+            if not Encryption.has_private_key(message[1]):
+                # The own key is sent in reply, using the key exchange that the other user chose
+                self.queue_message(("d", message[1], self.controller.username, Encryption.get_diffie_hellman(
+                    message[1], Encryption.is_x25519(message[2]))), None)
+            self.controller.file_manager.add_key(message[1], Encryption.receive_diffie_hellman(message[1], message[2]))
+            events.post_call(self.open_chat, message[1])
+        else:
+            from_user, to_cht, parsed_message = message[1:]
+            line = from_user + ": " + Encryption.decrypt(parsed_message, self.controller.keys[to_cht])
+            events.post_call(self.add_line, to_cht, line)
+
+    # The friends, the open chat and the loaded chats are only changed in the Tk main loop, which also reads them
+    # to draw the interface, so the handlers above post these methods instead of calling them
+
+    def set_friends(self, friends):
+        """Replaces the friend list with the one received after connecting.
+
+        Args:
+            friends: A dict with the usernames as keys and values 1 denoting online and 0 denoting offline.
+        """
+        self.controller.friends = friends
+        self.controller.chat_window.add_sidebar_buttons()
+
+    def set_online(self, friend, online):
+        """Marks a friend online or offline.
+
+        Args:
+            friend: The username of the friend.
+            online: 1 if the friend connected, 0 if the friend disconnected.
+        """
+        self.controller.friends[friend] = online
+        self.controller.chat_window.add_sidebar_buttons()
+
+    def open_chat(self, friend):
+        """Adds a new friend whose key exchange has completed and opens the chat with the friend.
+
+        Args:
+            friend: The username of the friend.
+        """
+        self.controller.friends[friend] = 1
+        self.controller.file_manager.load_chat(friend)
+        self.controller.chat_window.add_sidebar_buttons()
+        self.controller.to_user = friend
+        self.controller.chat_window.update_chat()
+
+    def add_line(self, chat, line):
+        """Adds a received line to a chat.
+
+        Args:
+            chat: The chat partner of the line.
+            line: The line.
+        """
+        self.controller.file_manager.add_line(chat, line)
+        self.controller.chat_window.add_line(chat, line)
 
 
 class Controller:
     """Creates the UI and starts the application."""
 
-    def __init__(self, ws_uri="ws://localhost:8765"):
+    def __init__(self, ws_uri="ws://localhost:8765", autosave_interval=10):
         """Constructor.
 
         Args:
             ws_uri: The location of the server.
+            autosave_interval: The time in seconds between saves of the changed keys and chats.
         """
         self.ws_uri = ws_uri
+        self.autosave_interval = autosave_interval
 
         width = 800
         height = 600
@@ -90,6 +263,7 @@ class Controller:
         self.connection_id = base64.urlsafe_b64encode(urandom(30)).decode()
         self.connection_secret_key = int.from_bytes(urandom(120), sys.byteorder)
         self.connection_key = None
+        self.autosaver = None
 
         self.color_1 = "#F3F4EF"
         self.color_2 = "#BDC696"
@@ -107,15 +281,39 @@ class Controller:
         self.raise_login_window()
 
         self.file_manager = FileManager(self)
+        self.connection = ConnectionThread(self)
+        self.connection.daemon = True
 
-        atexit.register(self.file_manager.save)
+        atexit.register(self.save)
         atexit.register(CleanUp(self).disconnect)
 
-        ct = ConnectionThread(self)
-        ct.daemon = True
-        ct.start()
+        self.connection.start()
         app.mainloop()
 
+    def save(self):
+        """Stops the autosaver and saves the keys and chats."""
+        if self.autosaver is not None:
+            self.autosaver.stop()
+            self.autosaver.join()
+        self.file_manager.save()
+
+    def when_done(self, future, callback):
+        """Calls the callback in the Tk thread with the result of a request once the reply has arrived.
+
+        Args:
+            future: The concurrent.futures.Future of the request.
+            callback: A function that takes the reply. It is not called if the connection is lost.
+        """
+        def done(f):
+            if not f.cancelled() and f.exception() is None:
+                self.chat_window.events.post_call(callback, f.result())
+        future.add_done_callback(done)
+
+    def connection_ready(self):
+        """Enables the login and the registration once the key exchange with the server has completed."""
+        self.login_window.set_connecting(False)
+        self.register_window.set_connecting(False)
+
     def raise_register_window(self):
         self.register_window.tkraise()
 
@@ -2,12 +2,11 @@
 Contains elements for the graphical user interface.
 """
 
-import websockets
 import asyncio
 from tkinter import *
 from tkinter import scrolledtext
 
-from tools import Encryption
+from tools import Encryption, UIEvents
 
 
 class LoginWindow(Frame):
@@ -78,28 +77,51 @@ class LoginWindow(Frame):
         self.register_button.grid(column=0, row=0, sticky=EW, padx=(1, 1), pady=(1, 1))
 
         self.grid(row=0, column=0)
+        self.set_connecting(True)
+
+    def set_connecting(self, connecting):
+        """Disables the login while the key exchange with the server is in progress.
+
+        Args:
+            connecting: True until the key exchange has completed.
+        """
+        self.login_button.config(fg="grey" if connecting else "black")
+        self.print_login_error("Connecting to the server..." if connecting else "")
 
     def try_login(self):
         """Initiates the login process."""
-        asyncio.get_event_loop().run_until_complete(self.verify_login(self.username_entry.get(),
-                                                                      self.password_entry.get()))
+        self.verify_login(self.username_entry.get(), self.password_entry.get())
 
-    async def verify_login(self, name, password):
+    def verify_login(self, name, password):
         """Sends the username and password to the server and handles the response.
 
         Args:
             name: The username.
             password: The password.
         """
-        async with websockets.connect(self.controller.ws_uri) as websocket:
-            await websocket.send("l;;" + self.controller.connection_id + ";" + Encryption.encrypt(
-                name + "@" + password, self.controller.connection_key))
-            response = await websocket.recv()
-            if response == "1":
-                self.controller.username = name
-                self.controller.raise_chat_window()
-            else:
-                self.print_login_error("Incorrect username or password")
+        if self.controller.connection_key is None:
+            self.print_login_error("Connecting to the server...")
+            return
+        reply = self.controller.connection.request("l", "", self.controller.connection_id, Encryption.encrypt(
+            name + "@" + password, self.controller.connection_key))
+        self.controller.when_done(reply, lambda response: self.handle_login(name, response))
+
+    def handle_login(self, name, response):
+        """Handles the response of the server to a login request.
+
+        Args:
+            name: The username.
+            response: The response of the server.
+        """
+        if response == "1":
+            self.controller.username = name
+            self.controller.raise_chat_window()
+        elif response == "2":
+            self.print_login_error("Server busy, try again later")
+        elif response == "3":
+            self.print_login_error("Too many attempts, try again later")
+        else:
+            self.print_login_error("Incorrect username or password")
 
     def print_login_error(self, message):
         """Prints the given message to the login error text area.
@@ -187,6 +209,16 @@ class RegisterWindow(Frame):
         self.return_button.grid(column=0, row=0, sticky=EW, padx=(1, 1), pady=(1, 1))
 
         self.grid(row=0, column=0)
+        self.set_connecting(True)
+
+    def set_connecting(self, connecting):
+        """Disables the registration while the key exchange with the server is in progress.
+
+        Args:
+            connecting: True until the key exchange has completed.
+        """
+        self.register_button.config(fg="grey" if connecting else "black")
+        self.print_registration_error("Connecting to the server..." if connecting else "")
 
     def try_registration(self):
         """Initiates the registration process after checking that the username and passwords are valid."""
@@ -203,24 +235,36 @@ class RegisterWindow(Frame):
         elif len(self.password_entry_1.get()) < 5 or len(self.password_entry_1.get()) > 20:
             self.print_registration_error("Password must be between 5 and 20 characters")
             return
-        asyncio.get_event_loop().run_until_complete(self.send_registration(self.username_entry.get(),
-                                                                           self.password_entry_1.get()))
+        self.send_registration(self.username_entry.get(), self.password_entry_1.get())
 
-    async def send_registration(self, name, password):
+    def send_registration(self, name, password):
         """Sends the registration request to the server.
 
         Args:
             name: The username.
             password: The password.
         """
-        async with websockets.connect(self.controller.ws_uri) as websocket:
-            await websocket.send("r;;" + self.controller.connection_id + ";" + Encryption.encrypt(
-                name + "@" + password, self.controller.connection_key))
-            response = await websocket.recv()
-            if response == "1":
-                self.controller.raise_login_window()
-            elif response == "0":
-                self.print_registration_error("Username taken")
+        if self.controller.connection_key is None:
+            self.print_registration_error("Connecting to the server...")
+            return
+        reply = self.controller.connection.request("r", "", self.controller.connection_id, Encryption.encrypt(
+            name + "@" + password, self.controller.connection_key))
+        self.controller.when_done(reply, self.handle_registration)
+
+    def handle_registration(self, response):
+        """Handles the response of the server to a registration request.
+
+        Args:
+            response: The response of the server.
+        """
+        if response == "1":
+            self.controller.raise_login_window()
+        elif response == "0":
+            self.print_registration_error("Username taken")
+        elif response == "2":
+            self.print_registration_error("Server busy, try again later")
+        elif response == "3":
+            self.print_registration_error("Too many attempts, try again later")
 
     def print_registration_error(self, message):
         """Prints the given message to the error message area.
@@ -236,6 +280,9 @@ class RegisterWindow(Frame):
 class ChatWindow(Frame):
     """Creates and adds logic to the chat frame."""
 
+    # The time in milliseconds between redraws of the changes made by the connection thread
+    refresh_interval = 50
+
     def __init__(self, parent, wd, ht, controller):
         """Constructor.
 
@@ -264,7 +311,8 @@ class ChatWindow(Frame):
         # Received messages areas
         self.received_messages = scrolledtext.ScrolledText(chat_frame, bg=controller.color_1, highlightthickness=0)
         self.received_messages.grid(column=0, row=0, sticky=NSEW, padx=(10, 0), pady=(10, 10))
-        self.received_messages.config(state=DISABLED)
+        self.received_messages.config(state=DISABLED, yscrollcommand=self.scrolled)
+        self.loading_older = False
 
         # Message entry
         self.message_entry = Entry(message_frame, highlightthickness=1, borderwidth=0,
@@ -318,14 +366,36 @@ class ChatWindow(Frame):
         self.add_friends_entry.grid(column=0, row=1, sticky=EW, padx=(3, 3), pady=(0, 25))
         self.add_friends_entry.bind("<Return>", lambda _: self.try_add_friend())
 
+        # The friend buttons by username as (button, row, background color) tuples
+        self.friend_buttons = {}
+        self.events = UIEvents()
         self.add_sidebar_buttons()
+        self.after(self.refresh_interval, self.refresh)
 
         self.grid(row=0, column=0, sticky=NSEW)
 
     def add_sidebar_buttons(self):
-        """Adds new friend buttons to the sidebar."""
+        """Requests an update of the friend buttons in the sidebar on the next refresh. Can be called from any
+        thread."""
+        self.events.post_sidebar()
+
+    def refresh(self):
+        """Runs the requested callbacks and applies the changes requested since the previous refresh with one
+        redraw of each changed area."""
+        for callback, args in self.events.take_calls():
+            callback(*args)
+        sidebar, chat, lines = self.events.take()
+        if sidebar:
+            self.update_sidebar()
+        if chat:
+            self.show_chat()
+        elif self.controller.to_user in lines:
+            self.show_lines(lines[self.controller.to_user])
+        self.after(self.refresh_interval, self.refresh)
+
+    def update_sidebar(self):
+        """Creates, removes, recolors and reorders only the friend buttons that have changed."""
 
-        friend_btns = []
         online_friends = []
         offline_friends = []
         for friend, online in self.controller.friends.items():
@@ -334,26 +404,26 @@ class ChatWindow(Frame):
             else:
                 offline_friends.append(friend)
 
-        for friend in sorted(online_friends):
-            if friend.lower() == self.controller.to_user.lower():
-                bg = self.controller.color_2
-            else:
-                bg = self.controller.color_3
-            b = Label(self.friends_frame, text=friend, bg=bg)
-            b.bind("<Button-1>", lambda _, f=friend: self.change_chat_partner(f))
-            friend_btns.append(b)
+        for friend in [friend for friend in self.friend_buttons if friend not in self.controller.friends]:
+            self.friend_buttons.pop(friend)[0].destroy()
 
-        for friend in sorted(offline_friends):
+        rows = [(friend, self.controller.color_3) for friend in sorted(online_friends)]
+        rows += [(friend, self.controller.color_1) for friend in sorted(offline_friends)]
+        for idx, (friend, bg) in enumerate(rows):
             if friend.lower() == self.controller.to_user.lower():
                 bg = self.controller.color_2
-            else:
-                bg = self.controller.color_1
-            b = Label(self.friends_frame, text=friend, bg=bg)
-            b.bind("<Button-1>", lambda _, f=friend: self.change_chat_partner(f))
-            friend_btns.append(b)
-
-        for idx, btn in enumerate(friend_btns):
-            btn.grid(column=0, row=idx, sticky=EW, pady=(0, 1))
+            if friend not in self.friend_buttons:
+                b = Label(self.friends_frame, text=friend, bg=bg)
+                b.bind("<Button-1>", lambda _, f=friend: self.change_chat_partner(f))
+                b.grid(column=0, row=idx, sticky=EW, pady=(0, 1))
+                self.friend_buttons[friend] = (b, idx, bg)
+                continue
+            b, row, old_bg = self.friend_buttons[friend]
+            if bg != old_bg:
+                b.config(bg=bg)
+            if idx != row:
+                b.grid(column=0, row=idx, sticky=EW, pady=(0, 1))
+            self.friend_buttons[friend] = (b, idx, bg)
 
     def send_message(self):
         """Sends a message to the current chat partner and erases the message entry field."""
@@ -362,29 +432,79 @@ class ChatWindow(Frame):
         if not message:
             return
         self.message_entry.delete(0, "end")
-        asyncio.get_event_loop().run_until_complete(self.msg(message))
+        self.msg(message)
 
     def update_chat(self):
-        """Updates the received messages area."""
+        """Requests a redraw of the current chat on the next refresh. Can be called from any thread."""
+        self.events.post_chat()
+
+    def show_chat(self):
+        """Shows the loaded lines of the current chat in the received messages area."""
 
         self.received_messages.config(state=NORMAL)
 
         self.received_messages.delete(1.0, END)
-        self.received_messages.insert(INSERT, "\n\n".join(
-            self.controller.chats[self.controller.to_user]
-            [max(0, len(self.controller.chats[self.controller.to_user]) - 500):]))
+        self.received_messages.insert(INSERT, "\n\n".join(self.controller.chats[self.controller.to_user]))
         self.received_messages.see(END)
         self.received_messages.config(state=DISABLED)
 
-    async def msg(self, message):
+    def add_line(self, chat, line):
+        """Requests a new line to be shown on the next refresh if its chat is open. Can be called from any thread.
+
+        Args:
+            chat: The chat partner of the line.
+            line: The line.
+        """
+        self.events.post_line(chat, line)
+
+    def show_lines(self, lines):
+        """Appends new lines to the received messages area.
+
+        Args:
+            lines: A list of lines of the current chat.
+        """
+        at_bottom = self.received_messages.yview()[1] == 1.0
+        self.received_messages.config(state=NORMAL)
+        if self.received_messages.compare("end-1c", "!=", "1.0"):
+            self.received_messages.insert(END, "\n\n")
+        self.received_messages.insert(END, "\n\n".join(lines))
+        self.received_messages.config(state=DISABLED)
+        if at_bottom:
+            self.received_messages.see(END)
+
+    def scrolled(self, first, last):
+        """Updates the scrollbar and loads older lines when the received messages area is scrolled to the top.
+
+        Args:
+            first: The fraction of the text above the visible area.
+            last: The fraction of the text above the end of the visible area.
+        """
+        self.received_messages.vbar.set(first, last)
+        if float(first) == 0 and self.controller.to_user and not self.loading_older:
+            self.loading_older = True
+            self.after_idle(self.show_older_lines)
+
+    def show_older_lines(self):
+        """Inserts the page of lines preceding the shown lines at the top of the received messages area."""
+        self.loading_older = False
+        lines = self.controller.file_manager.load_older(self.controller.to_user)
+        if not lines:
+            return
+        text = "\n\n".join(lines) + "\n\n"
+        self.received_messages.config(state=NORMAL)
+        self.received_messages.insert("1.0", text)
+        self.received_messages.config(state=DISABLED)
+        # Keep the previously first line at the top of the visible area
+        self.received_messages.yview("1.0 + " + str(text.count("\n")) + " lines")
+
+    def msg(self, message):
         """Sends the given message to the current chat partner.
 
         Args:
             message: The message that is sent.
         """
-        async with websockets.connect(self.controller.ws_uri) as websocket:
-            await websocket.send("m;" + self.controller.to_user + ";" + self.controller.username + ";"
-                                 + Encryption.encrypt(message, self.controller.keys[self.controller.to_user]))
+        self.controller.connection.send("m", self.controller.to_user, self.controller.username,
+                                        Encryption.encrypt(message, self.controller.keys[self.controller.to_user]))
 
     def change_chat_partner(self, friend):
         """Changes the current chat partner.
@@ -393,26 +513,27 @@ class ChatWindow(Frame):
             friend: The new chat partner.
         """
         self.controller.to_user = friend
-        self.add_sidebar_buttons()
+        self.controller.file_manager.load_chat(friend)
+        self.update_sidebar()
         self.message_entry.config(state=NORMAL)
+        # Redrawn on the next refresh, which replaces the lines queued before the chat was loaded
         self.update_chat()
 
     def try_add_friend(self):
         """Initiates the process to add a new friend."""
-        asyncio.get_event_loop().run_until_complete(self.add_friend(self.add_friends_entry.get()))
+        user = self.add_friends_entry.get()
+        self.add_friends_entry.delete(0, END)
+        asyncio.run_coroutine_threadsafe(self.add_friend(user), self.controller.connection.loop)
 
     async def add_friend(self, user):
-        """Sends a request to the server to add a new friend and sends the Diffie-Hellman key if the request succeeds.
+        """Sends a request to the server to add a new friend.
+
+        The request lists the supported key exchanges. The friend chooses one and sends its key first, and the
+        own key is sent in reply when it arrives. Runs in the event loop of the connection.
 
         Args:
             user: The added friend.
         """
-        async with websockets.connect(self.controller.ws_uri) as websocket:
-            if user == self.controller.username:
-                return
-            await websocket.send("a;" + user + ";" + self.controller.username + ";")
-            response = await websocket.recv()
-            if response == "1":
-                await websocket.send(
-                    "d;" + user + ";" + self.controller.username + ";" + Encryption.get_diffie_hellman(user))
-            self.add_friends_entry.delete(0, END)
+        if user == self.controller.username:
+            return
+        await self.controller.connection.send_request("a", user, self.controller.username, Encryption.key_exchanges())
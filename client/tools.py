@@ -2,20 +2,52 @@
 Contains tools for the client to use.
 """
 
+import os
 import random
 import base64
 import pickle
+import struct
 import threading
 import asyncio
 import websockets
 import sys
-import time
+import sqlite3
 from os import urandom
-from cryptography.fernet import Fernet
+from collections import OrderedDict
+from cryptography.fernet import Fernet, InvalidToken
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from cryptography.hazmat.primitives.serialization import Encoding, PublicFormat
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey, X25519PublicKey
+from websockets.extensions.permessage_deflate import ClientPerMessageDeflateFactory
+
+# The opcodes of text and binary websocket frames
+DATA_OPCODES = (1, 2)
+
+# The handshake response header in which the server lists the key exchanges it supports
+KEY_EXCHANGE_HEADER = "Chat-Key-Exchange"
+
+# The handshake response header that tells that the server accepts session resumption tickets
+RESUMPTION_HEADER = "Chat-Session-Resumption"
+
+# The replies of the server to a request that it rejected because it is overloaded or rate limited
+REJECTED = ("2", "3")
 
 
 class FileManager:
-    """Manages saving and loading the chats and the Diffie-Hellman keys."""
+    """Manages saving and loading the chats and the Diffie-Hellman keys.
+
+    The keys and the chat lines are stored in a SQLite database per user. New lines and keys are kept as pending
+    changes until the next flush, which writes them in one transaction, so a crash during a save leaves the
+    previous state intact. Each chat is loaded only when it is opened, and then only its most recent page.
+    """
+
+    # The number of most recent lines loaded when a chat is opened
+    page_size = 500
+
+    # The file of the session resumption ticket, which is shared by the users of the client
+    ticket_path = "session.ticket"
 
     def __init__(self, controller):
         """Constructor.
@@ -24,34 +56,170 @@ class FileManager:
             controller: An instance of the Controller class.
         """
         self.controller = controller
+        self.db = None
+        self.lock = threading.Lock()
+        self.pending_lines = {}
+        self.pending_keys = {}
+        self.oldest = {}
 
     def load(self):
-        """Loads the chats and Diffie-Hellman keys from a pickle file."""
+        """Opens the database of the user and loads the Diffie-Hellman keys.
+
+        A pickle file saved by an earlier version is moved into the database on first use.
+        """
         name = self.controller.username.lower()
-        try:
-            f = open(name + ".pickle", "rb")
-            f.close()
-        except IOError:
-            f = open(name + ".pickle", "wb+")
-            f.close()
-        with open(name + ".pickle", "rb") as file:
+        with self.lock:
+            self.db = sqlite3.connect(name + ".db", check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS keys (friend TEXT PRIMARY KEY, key TEXT)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS lines (id INTEGER PRIMARY KEY, chat TEXT, line TEXT)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS lines_chat ON lines (chat, id)")
+            self.db.commit()
+            if os.path.exists(name + ".pickle"):
+                self.migrate(name + ".pickle")
+            self.controller.keys = {friend: int(key) for friend, key in self.db.execute("SELECT friend, key FROM keys")}
+        self.controller.chats = {}
+
+    def migrate(self, path):
+        """Moves the keys and chats of a pickle file into the database and renames the file.
+
+        Args:
+            path: The location of the pickle file.
+        """
+        with open(path, "rb") as file:
             try:
                 loaded_keys, loaded_chats = pickle.load(file)
-                self.controller.keys = loaded_keys
-                self.controller.chats = loaded_chats
             except EOFError:
-                self.controller.keys = {}
-                self.controller.chats = {}
+                loaded_keys, loaded_chats = {}, {}
+        self.db.executemany("INSERT OR REPLACE INTO keys VALUES (?, ?)",
+                            ((friend, str(key)) for friend, key in loaded_keys.items()))
+        self.db.executemany("INSERT INTO lines (chat, line) VALUES (?, ?)",
+                            ((chat, line) for chat, lines in loaded_chats.items() for line in lines))
+        self.db.commit()
+        os.replace(path, path + ".migrated")
+
+    def load_chat(self, friend):
+        """Loads the most recent page of a chat unless it has already been loaded.
+
+        Args:
+            friend: The chat partner.
+        Returns:
+            The list of the loaded lines of the chat.
+        """
+        if friend not in self.controller.chats:
+            with self.lock:
+                rows = self.read_page(friend)
+                lines = [row[1] for row in reversed(rows)] + self.pending_lines.get(friend, [])
+            self.controller.chats[friend] = lines
+        return self.controller.chats[friend]
+
+    def load_older(self, friend):
+        """Loads the page of lines preceding the loaded lines of a chat.
+
+        Args:
+            friend: The chat partner.
+        Returns:
+            The list of the loaded lines, empty if the whole chat has been loaded.
+        """
+        if not self.oldest.get(friend):
+            return []
+        with self.lock:
+            lines = [row[1] for row in reversed(self.read_page(friend, self.oldest[friend]))]
+        self.controller.chats[friend][:0] = lines
+        return lines
+
+    def read_page(self, friend, before=None):
+        """Reads a page of the stored lines of a chat and remembers the oldest line that has been read.
+
+        Args:
+            friend: The chat partner.
+            before: The id of the oldest line that has already been read, None to read the most recent page.
+        Returns:
+            A list of (id, line) tuples from the newest to the oldest.
+        """
+        if before is None:
+            rows = self.db.execute("SELECT id, line FROM lines WHERE chat=? ORDER BY id DESC LIMIT ?",
+                                   (friend, self.page_size)).fetchall()
+        else:
+            rows = self.db.execute("SELECT id, line FROM lines WHERE chat=? AND id<? ORDER BY id DESC LIMIT ?",
+                                   (friend, before, self.page_size)).fetchall()
+        # An id of 0 marks a chat whose oldest line has been read
+        self.oldest[friend] = rows[-1][0] if len(rows) == self.page_size else 0
+        return rows
+
+    def add_line(self, friend, line):
+        """Appends a line to a chat. The line is written on the next flush.
+
+        Args:
+            friend: The chat partner.
+            line: The line.
+        """
+        with self.lock:
+            self.pending_lines.setdefault(friend, []).append(line)
+        if friend in self.controller.chats:
+            self.controller.chats[friend].append(line)
+
+    def add_key(self, friend, key):
+        """Stores the Diffie-Hellman key shared with a friend. The key is written on the next flush.
+
+        Args:
+            friend: The friend.
+            key: The shared key.
+        """
+        self.controller.keys[friend] = key
+        with self.lock:
+            self.pending_keys[friend] = key
+
+    def flush(self):
+        """Writes the lines and keys that have changed since the previous flush in one transaction."""
+        with self.lock:
+            if self.db is None or not (self.pending_lines or self.pending_keys):
+                return
+            with self.db:
+                self.db.executemany("INSERT OR REPLACE INTO keys VALUES (?, ?)",
+                                    ((friend, str(key)) for friend, key in self.pending_keys.items()))
+                self.db.executemany("INSERT INTO lines (chat, line) VALUES (?, ?)",
+                                    ((chat, line) for chat, lines in self.pending_lines.items() for line in lines))
+            self.pending_lines = {}
+            self.pending_keys = {}
+
+    def load_ticket(self):
+        """Loads and removes the stored session resumption ticket, which can only be used once.
+
+        Returns:
+            A tuple of the ticket id and the secret of the ticket, None if there is no ticket.
+        """
+        try:
+            with open(self.ticket_path) as file:
+                ticket, secret = file.read().split(":")
+        except (IOError, ValueError):
+            return None
+        os.remove(self.ticket_path)
+        return ticket, int(secret)
+
+    def save_ticket(self, ticket, secret):
+        """Stores a session resumption ticket. The file is replaced in one step.
+
+        Args:
+            ticket: The ticket id.
+            secret: The secret of the ticket.
+        """
+        with open(self.ticket_path + ".tmp", "w") as file:
+            file.write(ticket + ":" + str(secret))
+        os.replace(self.ticket_path + ".tmp", self.ticket_path)
 
     def save(self):
-        """Saves the chats and Diffie-Hellman keys to a pickle file."""
-        if self.controller.username:
-            with open(self.controller.username.lower() + ".pickle", "wb+") as file:
-                pickle.dump((self.controller.keys, self.controller.chats), file)
+        """Flushes the pending changes and closes the database."""
+        self.flush()
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
 
 
 class AutoSaver(threading.Thread):
-    """A thread that saves the keys and chats periodically."""
+    """A thread that flushes the changed keys and chats periodically."""
 
     def __init__(self, frequency, file_manager):
         """Constructor.
@@ -63,11 +231,87 @@ class AutoSaver(threading.Thread):
         threading.Thread.__init__(self)
         self.freq = frequency
         self.file_manager = file_manager
+        self.stopped = threading.Event()
+
+    def stop(self):
+        """Stops the thread. The remaining changes are flushed by FileManager.save after the thread has finished."""
+        self.stopped.set()
 
     def run(self):
-        """Sleeps for the specified amount of seconds between autosaves."""
-        time.sleep(self.freq)
-        self.file_manager.save()
+        """Flushes the changes every specified amount of seconds until the thread is stopped."""
+        while not self.stopped.wait(self.freq):
+            self.file_manager.flush()
+
+
+class UIEvents:
+    """Passes the changes that the connection thread makes to the Tk main loop.
+
+    Events of the same kind are merged until the main loop takes them, so the interface is redrawn at most
+    once per refresh no matter how many messages arrive.
+    """
+
+    def __init__(self):
+        """Constructor."""
+        self.lock = threading.Lock()
+        self.sidebar = False
+        self.chat = False
+        self.lines = OrderedDict()
+        self.calls = []
+
+    def post_sidebar(self):
+        """Requests an update of the sidebar."""
+        with self.lock:
+            self.sidebar = True
+
+    def post_chat(self):
+        """Requests a redraw of the open chat."""
+        with self.lock:
+            self.chat = True
+
+    def post_line(self, chat, line):
+        """Requests a new line to be shown.
+
+        Args:
+            chat: The chat partner of the line.
+            line: The line.
+        """
+        with self.lock:
+            self.lines.setdefault(chat, []).append(line)
+
+    def post_call(self, callback, *args):
+        """Requests a function to be called in the main loop.
+
+        Args:
+            callback: The function.
+            args: The arguments of the function.
+        """
+        with self.lock:
+            self.calls.append((callback, args))
+
+    def take_calls(self):
+        """Returns the requested function calls in order and clears them.
+
+        Returns:
+            A list of (callback, args) tuples.
+        """
+        with self.lock:
+            calls = self.calls
+            self.calls = []
+        return calls
+
+    def take(self):
+        """Returns the merged events and clears them.
+
+        Returns:
+            A tuple of whether the sidebar should be updated, whether the open chat should be redrawn and an
+            OrderedDict of the new lines by chat.
+        """
+        with self.lock:
+            events = self.sidebar, self.chat, self.lines
+            self.sidebar = False
+            self.chat = False
+            self.lines = OrderedDict()
+        return events
 
 
 class CleanUp:
@@ -83,15 +327,270 @@ class CleanUp:
 
     def disconnect(self):
         """Initiates the disconnection process."""
-        asyncio.get_event_loop().run_until_complete(self.send_disconnect_request())
+        if self.controller.connection.is_alive():
+            asyncio.run_coroutine_threadsafe(self.send_disconnect_request(), self.controller.connection.loop).result(5)
 
     async def send_disconnect_request(self):
-        """Sends the disconnection request to the server."""
-        async with websockets.connect(self.controller.ws_uri) as websocket:
-            if self.controller.username:
-                await websocket.send("g;;" + self.controller.username + ";")
-            else:
-                await websocket.send("g;;" + self.controller.connection_id + ";")
+        """Sends the disconnection request to the server and waits until the queued messages have been sent."""
+        connection = self.controller.connection
+        if self.controller.username:
+            connection.queue_message(("g", "", self.controller.username, ""), None)
+        else:
+            connection.queue_message(("g", "", self.controller.connection_id, ""), None)
+        await connection.outbox.join()
+
+
+class TextProtocol:
+    """The original protocol, where the fields of a message are separated by ";"."""
+
+    name = None
+
+    @staticmethod
+    def encode(msg_type, receiver, sender, message):
+        """Encodes a message that is sent to the server.
+
+        Args:
+            msg_type: The message type.
+            receiver: The receiver of the message.
+            sender: The sender of the message.
+            message: The message. Encrypted messages are Fernet token strings.
+        Returns:
+            The frame.
+        """
+        return msg_type + ";" + receiver + ";" + sender + ";" + message
+
+    @staticmethod
+    def unpack(frame):
+        """Returns the frames that a received frame contains. The text protocol has no batch frames.
+
+        Args:
+            frame: The received frame.
+        Returns:
+            A list of frames.
+        """
+        return [frame]
+
+    @staticmethod
+    def parse(frame):
+        """Parses a frame that the server sent.
+
+        Frames without a ";" are replies, which the server sends in the same order as the requests.
+
+        Args:
+            frame: The received frame.
+        Returns:
+            ("reply", value), ("c", user, online), ("a", user, info), ("d", user, key) or
+            ("m", sender, chat, message), where the value of a reply is a string or a friend list dict.
+        """
+        if isinstance(frame, bytes):
+            return "reply", pickle.loads(frame)
+        if ";" not in frame:
+            return "reply", frame
+        sender, parsed_message = frame.split(";", 1)
+        if sender[:2] in ("c+", "a+", "d+"):
+            return sender[0], sender[2:], parsed_message
+        from_user, to_cht = sender.split(">", 1)
+        return "m", from_user, to_cht, parsed_message
+
+
+class BinaryProtocol:
+    """A binary protocol where a frame is a type byte followed by fields that are prefixed with their length.
+
+    The encrypted payloads are sent as raw bytes. The protocol is negotiated as a websocket subprotocol.
+    """
+
+    name = "chat.v2"
+
+    # The message types whose payload is encrypted
+    encrypted = ("l", "r", "m")
+
+    @staticmethod
+    def encode_frame(frame_type, *fields):
+        """Encodes a frame.
+
+        Args:
+            frame_type: A one character string.
+            fields: The fields as strings or bytes.
+        Returns:
+            The frame as bytes.
+        """
+        parts = [frame_type.encode()]
+        for field in fields:
+            if isinstance(field, str):
+                field = field.encode()
+            parts.append(struct.pack(">I", len(field)))
+            parts.append(field)
+        return b"".join(parts)
+
+    @staticmethod
+    def decode_frame(frame):
+        """Decodes a frame.
+
+        Args:
+            frame: The frame as bytes.
+        Returns:
+            A tuple of the frame type and a list of the fields as bytes.
+        Raises:
+            ValueError: If the frame is malformed.
+        """
+        if not isinstance(frame, bytes) or not frame:
+            raise ValueError("Not a binary frame")
+        fields = []
+        offset = 1
+        while offset < len(frame):
+            if offset + 4 > len(frame):
+                raise ValueError("Truncated frame")
+            length, = struct.unpack_from(">I", frame, offset)
+            offset += 4
+            if offset + length > len(frame):
+                raise ValueError("Truncated frame")
+            fields.append(frame[offset:offset + length])
+            offset += length
+        return chr(frame[0]), fields
+
+    @classmethod
+    def encode(cls, msg_type, receiver, sender, message):
+        """See TextProtocol.encode."""
+        if msg_type in cls.encrypted:
+            message = base64.urlsafe_b64decode(message)
+        return cls.encode_frame(msg_type, receiver, sender, message)
+
+    @classmethod
+    def unpack(cls, frame):
+        """Returns the frames that a received frame contains, splitting batch frames.
+
+        Args:
+            frame: The received frame.
+        Returns:
+            A list of frames.
+        """
+        if frame[:1] == b"b":
+            return cls.decode_frame(frame)[1]
+        return [frame]
+
+    @classmethod
+    def parse(cls, frame):
+        """See TextProtocol.parse."""
+        frame_type, fields = cls.decode_frame(frame)
+        if frame_type == "R":
+            return "reply", fields[0].decode()
+        if frame_type == "F":
+            return "reply", {fields[i].decode(): int(fields[i + 1]) for i in range(0, len(fields), 2)}
+        if frame_type == "m":
+            return "m", fields[0].decode(), fields[1].decode(), base64.urlsafe_b64encode(fields[2]).decode()
+        return frame_type, fields[0].decode(), fields[1].decode()
+
+
+# The protocols by the negotiated subprotocol
+PROTOCOLS = {TextProtocol.name: TextProtocol, BinaryProtocol.name: BinaryProtocol}
+
+
+class SmallMessageBypass:
+    """Wraps a permessage-deflate extension so that messages below a size threshold are sent uncompressed."""
+
+    def __init__(self, extension, min_size):
+        """Constructor.
+
+        Args:
+            extension: The negotiated permessage-deflate extension.
+            min_size: The size in bytes below which messages are not compressed.
+        """
+        self.extension = extension
+        self.min_size = min_size
+
+    @property
+    def name(self):
+        """The name of the extension."""
+        return self.extension.name
+
+    def decode(self, frame, *, max_size=None):
+        """Decodes an incoming frame."""
+        return self.extension.decode(frame, max_size=max_size)
+
+    def encode(self, frame):
+        """Encodes an outgoing frame, leaving small unfragmented data frames uncompressed."""
+        if frame.fin and frame.opcode in DATA_OPCODES and len(frame.data) < self.min_size:
+            return frame
+        return self.extension.encode(frame)
+
+
+class Compression(ClientPerMessageDeflateFactory):
+    """Negotiates permessage-deflate with tunable settings for the client."""
+
+    def __init__(self, min_size=512, level=6, mem_level=8):
+        """Constructor.
+
+        Args:
+            min_size: The size in bytes below which messages are not compressed.
+            level: The zlib compression level.
+            mem_level: The zlib memory level.
+        """
+        ClientPerMessageDeflateFactory.__init__(self, client_max_window_bits=True,
+                                                compress_settings={"level": level, "memLevel": mem_level})
+        self.min_size = min_size
+
+    def process_response_params(self, params, accepted_extensions):
+        """Negotiates the extension and wraps it so that small messages are not compressed."""
+        return SmallMessageBypass(
+            ClientPerMessageDeflateFactory.process_response_params(self, params, accepted_extensions), self.min_size)
+
+
+class CipherCache:
+    """A bounded LRU cache of Fernet ciphers keyed by the shared Diffie-Hellman key."""
+
+    def __init__(self, size=128):
+        """Constructor.
+
+        Args:
+            size: The maximum number of cached ciphers.
+        """
+        self.size = size
+        self.ciphers = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the cipher for the shared key, deriving it on the first use.
+
+        Args:
+            key: The shared Diffie-Hellman key.
+        Returns:
+            A Fernet instance.
+        """
+        with self.lock:
+            cipher = self.ciphers.get(key)
+            if cipher is not None:
+                self.ciphers.move_to_end(key)
+                return cipher
+        cipher = Fernet(self.derive_key(key))
+        with self.lock:
+            self.ciphers[key] = cipher
+            while len(self.ciphers) > self.size:
+                self.ciphers.popitem(last=False)
+        return cipher
+
+    @staticmethod
+    def derive_key(key):
+        """Derives a Fernet key from the shared Diffie-Hellman key with HKDF-SHA256.
+
+        Args:
+            key: The shared Diffie-Hellman key.
+        Returns:
+            The base64 encoded Fernet key.
+        """
+        hkdf = HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=b"chat fernet key", backend=default_backend())
+        return base64.urlsafe_b64encode(hkdf.derive(key.to_bytes((key.bit_length() + 7) // 8, "big")))
+
+    @staticmethod
+    def legacy_cipher(key):
+        """Returns the cipher of older versions, which seeded the random module with the shared key.
+
+        Args:
+            key: The shared Diffie-Hellman key.
+        Returns:
+            A Fernet instance.
+        """
+        rng = random.Random(key)
+        return Fernet(base64.urlsafe_b64encode(bytearray(rng.getrandbits(8) for _ in range(32))))
 
 
 class Encryption:
@@ -121,21 +620,33 @@ class Encryption:
               "670C354E4ABC9804F1746C08CA237327FFFFFFFFFFFFFFFF", 16)
     g = 2
     private_keys = {}
+    ciphers = CipherCache()
+
+    # The name of the X25519 key exchange, which is also the prefix of X25519 public keys
+    x25519 = "x25519"
 
     @classmethod
-    def get_diffie_hellman(cls, friend):
+    def get_diffie_hellman(cls, friend, x25519=False):
         """Returns the Diffie-Hellman public key that is sent to the other user through the server.
 
         Args:
             friend: The username of the other user.
+            x25519: If True, an X25519 key is returned instead of a finite-field Diffie-Hellman key.
         """
-        if friend.lower() not in cls.private_keys:
-            cls.add_private_key(friend.lower(), 160)
-        return str(pow(cls.g, cls.private_keys[friend.lower()], cls.p))
+        friend = friend.lower()
+        if x25519:
+            if friend not in cls.private_keys:
+                cls.private_keys[friend] = X25519PrivateKey.generate()
+            return cls.x25519_public_key(cls.private_keys[friend])
+        if friend not in cls.private_keys:
+            cls.add_private_key(friend, 160)
+        return str(pow(cls.g, cls.private_keys[friend], cls.p))
 
     @classmethod
     def receive_diffie_hellman(cls, friend, received_key):
-        """Computes the shared key from the received Diffie-Hellman public key.
+        """Computes the shared key from the received Diffie-Hellman or X25519 public key.
+
+        The private key is discarded, so the next key exchange with the user starts over.
 
         Args:
             friend: The username of the key sender.
@@ -144,26 +655,67 @@ class Encryption:
         Returns:
             The computed shared key.
         """
-        if friend.lower() not in cls.private_keys:
-            cls.add_private_key(friend.lower(), 160)
-        return pow(int(received_key), cls.private_keys[friend.lower()], cls.p)
+        friend = friend.lower()
+        if cls.is_x25519(received_key):
+            if friend not in cls.private_keys:
+                cls.private_keys[friend] = X25519PrivateKey.generate()
+            return cls.x25519_shared_key(cls.private_keys.pop(friend), received_key)
+        if friend not in cls.private_keys:
+            cls.add_private_key(friend, 160)
+        return pow(int(received_key), cls.private_keys.pop(friend), cls.p)
+
+    @classmethod
+    def has_private_key(cls, friend):
+        """Checks whether a key exchange with the user is in progress, that is, the own public key has been sent.
+
+        Args:
+            friend: The username of the other user.
+        """
+        return friend.lower() in cls.private_keys
+
+    @classmethod
+    def is_x25519(cls, received_key):
+        """Checks whether a received public key is an X25519 key.
+
+        Args:
+            received_key: The received public key.
+        """
+        return received_key.startswith(cls.x25519 + ":")
 
     @classmethod
-    async def diffie_hellman_to_server(cls, connection_id, connection_secret_key, ws_uri):
+    async def diffie_hellman_to_server(cls, connection_id, connection_secret_key, send_request, x25519=False,
+                                       retry_delay=1, max_retry_delay=30):
         """Performs the Diffie-Hellman key exchange with the server before logging in.
 
+        If the server rejects the key exchange because it is overloaded or rate limited, the exchange is retried
+        with a random exponential backoff.
+
         Args:
             connection_id: The connection id from an instance of the Controller class.
             connection_secret_key: The connection secret key from an instance of the Controller class.
-            ws_uri: The location of the server.
+            send_request: A coroutine function that sends a message to the server and returns the reply. It is
+                called with the message type, the receiver, the sender and the message.
+            x25519: If True, X25519 is used instead of finite-field Diffie-Hellman.
+            retry_delay: The time in seconds before the first retry.
+            max_retry_delay: The maximum time in seconds between the retries.
 
         Returns:
             The computed shared key.
         """
-        async with websockets.connect(ws_uri) as ws:
-            await ws.send("s;;" + connection_id + ";" + str(pow(cls.g, connection_secret_key, cls.p_s)))
-            received_key = await ws.recv()
-            return pow(int(received_key), connection_secret_key, cls.p_s)
+        if x25519:
+            private_key = X25519PrivateKey.generate()
+            public_key = cls.x25519_public_key(private_key)
+        else:
+            public_key = str(pow(cls.g, connection_secret_key, cls.p_s))
+        received_key = await send_request("s", "", connection_id, public_key)
+        while received_key in REJECTED:
+            # The jitter spreads out the retries of clients that were rejected at the same time
+            await asyncio.sleep(retry_delay * random.uniform(0.5, 1.5))
+            retry_delay = min(retry_delay * 2, max_retry_delay)
+            received_key = await send_request("s", "", connection_id, public_key)
+        if x25519:
+            return cls.x25519_shared_key(private_key, received_key)
+        return pow(int(received_key), connection_secret_key, cls.p_s)
 
     @classmethod
     def add_private_key(cls, friend, n_bits):
@@ -176,7 +728,88 @@ class Encryption:
         cls.private_keys[friend] = int.from_bytes(urandom(n_bits), sys.byteorder)
 
     @staticmethod
-    def encrypt(message, key):
+    def derive_shared_key(key, info, salt=None):
+        """Derives a new shared key from a shared key with HKDF-SHA256.
+
+        Args:
+            key: The shared key.
+            info: The purpose of the derived key as bytes.
+            salt: Optional salt bytes.
+        Returns:
+            The derived key.
+        """
+        hkdf = HKDF(algorithm=hashes.SHA256(), length=32, salt=salt, info=info, backend=default_backend())
+        return int.from_bytes(hkdf.derive(key.to_bytes((key.bit_length() + 7) // 8, "big")), "big")
+
+    @classmethod
+    def resumption_secret(cls, key):
+        """Returns the secret of a session resumption ticket that is issued for a session.
+
+        Args:
+            key: The shared key of the session.
+        """
+        return cls.derive_shared_key(key, b"chat resumption")
+
+    @classmethod
+    def resumed_key(cls, secret, client_nonce, server_nonce):
+        """Returns the shared key of a session that is resumed with a ticket.
+
+        Args:
+            secret: The secret of the ticket.
+            client_nonce: The random bytes sent by the client.
+            server_nonce: The random bytes sent by the server.
+        """
+        return cls.derive_shared_key(secret, b"chat session key", client_nonce + server_nonce)
+
+    @classmethod
+    def key_exchanges(cls):
+        """Returns the supported key exchanges besides finite-field Diffie-Hellman.
+
+        Returns:
+            The names of the key exchanges separated by ",", an empty string if there are none.
+        """
+        return cls.x25519 if default_backend().x25519_supported() else ""
+
+    @classmethod
+    def supports_x25519(cls, offer):
+        """Checks whether X25519 can be used with a party that offered the given key exchanges.
+
+        Args:
+            offer: The key exchanges of the other party separated by ",".
+        Returns:
+            True if both parties support X25519, False otherwise.
+        """
+        return cls.x25519 in offer.split(",") and cls.x25519 in cls.key_exchanges().split(",")
+
+    @classmethod
+    def x25519_public_key(cls, private_key):
+        """Returns the X25519 public key that is sent to the other party.
+
+        Args:
+            private_key: An X25519PrivateKey.
+        Returns:
+            The public key as "x25519:" followed by the key in base64.
+        """
+        public_bytes = private_key.public_key().public_bytes(Encoding.Raw, PublicFormat.Raw)
+        return cls.x25519 + ":" + base64.urlsafe_b64encode(public_bytes).decode()
+
+    @classmethod
+    def x25519_shared_key(cls, private_key, received_key):
+        """Computes the shared key from a received X25519 public key.
+
+        The shared secret is returned as an integer so that it is used like a Diffie-Hellman shared key.
+
+        Args:
+            private_key: The own X25519PrivateKey.
+            received_key: The public key received from the other party. See x25519_public_key.
+        Returns:
+            The shared key.
+        """
+        public_key = X25519PublicKey.from_public_bytes(base64.urlsafe_b64decode(received_key[len(cls.x25519) + 1:]))
+        return int.from_bytes(private_key.exchange(public_key), "big")
+
+    @classmethod
+    def encrypt(cls, message, key):
         """Encrypts a message that is sent to another user.
 
         Args:
@@ -186,15 +819,14 @@ class Encryption:
         Returns:
             The encrypted message.
         """
-        random.seed(key)
-        k = base64.urlsafe_b64encode(bytearray(random.getrandbits(8) for _ in range(32)))
-        f = Fernet(k)
-        return f.encrypt(bytes(message, encoding="UTF-8")).decode("UTF-8")
+        return cls.ciphers.get(key).encrypt(bytes(message, encoding="UTF-8")).decode("UTF-8")
 
-    @staticmethod
-    def decrypt(message, key):
+    @classmethod
+    def decrypt(cls, message, key):
         """Decrypts a message that is received from another user.
 
+        Messages from older versions that do not use the derived key are decrypted with the legacy key.
+
         Args:
             message: The message.
             key: The Diffie-Hellman key that is shared between the users.
@@ -202,7 +834,8 @@ class Encryption:
         Returns:
             The decrypted message.
         """
-        random.seed(key)
-        k = base64.urlsafe_b64encode(bytearray(random.getrandbits(8) for _ in range(32)))
-        f = Fernet(k)
-        return f.decrypt(message.encode("UTF-8")).decode()
+        token = message.encode("UTF-8")
+        try:
+            return cls.ciphers.get(key).decrypt(token).decode()
+        except InvalidToken:
+            return CipherCache.legacy_cipher(key).decrypt(token).decode()
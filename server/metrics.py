@@ -0,0 +1,252 @@
+"""
+Collects the metrics of the server and serves them in the Prometheus text format.
+"""
+
+import time
+import asyncio
+from contextlib import contextmanager
+from websockets.server import WebSocketServerProtocol
+
+# The message types that the metrics are split by. The other types are counted as "other", so that clients
+# cannot create new label values.
+MESSAGE_TYPES = ("l", "r", "c", "m", "a", "d", "s", "t", "g")
+
+# The upper bounds of the latency histogram buckets in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# The content type of the Prometheus text format
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def message_type(msg_type):
+    """Returns the label value of a message type.
+
+    Args:
+        msg_type: The type of a received message.
+    """
+    return msg_type if msg_type in MESSAGE_TYPES else "other"
+
+
+def format_value(value):
+    """Formats a sample value or a bucket bound."""
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def format_labels(labels):
+    """Formats a list of (name, value) label pairs.
+
+    Args:
+        labels: The label pairs.
+    Returns:
+        The labels in braces, or an empty string if there are none.
+    """
+    if not labels:
+        return ""
+    escaped = (value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for _, value in labels)
+    return "{" + ",".join(name + "=\"" + value + "\"" for (name, _), value in zip(labels, escaped)) + "}"
+
+
+class Counter:
+    """A counter that is optionally split by the value of one label."""
+
+    kind = "counter"
+
+    def __init__(self, name, description, label=None):
+        """Constructor.
+
+        Args:
+            name: The metric name.
+            description: The help text.
+            label: The name of the label, or None.
+        """
+        self.name = name
+        self.description = description
+        self.label = label
+        self.values = {}
+
+    def inc(self, label_value=None, amount=1):
+        """Increases the counter.
+
+        Args:
+            label_value: The value of the label, None if the counter has no label.
+            amount: The increase.
+        """
+        self.values[label_value] = self.values.get(label_value, 0) + amount
+
+    def labels(self, label_value):
+        """Returns the label pairs of a label value."""
+        return [(self.label, label_value)] if self.label else []
+
+    def samples(self):
+        """Returns the samples as (name, labels, value) tuples."""
+        return [(self.name, self.labels(label_value), value) for label_value, value in sorted(self.values.items())]
+
+
+class Gauge:
+    """A gauge whose value is read from a function when the metrics are collected."""
+
+    kind = "gauge"
+
+    def __init__(self, name, description, function):
+        """Constructor.
+
+        Args:
+            name: The metric name.
+            description: The help text.
+            function: A function that returns the current value.
+        """
+        self.name = name
+        self.description = description
+        self.function = function
+
+    def samples(self):
+        """See Counter.samples."""
+        return [(self.name, [], self.function())]
+
+
+class Histogram(Counter):
+    """A histogram of durations that is optionally split by the value of one label."""
+
+    kind = "histogram"
+
+    def __init__(self, name, description, label=None, buckets=LATENCY_BUCKETS):
+        """Constructor.
+
+        Args:
+            name: The metric name.
+            description: The help text.
+            label: The name of the label, or None.
+            buckets: The upper bounds of the buckets in seconds in increasing order.
+        """
+        Counter.__init__(self, name, description, label)
+        self.buckets = tuple(buckets) + (float("inf"),)
+
+    def observe(self, label_value, seconds):
+        """Records a duration.
+
+        Args:
+            label_value: The value of the label, None if the histogram has no label.
+            seconds: The duration in seconds.
+        """
+        counts = self.values.get(label_value)
+        if counts is None:
+            # The bucket counts followed by the sum
+            counts = self.values[label_value] = [0] * len(self.buckets) + [0.0]
+        for i, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                counts[i] += 1
+                break
+        counts[-1] += seconds
+
+    @contextmanager
+    def time(self, label_value=None):
+        """Records the duration of a with block.
+
+        Args:
+            label_value: The value of the label, None if the histogram has no label.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(label_value, time.perf_counter() - start)
+
+    def samples(self):
+        """See Counter.samples. The bucket counts are cumulative."""
+        samples = []
+        for label_value, counts in sorted(self.values.items()):
+            labels = self.labels(label_value)
+            total = 0
+            for bound, count in zip(self.buckets, counts):
+                total += count
+                samples.append((self.name + "_bucket", labels + [("le", format_value(bound))], total))
+            samples.append((self.name + "_sum", labels, counts[-1]))
+            samples.append((self.name + "_count", labels, total))
+        return samples
+
+
+class Metrics:
+    """The metrics of one server process and the HTTP endpoint that serves them."""
+
+    def __init__(self):
+        self.metrics = []
+        self.messages = self.add(Counter("chat_messages_total", "Messages received from the clients.", "type"))
+        self.handler_seconds = self.add(Histogram(
+            "chat_handler_seconds", "Time spent handling a received message, including the awaited work.", "type"))
+        self.db_seconds = self.add(Histogram(
+            "chat_db_seconds", "Time of a database query, including the time it was queued.", "query"))
+        self.pool_seconds = self.add(Histogram(
+            "chat_pool_seconds", "Time of a password hash or a key exchange in the process pool, including the time "
+                                 "it waited for a process.", "operation"))
+        self.bytes_in = self.add(Counter("chat_received_bytes_total", "Payload bytes of the received messages."))
+        self.bytes_out = self.add(Counter("chat_sent_bytes_total", "Payload bytes of the sent messages."))
+
+    def add(self, metric):
+        """Registers a metric and returns it."""
+        self.metrics.append(metric)
+        return metric
+
+    def gauge(self, name, description, function):
+        """Registers a gauge. See Gauge."""
+        return self.add(Gauge(name, description, function))
+
+    def render(self):
+        """Returns the metrics in the Prometheus text format."""
+        lines = []
+        for metric in self.metrics:
+            lines.append("# HELP " + metric.name + " " + metric.description)
+            lines.append("# TYPE " + metric.name + " " + metric.kind)
+            for name, labels, value in metric.samples():
+                lines.append(name + format_labels(labels) + " " + format_value(value))
+        return "\n".join(lines) + "\n"
+
+    def protocol(self):
+        """Returns a websocket server protocol class that counts the payload bytes of the messages.
+
+        The class is passed to websockets.serve as create_protocol.
+        """
+        metrics = self
+
+        class MeteredProtocol(WebSocketServerProtocol):
+
+            async def recv(self):
+                message = await WebSocketServerProtocol.recv(self)
+                metrics.bytes_in.inc(amount=len(message))
+                return message
+
+            async def send(self, message):
+                await WebSocketServerProtocol.send(self, message)
+                metrics.bytes_out.inc(amount=len(message))
+
+        return MeteredProtocol
+
+    async def serve(self, port, host="localhost"):
+        """Starts serving the metrics over HTTP.
+
+        Args:
+            port: The port of the endpoint.
+            host: The hostname. The endpoint is only reachable locally by default.
+        Returns:
+            The asyncio server.
+        """
+        return await asyncio.start_server(self.handle, host, port)
+
+    async def handle(self, reader, writer):
+        """Answers one HTTP request with the metrics."""
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 10)
+            method, target = request.split(b" ", 2)[:2]
+            if method == b"GET" and target.split(b"?")[0] in (b"/", b"/metrics"):
+                status, content_type, body = "200 OK", CONTENT_TYPE, self.render().encode()
+            else:
+                status, content_type, body = "404 Not Found", "text/plain", b"Not found\n"
+            writer.write(("HTTP/1.1 " + status + "\r\nContent-Type: " + content_type + "\r\nContent-Length: %d\r\n"
+                          "Connection: close\r\n\r\n" % len(body)).encode() + body)
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ValueError,
+                ConnectionError):
+            pass
+        finally:
+            writer.close()
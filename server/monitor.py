@@ -0,0 +1,193 @@
+"""
+Watches the event loop of the server for stalls and profiles it on request.
+"""
+
+import os
+import sys
+import time
+import asyncio
+import weakref
+import threading
+import traceback
+from collections import Counter
+
+
+def current_task(loop):
+    """Returns the task that is running in the loop, None if there is none. Can be called from any thread."""
+    if hasattr(asyncio, "current_task"):
+        return asyncio.current_task(loop)
+    return asyncio.Task.current_task(loop)
+
+
+def folded_frames(frame):
+    """Returns the frames of a stack from the outermost as "file:function" strings."""
+    frames = []
+    while frame is not None:
+        frames.append(os.path.basename(frame.f_code.co_filename) + ":" + frame.f_code.co_name)
+        frame = frame.f_back
+    frames.reverse()
+    return frames
+
+
+class Monitor:
+    """Measures the scheduling delay of the event loop and reports the handlers that block it.
+
+    A heartbeat task runs in the loop and a watchdog thread samples the stack of the loop thread while the
+    heartbeat is late by more than the threshold. When the loop runs again, the stall is reported with the message
+    type and the phase of the handler that was running and the most common stacks. The handlers mark their message
+    type and phase with handling and phase.
+
+    The watchdog thread can only take a sample between bytecodes, so a single long call into C code, such as a
+    big-integer pow, shows up as one sample at its end.
+
+    The sampling profiler samples the loop thread at a fixed interval while it is enabled and writes the samples in
+    the folded stack format of flamegraph.pl, with the message type and the phase as the two outermost frames.
+    """
+
+    def __init__(self, threshold=None, profile_path=None, interval=0.05, sample_interval=0.005, observe_lag=None,
+                 log=None):
+        """Constructor.
+
+        Args:
+            threshold: The scheduling delay in seconds that is reported as a stall. If None, stalls are not
+                watched for.
+            profile_path: The file the profile is written to when the profiler is stopped.
+            interval: The time in seconds between the heartbeats.
+            sample_interval: The time in seconds between the stack samples.
+            observe_lag: A function that is called with the scheduling delay of each heartbeat in seconds, or None.
+            log: A function that is called with each stall report. Defaults to printing to stderr.
+        """
+        self.threshold = threshold
+        self.profile_path = profile_path
+        self.interval = interval
+        self.sample_interval = sample_interval
+        self.observe_lag = observe_lag
+        self.log = log or (lambda report: print(report, file=sys.stderr, flush=True))
+        self.enabled = threshold is not None or profile_path is not None
+        self.loop = None
+        self.thread_id = None
+        self.beat = time.monotonic()
+        # The message type and the phase of the handler running in each task
+        self.contexts = weakref.WeakKeyDictionary()
+        self.profiling = False
+        self.profile = Counter()
+        # Guards the profile, which the watchdog thread adds to and the loop thread writes out
+        self.profile_lock = threading.Lock()
+        self.heartbeat_task = None
+        self.stopped = threading.Event()
+
+    def start(self, loop):
+        """Starts the heartbeat and the watchdog thread. Must be called from the thread that runs the loop.
+
+        Args:
+            loop: The event loop of the server.
+        """
+        if not self.enabled:
+            return
+        self.loop = loop
+        self.thread_id = threading.get_ident()
+        if self.threshold is not None:
+            self.heartbeat_task = loop.create_task(self.heartbeat())
+        watchdog = threading.Thread(target=self.watch, name="loop watchdog")
+        watchdog.daemon = True
+        watchdog.start()
+
+    def stop(self):
+        """Stops the heartbeat and the watchdog thread."""
+        if self.heartbeat_task is not None:
+            self.heartbeat_task.cancel()
+        self.stopped.set()
+
+    def handling(self, msg_type):
+        """Marks the running task as handling a message of the given type.
+
+        Args:
+            msg_type: The message type.
+        """
+        if self.enabled:
+            self.contexts[current_task(self.loop)] = [msg_type, "handle"]
+
+    def phase(self, phase):
+        """Marks the phase of the message that the running task is handling, such as "decrypt", "db" or "fan-out".
+
+        Args:
+            phase: The name of the phase.
+        """
+        if self.enabled:
+            context = self.contexts.get(current_task(self.loop))
+            if context is not None:
+                context[1] = phase
+
+    def context(self):
+        """Returns the message type and the phase of the task that is running in the loop."""
+        task = current_task(self.loop)
+        if task is None:
+            return "-", "-"
+        return tuple(self.contexts.get(task, ("-", "-")))
+
+    async def heartbeat(self):
+        """Wakes up at the interval and records how late each wake-up was."""
+        while True:
+            self.beat = time.monotonic()
+            await asyncio.sleep(self.interval)
+            lag = time.monotonic() - self.beat - self.interval
+            if self.observe_lag is not None:
+                self.observe_lag(max(0, lag))
+
+    def toggle_profiling(self):
+        """Starts the profiler, or stops it and writes the profile."""
+        with self.profile_lock:
+            profile, self.profile = self.profile, Counter()
+            self.profiling = not self.profiling
+        if not self.profiling:
+            self.write_profile(profile)
+
+    def write_profile(self, profile):
+        """Writes the collected samples to the profile file in the folded stack format.
+
+        Args:
+            profile: A Counter of the samples by folded stack.
+        """
+        with open(self.profile_path, "w") as f:
+            for stack, count in sorted(profile.items()):
+                f.write("%s %d\n" % (stack, count))
+
+    def watch(self):
+        """Runs in the watchdog thread, taking the stall samples and the profile samples."""
+        stall = None
+        while not self.stopped.wait(self.sample_interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                return
+            if self.profiling:
+                msg_type, phase = self.context()
+                stack = ";".join([msg_type, phase] + folded_frames(frame))
+                with self.profile_lock:
+                    # The profiler may have been stopped while the stack was folded
+                    if self.profiling:
+                        self.profile[stack] += 1
+            if self.threshold is None:
+                continue
+
+            delay = time.monotonic() - self.beat - self.interval
+            if delay > self.threshold:
+                if stall is None:
+                    stall = {"start": self.beat + self.interval, "context": self.context(), "stacks": Counter()}
+                stall["stacks"]["".join(traceback.format_stack(frame))] += 1
+            elif stall is not None:
+                self.log(self.report(stall))
+                stall = None
+
+    def report(self, stall):
+        """Returns the report of a stall.
+
+        Args:
+            stall: A dict of the start time, the (message type, phase) tuple and a Counter of the sampled stacks.
+        """
+        samples = sum(stall["stacks"].values())
+        lines = ["Event loop blocked for %.3f s handling \"%s\" in phase \"%s\" (%d samples)" % (
+            self.beat - stall["start"], stall["context"][0], stall["context"][1], samples)]
+        for stack, count in stall["stacks"].most_common(3):
+            lines.append("%d/%d samples:" % (count, samples))
+            lines.append(stack.rstrip())
+        return "\n".join(lines)
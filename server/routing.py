@@ -0,0 +1,194 @@
+"""
+Contains the routing layer that connects the worker processes of a sharded server.
+"""
+
+import json
+import asyncio
+
+# The maximum length of a single routed message in bytes
+LINE_LIMIT = 2 ** 24
+
+
+class Router:
+    """Keeps track of the worker that each online user is connected to and forwards messages between the workers.
+
+    The workers connect to a Unix socket and exchange newline separated JSON objects with the router.
+    """
+
+    def __init__(self, path):
+        """Constructor.
+
+        Args:
+            path: The location of the Unix socket.
+        """
+        self.path = path
+        self.presence = {}
+        self.workers = {}
+
+    async def start(self):
+        """Starts listening for the workers."""
+        await asyncio.start_unix_server(self.handle_worker, self.path, limit=LINE_LIMIT)
+
+    async def handle_worker(self, reader, writer):
+        """Handles the messages of one worker until it disconnects.
+
+        Args:
+            reader: The stream reader of the worker connection.
+            writer: The stream writer of the worker connection.
+        """
+        worker = None
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                message = json.loads(line.decode())
+                op = message["op"]
+
+                if op == "hello":
+                    worker = message["worker"]
+                    self.workers[worker] = writer
+                    self.send(writer, {"op": "snapshot", "presence": self.presence})
+                elif op == "online":
+                    self.presence[message["user"]] = worker
+                    self.broadcast(worker, {"op": "online", "user": message["user"], "worker": worker})
+                elif op == "offline":
+                    if self.presence.get(message["user"]) == worker:
+                        self.presence.pop(message["user"])
+                        self.broadcast(worker, {"op": "offline", "user": message["user"]})
+                elif op == "route":
+                    owner = self.presence.get(message["user"])
+                    if owner is not None and owner in self.workers:
+                        self.send(self.workers[owner], {"op": "deliver", "user": message["user"],
+                                                        "event": message["event"]})
+                elif op == "friends":
+                    self.broadcast(worker, message)
+        finally:
+            if worker is not None:
+                self.workers.pop(worker, None)
+                for user in [user for user, owner in self.presence.items() if owner == worker]:
+                    self.presence.pop(user)
+                    self.broadcast(worker, {"op": "offline", "user": user})
+            writer.close()
+
+    def broadcast(self, sender, message):
+        """Sends the message to every worker except the sender.
+
+        Args:
+            sender: The id of the worker that caused the message.
+            message: A JSON serializable dict.
+        """
+        for worker, writer in self.workers.items():
+            if worker != sender:
+                self.send(writer, message)
+
+    @staticmethod
+    def send(writer, message):
+        """Writes one message to a worker connection.
+
+        Args:
+            writer: The stream writer of the worker connection.
+            message: A JSON serializable dict.
+        """
+        writer.write(json.dumps(message).encode() + b"\n")
+
+
+class RouterClient:
+    """The connection of one worker process to the router."""
+
+    def __init__(self, worker, path, on_deliver, on_friends):
+        """Constructor.
+
+        Args:
+            worker: The id of the worker.
+            path: The location of the Unix socket of the router.
+            on_deliver: A coroutine function that is called with the username and the event when the router
+                forwards an event to a user of this worker.
+            on_friends: A function that is called with the two usernames when another worker adds a friendship.
+        """
+        self.worker = worker
+        self.path = path
+        self.on_deliver = on_deliver
+        self.on_friends = on_friends
+        self.remote = {}
+        self.writer = None
+
+    async def connect(self, retries=50):
+        """Connects to the router and starts handling the forwarded messages.
+
+        Args:
+            retries: The number of times the connection is retried while the router is starting.
+        """
+        for _ in range(retries):
+            try:
+                reader, self.writer = await asyncio.open_unix_connection(self.path, limit=LINE_LIMIT)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                await asyncio.sleep(0.1)
+        else:
+            raise ConnectionError("Could not connect to the router at " + self.path)
+        self.send({"op": "hello", "worker": self.worker})
+        asyncio.ensure_future(self.read(reader))
+
+    async def read(self, reader):
+        """Handles the messages from the router.
+
+        Args:
+            reader: The stream reader of the router connection.
+        """
+        while True:
+            line = await reader.readline()
+            if not line:
+                # The router has stopped, so the worker stops too
+                asyncio.get_event_loop().stop()
+                return
+            message = json.loads(line.decode())
+            op = message["op"]
+
+            if op == "snapshot":
+                self.remote = message["presence"]
+            elif op == "online":
+                self.remote[message["user"]] = message["worker"]
+            elif op == "offline":
+                self.remote.pop(message["user"], None)
+            elif op == "deliver":
+                await self.on_deliver(message["user"], message["event"])
+            elif op == "friends":
+                self.on_friends(*message["users"])
+
+    def send(self, message):
+        """Sends one message to the router.
+
+        Args:
+            message: A JSON serializable dict.
+        """
+        self.writer.write(json.dumps(message).encode() + b"\n")
+
+    def announce(self, user, online):
+        """Tells the other workers that a user connected to or disconnected from this worker.
+
+        Args:
+            user: The username.
+            online: True if the user connected, False if the user disconnected.
+        """
+        self.send({"op": "online" if online else "offline", "user": user})
+
+    def add_friends(self, user_1, user_2):
+        """Tells the other workers that two users became friends.
+
+        Args:
+            user_1: The username of the first user.
+            user_2: The username of the second user.
+        """
+        self.send({"op": "friends", "users": [user_1, user_2]})
+
+    def route(self, user, event):
+        """Forwards an event to a user that is connected to another worker.
+
+        The event is encoded into a frame by the worker of the receiver, which knows the protocol of the user.
+
+        Args:
+            user: The username of the receiver.
+            event: The event as a JSON serializable tuple.
+        """
+        self.send({"op": "route", "user": user, "event": event})
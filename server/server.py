@@ -2,102 +2,396 @@
 Contains the server functionality.
 """
 
+import os
+import base64
+import functools
+import signal
 import asyncio
+import sqlite3
+import argparse
+import tempfile
 import websockets
-import pickle
+import multiprocessing
+from os import urandom
 
-from server_tools import Encryption, Database
+from server_tools import KEY_EXCHANGE_HEADER, RESUMPTION_HEADER, Encryption, Session, SessionRegistry, TicketCache
+from server_tools import AsyncDatabase, PasswordHasher, HasherBusy, RateLimiter, PresenceNotifier
+from server_tools import TextProtocol, BinaryProtocol, PROTOCOLS, Outbox, Compression, OfflineStore
+from routing import Router, RouterClient
+from metrics import Metrics, Histogram, message_type
+from monitor import Monitor
+
+# Response sent when a request is rejected because the server is overloaded
+BUSY = "2"
+# Response sent when a request is rejected because its address or username has made too many requests
+RATE_LIMITED = "3"
 
 
 class Server:
     """Initializes the server and handles the connections. """
 
-    def __init__(self, hostname="localhost", port=8765):
+    def __init__(self, hostname="localhost", port=8765, hash_workers=None, max_pending_hashes=256, db_readers=4,
+                 presence_window=0.5, compression_threshold=512, compression_window_bits=None, max_sessions=100000,
+                 handshake_timeout=600, ping_interval=20, ping_timeout=20, reap_interval=60, max_queue=1024,
+                 max_offline_messages=10000, overflow_policy="spill", address_rate=1, address_burst=20, user_rate=0.1,
+                 user_burst=5, metrics_port=None, worker=None, router_path=None, stall_threshold=None,
+                 profile_path=None):
         """Constructor.
 
         Args:
             hostname: The hostname. Default value "localhost".
             port: The port for the websocket connections. Default value 8765.
+            hash_workers: The number of processes used for password hashing and Diffie-Hellman key exchanges.
+                Defaults to the number of CPUs.
+            max_pending_hashes: The maximum number of password hashes and Diffie-Hellman key exchanges that can be
+                pending. The requests over the limit are rejected as busy.
+            db_readers: The number of threads used for database reads.
+            presence_window: The time in seconds during which the presence changes of one user are merged.
+            compression_threshold: The size in bytes below which messages are not compressed.
+            compression_window_bits: The base two logarithm of the compression window. Defaults to 15.
+            max_sessions: The maximum number of client sessions.
+            handshake_timeout: The time in seconds after which an idle session of a client that has not connected
+                as a user is removed.
+            ping_interval: The time in seconds between the keepalive pings of a connection.
+            ping_timeout: The time in seconds after which a connection whose keepalive ping is not answered is
+                closed.
+            reap_interval: The time in seconds between the checks for idle sessions.
+            max_queue: The maximum number of events queued for one connection.
+            max_offline_messages: The maximum number of messages stored for one offline user. The messages over the
+                limit are dropped.
+            overflow_policy: What happens when the queue of a connection is full: "drop", "spill" or
+                "disconnect". See Outbox.
+            address_rate: The number of key exchanges, logins and registrations per second allowed from one
+                address in the long run.
+            address_burst: The number of key exchanges, logins and registrations allowed from one address at once.
+            user_rate: The number of logins and registrations per second allowed for one username in the long run.
+            user_burst: The number of logins and registrations allowed for one username at once.
+            metrics_port: The local port on which the metrics are served in the Prometheus text format. With
+                several worker processes, each worker adds its id to the port. If None, the metrics are not served.
+            worker: The id of this process when the server is run with several worker processes.
+            router_path: The location of the Unix socket of the router that connects the worker processes.
+            stall_threshold: The time in seconds that the event loop can be blocked before the stall is reported
+                with the message type, the phase and the stacks of the blocking handler. If None, the event loop
+                is not watched.
+            profile_path: The file that the sampling profiler writes the folded stacks to. The profiler is started
+                and stopped with SIGUSR2. With several worker processes, each worker adds its id to the path. If
+                None, the profiler is not available.
         """
-        self.connections = {}
-        self.db = Database()
-        self.keys = {}
+        self.metrics = Metrics()
+        observe_lag = None
+        if stall_threshold is not None:
+            lag_seconds = self.metrics.add(Histogram("chat_loop_lag_seconds", "Scheduling delay of the event loop."))
+            observe_lag = functools.partial(lag_seconds.observe, None)
+        if profile_path is not None and worker is not None:
+            profile_path += ".%d" % worker
+        self.monitor = Monitor(stall_threshold, profile_path, observe_lag=observe_lag)
+        self.sessions = SessionRegistry(max_sessions, handshake_timeout)
+        self.db = AsyncDatabase(readers=db_readers, observe=self.metrics.db_seconds.observe)
+        self.offline = OfflineStore(observe=self.metrics.db_seconds.observe, max_messages=max_offline_messages)
+        self.hasher = PasswordHasher(hash_workers, max_pending_hashes, self.metrics.pool_seconds.observe)
+        self.address_limits = RateLimiter(address_rate, address_burst)
+        self.user_limits = RateLimiter(user_rate, user_burst)
+        self.tickets = TicketCache()
+        self.router = None
+        self.presence = PresenceNotifier(self.deliver, self.find_online_friend_names, presence_window)
+        self.max_queue = max_queue
+        self.overflow_policy = overflow_policy
+        self.add_gauges()
+        options = {"subprotocols": [BinaryProtocol.name], "compression": None,
+                   "extensions": [Compression(compression_threshold, compression_window_bits)],
+                   "create_protocol": self.metrics.protocol(),
+                   "ping_interval": ping_interval, "ping_timeout": ping_timeout,
+                   "extra_headers": {RESUMPTION_HEADER: "1"}}
+        if Encryption.key_exchanges():
+            options["extra_headers"][KEY_EXCHANGE_HEADER] = Encryption.key_exchanges()
 
-        start_server = websockets.serve(self.msg, hostname, port)
-        asyncio.get_event_loop().run_until_complete(start_server)
-        asyncio.get_event_loop().run_forever()
+        loop = asyncio.get_event_loop()
+        if router_path:
+            # The worker processes share the listening port and reach each other's users through the router
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            self.router = RouterClient(worker, router_path, self.deliver_local, self.db.graph.add)
+            loop.run_until_complete(self.router.connect())
+            start_server = websockets.serve(self.msg, hostname, port, reuse_port=True, **options)
+        else:
+            start_server = websockets.serve(self.msg, hostname, port, **options)
+        loop.run_until_complete(start_server)
+        if metrics_port is not None:
+            loop.run_until_complete(self.metrics.serve(metrics_port + (worker or 0)))
+        loop.create_task(self.reap_sessions(reap_interval))
+        # The session report is printed on request: kill -USR1 <pid>
+        loop.add_signal_handler(signal.SIGUSR1, lambda: print(self.sessions.report(), flush=True))
+        self.monitor.start(loop)
+        if profile_path is not None:
+            # The profiler is started and stopped on request: kill -USR2 <pid>
+            loop.add_signal_handler(signal.SIGUSR2, self.monitor.toggle_profiling)
+        loop.run_forever()
 
     async def msg(self, websocket, _):
         """Handles the received messages."""
+        protocol = PROTOCOLS[websocket.subprotocol]
+        address = websocket.remote_address[0] if websocket.remote_address else ""
+        # The lowercased usernames of the user that logged in and the user that connected through this websocket
+        logged_in_user = None
+        connected_user = None
         try:
             async for received_message in websocket:
-                msg_type, receiver, sender, message = self.parse_message(received_message)
-
-                # Login
-                if msg_type == "l":
-                    message = Encryption.decrypt(message, self.keys[sender])
-                    username, password = message.split("@", 1)
-                    if self.db.verify_user(username, password):
-                        self.keys[username] = self.keys[sender]
-                        self.keys.pop(sender)
-                        await websocket.send("1")
-                    else:
-                        await websocket.send("0")
-                # Registration
-                elif msg_type == "r":
-                    message = Encryption.decrypt(message, self.keys[sender])
-                    username, password = message.split("@", 1)
-                    if not self.db.find_user(username):
-                        self.db.add_user(username, password)
-                        await websocket.send("1")
-                    else:
-                        await websocket.send("0")
-                # Connection
-                elif msg_type == "c":
-                    if sender.lower() not in self.connections:
-                        self.connections[sender.lower()] = websocket
-                    online_friends = self.find_online_friends(sender)
-                    await websocket.send(pickle.dumps(online_friends))
-                    for friend, online in online_friends.items():
-                        if online:
-                            await self.connections[friend].send("c+" + sender + ";1")
-                # Receive a message
-                elif msg_type == "m":
-                    if receiver in self.connections and receiver != sender:
-                        await self.connections[sender].send(sender + ">" + receiver + ";" + message)
-                        await self.connections[receiver].send(sender + ">" + sender + ";" + message)
-                # Add friend
-                elif msg_type == "a":
-                    if self.db.find_user(receiver) and receiver.lower() in self.connections\
-                            and not self.db.are_friends(sender, receiver):
-                        self.db.add_friends(sender, receiver)
-                        if receiver.lower() in self.connections:
-                            await self.connections[receiver.lower()].send("a+" + sender + ";")
-                        await websocket.send("1")
-                    else:
-                        await websocket.send("0")
-                # Diffie-Hellman key exchange between clients
-                elif msg_type == "d":
-                    if receiver.lower() in self.connections:
-                        await self.connections[receiver.lower()].send("d+" + sender + ";" + message)
-                # Diffie-Hellman exchange between server and a client
-                elif msg_type == "s":
-                    self.keys[sender] = await Encryption.receive_diffie_hellman_from_client(sender, message)
-                    await websocket.send(Encryption.get_diffie_hellman_key(sender))
-                # Disconnection request
-                elif msg_type == "g":
-                    try:
-                        self.connections.pop(sender.lower())
-                        online_friends = self.find_online_friends(sender)
-                        for friend, online in online_friends.items():
-                            if online:
-                                await self.connections[friend].send("c+" + sender + ";0")
-                        self.keys.pop(sender)
-                    except KeyError:
+                msg_type, receiver, sender, message = protocol.parse(received_message)
+                if connected_user is not None:
+                    self.sessions.get(connected_user)
+
+                label = message_type(msg_type)
+                self.metrics.messages.inc(label)
+                self.monitor.handling(label)
+                with self.metrics.handler_seconds.time(label):
+                    # Messages to other users can only be sent by the user connected through this websocket
+                    if msg_type in ("m", "a", "d") and sender.lower() != connected_user:
+                        if msg_type == "a":
+                            await websocket.send(protocol.reply("0"))
                         continue
+                    # Login
+                    if msg_type == "l":
+                        session = self.sessions.get(self.sessions.pending(sender))
+                        if session is None or session.key is None:
+                            await websocket.send(protocol.reply("0"))
+                            continue
+                        self.monitor.phase("decrypt")
+                        message = Encryption.decrypt(TextProtocol.ciphertext(message), session.key)
+                        username, password = message.split("@", 1)
+                        if not self.admit(address, username):
+                            await websocket.send(protocol.reply(RATE_LIMITED))
+                            continue
+                        self.monitor.phase("db")
+                        credentials = await self.db.find_credentials(username)
+                        self.monitor.phase("hash")
+                        try:
+                            verified = credentials and await self.hasher.verify_password(password, *credentials)
+                        except HasherBusy:
+                            await websocket.send(protocol.reply(BUSY))
+                            continue
+                        if verified:
+                            self.sessions.rename(self.sessions.pending(sender), username.lower())
+                            logged_in_user = username.lower()
+                            await websocket.send(protocol.reply("1"))
+                        else:
+                            await websocket.send(protocol.reply("0"))
+                    # Registration
+                    elif msg_type == "r":
+                        session = self.sessions.get(self.sessions.pending(sender))
+                        if session is None or session.key is None:
+                            await websocket.send(protocol.reply("0"))
+                            continue
+                        self.monitor.phase("decrypt")
+                        message = Encryption.decrypt(TextProtocol.ciphertext(message), session.key)
+                        username, password = message.split("@", 1)
+                        if not self.admit(address, username):
+                            await websocket.send(protocol.reply(RATE_LIMITED))
+                            continue
+                        self.monitor.phase("db")
+                        if not await self.db.find_user(username):
+                            self.monitor.phase("hash")
+                            try:
+                                hashed_password, salt = await self.hasher.hash_password(password)
+                            except HasherBusy:
+                                await websocket.send(protocol.reply(BUSY))
+                                continue
+                            self.monitor.phase("db")
+                            try:
+                                await self.db.add_hashed_user(username, hashed_password, salt)
+                            except sqlite3.IntegrityError:
+                                # The same username was registered while the password was being hashed
+                                await websocket.send(protocol.reply("0"))
+                                continue
+                            await websocket.send(protocol.reply("1"))
+                        else:
+                            await websocket.send(protocol.reply("0"))
+                    # Connection
+                    elif msg_type == "c":
+                        session = None
+                        if sender.lower() == logged_in_user:
+                            session = self.sessions.connect(sender.lower(), websocket)
+                        if session is None:
+                            # The user has not logged in through this websocket, is already connected or the
+                            # registry is full, so the queued messages are left for the user's own connection
+                            await websocket.send(protocol.friend_list({}))
+                            continue
+                        connected_user = sender.lower()
+                        # The events sent to the user from now on wait in the outbox until the friend list and the
+                        # queued messages have been sent, so they arrive after them
+                        session.outbox = Outbox(websocket, lambda event, user=connected_user: self.spill(user, event),
+                                                self.max_queue, self.overflow_policy, paused=True)
+                        if self.router:
+                            self.router.announce(sender.lower(), True)
+                        self.monitor.phase("fan-out")
+                        online_friends = self.find_online_friends(sender)
+                        await websocket.send(protocol.friend_list(online_friends))
+                        self.presence.notify(sender, 1)
+                        # Deliver the messages that were sent while the user was offline
+                        self.monitor.phase("offline")
+                        async for page in self.offline.pages(sender.lower()):
+                            for frame in protocol.encode_events([("m", user, user, text) for user, text in page]):
+                                await websocket.send(frame)
+                        session.outbox.start()
+                    # Receive a message
+                    elif msg_type == "m":
+                        # The events are queued for the writers of the connections, so a slow receiver does not
+                        # block the sender
+                        self.monitor.phase("fan-out")
+                        if self.is_online(receiver.lower()) and receiver.lower() != connected_user:
+                            await self.deliver(connected_user, ("m", sender, receiver, message))
+                            await self.deliver(receiver.lower(), ("m", sender, sender, message))
+                        elif receiver.lower() != connected_user and self.db.are_friends(sender, receiver):
+                            # The message is queued until the receiver connects
+                            self.monitor.phase("offline")
+                            if await self.offline.add_message(receiver, sender, BinaryProtocol.ciphertext(message)):
+                                await self.deliver(connected_user, ("m", sender, receiver, message))
+                    # Add friend
+                    elif msg_type == "a":
+                        self.monitor.phase("db")
+                        if self.is_online(receiver.lower()) and await self.db.find_user(receiver)\
+                                and not self.db.are_friends(sender, receiver):
+                            await self.db.add_friends(sender, receiver)
+                            if self.router:
+                                self.router.add_friends(sender, receiver)
+                            # The message lists the key exchanges that the sender supports
+                            self.monitor.phase("fan-out")
+                            await self.deliver(receiver.lower(), ("a", sender, message))
+                            await websocket.send(protocol.reply("1"))
+                        else:
+                            await websocket.send(protocol.reply("0"))
+                    # Diffie-Hellman key exchange between clients
+                    elif msg_type == "d":
+                        self.monitor.phase("fan-out")
+                        await self.deliver(receiver.lower(), ("d", sender, message))
+                    # Diffie-Hellman exchange between server and a client
+                    elif msg_type == "s":
+                        if not self.admit(address):
+                            await websocket.send(protocol.reply(RATE_LIMITED))
+                            continue
+                        session = Session()
+                        self.monitor.phase("key exchange")
+                        if message.startswith(Encryption.x25519 + ":"):
+                            session.key, public_key = Encryption.x25519_exchange(message)
+                        else:
+                            try:
+                                session.key, public_key = await self.hasher.key_exchange(message)
+                            except HasherBusy:
+                                await websocket.send(protocol.reply(BUSY))
+                                continue
+                        if not self.sessions.add(self.sessions.pending(sender), session):
+                            # Every session is in use by a connected user
+                            await websocket.close(1013)
+                            return
+                        await websocket.send(protocol.reply(public_key))
+                    # Session resumption tickets
+                    elif msg_type == "t":
+                        if not self.admit(address):
+                            await websocket.send(protocol.reply(RATE_LIMITED))
+                            continue
+                        await websocket.send(protocol.reply(self.handle_ticket(sender, message, logged_in_user)))
+                    # Disconnection request
+                    elif msg_type == "g":
+                        # Only the session of this connection can be removed
+                        session = self.sessions.remove(self.sessions.pending(sender)) or \
+                            self.sessions.remove(sender.lower(), websocket)
+                        if session is not None and session.websocket is not None:
+                            self.disconnected(sender.lower(), session)
 
         except websockets.ConnectionClosed:
             pass
+        finally:
+            session = self.sessions.remove(connected_user, websocket) if connected_user is not None else None
+            if session is not None:
+                self.disconnected(connected_user, session)
+
+    def add_gauges(self):
+        """Registers the gauges of the server's state."""
+        self.metrics.gauge("chat_connections", "Users connected to this process.", lambda: self.sessions.online)
+        self.metrics.gauge("chat_sessions", "Client sessions, including those that have not connected as a user.",
+                           lambda: len(self.sessions))
+        self.metrics.gauge("chat_cached_keys", "Shared keys whose cipher is cached.",
+                           lambda: len(Encryption.ciphers.ciphers))
+        self.metrics.gauge("chat_resumption_tickets", "Session resumption tickets that have not been redeemed.",
+                           lambda: len(self.tickets.tickets))
+        self.metrics.gauge("chat_pool_pending", "Password hashes and key exchanges queued or running.",
+                           lambda: self.hasher.pending)
+        self.metrics.gauge("chat_queued_events", "Events waiting in the outboxes of the connections.",
+                           lambda: sum(len(session.outbox.events) for session in self.sessions.sessions.values()
+                                       if session.outbox is not None))
+
+    def admit(self, address, username=None):
+        """Checks the rate limits of a key exchange, session resumption, login or registration request.
+
+        The address is charged before the username, so requests that are rejected because of their address do not
+        use up the limit of the username.
+
+        Args:
+            address: The address of the peer.
+            username: The username in the request, None for key exchanges and session resumption tickets.
+        Returns:
+            True if the request is within the limits, False if it is rejected.
+        """
+        if not self.address_limits.allow(address):
+            return False
+        return username is None or self.user_limits.allow(username.lower())
+
+    def disconnected(self, user, session):
+        """Stops sending to a user that has disconnected and tells the other worker processes and the friends.
+
+        Args:
+            user: The lowercased username.
+            session: The removed session of the user.
+        """
+        if session.outbox is not None:
+            session.outbox.close()
+        if self.router:
+            self.router.announce(user, False)
+        self.presence.notify(user, 0)
+
+    async def reap_sessions(self, interval):
+        """Removes the idle sessions and the sessions of the closed connections periodically.
+
+        Args:
+            interval: The time in seconds between the checks.
+        """
+        while True:
+            await asyncio.sleep(interval)
+            for user, session in self.sessions.expired():
+                if self.sessions.remove(user, session.websocket):
+                    self.disconnected(user, session)
+
+    def handle_ticket(self, sender, message, logged_in_user):
+        """Issues a session resumption ticket to a logged in user or resumes a session with a ticket.
+
+        Args:
+            sender: The username, or the connection id when a session is resumed.
+            logged_in_user: The lowercased username of the user that logged in through the websocket, or None.
+                Tickets are only issued to this user.
+            message: An empty string to issue a ticket, or the ticket id and the client nonce in base64
+                separated by ":" to resume a session.
+        Returns:
+            The ticket id or the server nonce in base64, "0" if the request is rejected.
+        """
+        if not message:
+            if sender.lower() != logged_in_user:
+                return "0"
+            session = self.sessions.get(sender.lower())
+            if session is None or session.key is None:
+                return "0"
+            return self.tickets.issue(session.key)
+        ticket, _, client_nonce = message.partition(":")
+        secret = self.tickets.redeem(ticket)
+        if secret is None:
+            return "0"
+        try:
+            client_nonce = base64.urlsafe_b64decode(client_nonce)
+        except ValueError:
+            return "0"
+        server_nonce = urandom(16)
+        session = Session(Encryption.resumed_key(secret, client_nonce, server_nonce))
+        if not self.sessions.add(self.sessions.pending(sender), session):
+            return "0"
+        return base64.urlsafe_b64encode(server_nonce).decode()
 
     def find_online_friends(self, user):
         """Returns the friends of the given user and their online status.
@@ -110,24 +404,123 @@ class Server:
         ret = {}
         friends = self.db.find_friends(user)
         for friend in friends:
-            if friend in self.connections:
+            if self.is_online(friend):
                 ret[friend] = 1
             else:
                 ret[friend] = 0
         return ret
 
-    @staticmethod
-    def parse_message(message):
-        """Parses the received message into 4 parts that are separated by ";".
+    def find_online_friend_names(self, user):
+        """Returns the friends of the given user that are online.
 
         Args:
-            message: The message to be parsed.
+            user: The name of the given user.
+        Returns:
+            A list of usernames.
+        """
+        return [friend for friend in self.db.find_friends(user) if self.is_online(friend)]
+
+    def is_online(self, user):
+        """Checks whether the user is connected to this process or to another worker process.
+
+        Args:
+            user: The username.
         Returns:
-            A tuple containing the four parsed parts.
+            True if the user is online, False otherwise.
+        """
+        return self.sessions.connection(user) is not None or (self.router is not None and user in self.router.remote)
+
+    async def deliver(self, user, event):
+        """Sends an event to the user, through the router if the user is connected to another worker process.
+
+        Args:
+            user: The username of the receiver.
+            event: The sent event. See TextProtocol.encode_event.
+        """
+        outbox = self.sessions.outbox(user)
+        if outbox is not None:
+            outbox.put(event)
+        elif self.router is not None and user in self.router.remote:
+            if event[0] == "m":
+                event = event[:3] + (TextProtocol.ciphertext(event[3]),)
+            self.router.route(user, event)
+
+    async def spill(self, user, event):
+        """Stores a chat message that did not fit in the queue of the user's connection until the user connects
+        again.
+
+        Args:
+            user: The lowercased username of the receiver.
+            event: The ("m", sender, sender, ciphertext) event.
+        """
+        await self.offline.add_message(user, event[1], BinaryProtocol.ciphertext(event[3]))
+
+    async def deliver_local(self, user, event):
+        """Sends an event that another worker process routed to a user of this process.
+
+        A chat message for a user that has just disconnected is queued until the user connects again.
+
+        Args:
+            user: The username of the receiver.
+            event: The sent event as a list.
         """
-        split_message = message.split(";", 3)
-        return split_message[0], split_message[1], split_message[2], split_message[3]
+        if self.sessions.outbox(user) is not None:
+            await self.deliver(user, tuple(event))
+        elif event[0] == "m":
+            await self.offline.add_message(user, event[1], BinaryProtocol.ciphertext(event[3]))
+
+
+def run_workers(workers, **kwargs):
+    """Runs the server in several processes that share the listening port.
+
+    Args:
+        workers: The number of worker processes.
+        kwargs: The arguments passed to each Server.
+    """
+    router_path = os.path.join(tempfile.mkdtemp(), "router.sock")
+    kwargs.setdefault("hash_workers", max(1, (os.cpu_count() or 1) // workers))
+    processes = [multiprocessing.Process(target=Server, kwargs=dict(kwargs, worker=worker, router_path=router_path))
+                 for worker in range(workers)]
+    for process in processes:
+        process.start()
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(Router(router_path).start())
+    try:
+        loop.run_forever()
+    finally:
+        for process in processes:
+            process.terminate()
 
 
 if __name__ == "__main__":
-    Server()
+    parser = argparse.ArgumentParser(description="Runs the chat server.")
+    parser.add_argument("--host", default="localhost", help="the hostname")
+    parser.add_argument("--port", type=int, default=8765, help="the port for the websocket connections")
+    parser.add_argument("--workers", type=int, default=1, help="the number of worker processes")
+    parser.add_argument("--compression-threshold", type=int, default=512,
+                        help="the size in bytes below which messages are not compressed")
+    parser.add_argument("--max-queue", type=int, default=1024,
+                        help="the maximum number of events queued for one connection")
+    parser.add_argument("--overflow-policy", choices=Outbox.policies, default="spill",
+                        help="what happens when the queue of a connection is full")
+    parser.add_argument("--address-rate", type=float, default=1,
+                        help="the key exchanges, logins and registrations per second allowed from one address")
+    parser.add_argument("--address-burst", type=int, default=20,
+                        help="the key exchanges, logins and registrations allowed from one address at once")
+    parser.add_argument("--metrics-port", type=int, help="the local port on which the metrics are served")
+    parser.add_argument("--stall-threshold", type=float,
+                        help="report the handlers that block the event loop for longer than this many seconds")
+    parser.add_argument("--profile-path",
+                        help="the file the sampling profiler writes to, the profiler is toggled with SIGUSR2")
+    args = parser.parse_args()
+
+    if args.workers > 1:
+        run_workers(args.workers, hostname=args.host, port=args.port, compression_threshold=args.compression_threshold,
+                    max_queue=args.max_queue, overflow_policy=args.overflow_policy, address_rate=args.address_rate,
+                    address_burst=args.address_burst, metrics_port=args.metrics_port,
+                    stall_threshold=args.stall_threshold, profile_path=args.profile_path)
+    else:
+        Server(args.host, args.port, compression_threshold=args.compression_threshold, max_queue=args.max_queue,
+               overflow_policy=args.overflow_policy, address_rate=args.address_rate, address_burst=args.address_burst,
+               metrics_port=args.metrics_port, stall_threshold=args.stall_threshold, profile_path=args.profile_path)
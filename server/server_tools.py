@@ -3,14 +3,120 @@ Contains tools for the server to use.
 """
 
 import sys
+import hmac
+import time
+import queue
+import pickle
+import struct
 import random
 import base64
+import asyncio
 import hashlib
 import binascii
+import threading
+import websockets
 from os import urandom
-from cryptography.fernet import Fernet
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from cryptography.fernet import Fernet, InvalidToken
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from cryptography.hazmat.primitives.serialization import Encoding, PublicFormat
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey, X25519PublicKey
+from websockets.extensions.permessage_deflate import ServerPerMessageDeflateFactory
 import sqlite3
 
+# The opcodes of text and binary websocket frames
+DATA_OPCODES = (1, 2)
+
+# The handshake response header in which the server lists the key exchanges it supports
+KEY_EXCHANGE_HEADER = "Chat-Key-Exchange"
+
+# The handshake response header that tells that the server accepts session resumption tickets
+RESUMPTION_HEADER = "Chat-Session-Resumption"
+
+
+class HasherBusy(Exception):
+    """Raised when too many password hashes and key exchanges are already pending."""
+
+
+async def timed(awaitable, observe, name):
+    """Awaits an operation and reports its duration.
+
+    Args:
+        awaitable: The operation.
+        observe: A function that is called with the name and the duration in seconds, or None.
+        name: The name of the operation.
+    Returns:
+        The result of the operation.
+    """
+    if observe is None:
+        return await awaitable
+    start = time.perf_counter()
+    try:
+        return await awaitable
+    finally:
+        observe(name, time.perf_counter() - start)
+
+
+class CipherCache:
+    """A bounded LRU cache of Fernet ciphers keyed by the shared Diffie-Hellman key."""
+
+    def __init__(self, size=128):
+        """Constructor.
+
+        Args:
+            size: The maximum number of cached ciphers.
+        """
+        self.size = size
+        self.ciphers = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the cipher for the shared key, deriving it on the first use.
+
+        Args:
+            key: The shared Diffie-Hellman key.
+        Returns:
+            A Fernet instance.
+        """
+        with self.lock:
+            cipher = self.ciphers.get(key)
+            if cipher is not None:
+                self.ciphers.move_to_end(key)
+                return cipher
+        cipher = Fernet(self.derive_key(key))
+        with self.lock:
+            self.ciphers[key] = cipher
+            while len(self.ciphers) > self.size:
+                self.ciphers.popitem(last=False)
+        return cipher
+
+    @staticmethod
+    def derive_key(key):
+        """Derives a Fernet key from the shared Diffie-Hellman key with HKDF-SHA256.
+
+        Args:
+            key: The shared Diffie-Hellman key.
+        Returns:
+            The base64 encoded Fernet key.
+        """
+        hkdf = HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=b"chat fernet key", backend=default_backend())
+        return base64.urlsafe_b64encode(hkdf.derive(key.to_bytes((key.bit_length() + 7) // 8, "big")))
+
+    @staticmethod
+    def legacy_cipher(key):
+        """Returns the cipher of older versions, which seeded the random module with the shared key.
+
+        Args:
+            key: The shared Diffie-Hellman key.
+        Returns:
+            A Fernet instance.
+        """
+        rng = random.Random(key)
+        return Fernet(base64.urlsafe_b64encode(bytearray(rng.getrandbits(8) for _ in range(32))))
+
 
 class Encryption:
     """Methods for Diffie-Hellman key exchange, message encrypting and password hashing."""
@@ -25,59 +131,162 @@ class Encryption:
               "83655D23DCA3AD961C62F356208552BB9ED529077096966D"
               "670C354E4ABC9804F1746C08CA237327FFFFFFFFFFFFFFFF", 16)
     g = 2
-    private_keys = {}
+    ciphers = CipherCache()
+
+    # The name of the X25519 key exchange, which is also the prefix of X25519 public keys
+    x25519 = "x25519"
 
     @classmethod
-    def get_diffie_hellman_key(cls, client):
+    def get_diffie_hellman_key(cls, private_key):
         """Returns the Diffie-Hellman public key that is sent to the other party.
 
         Args:
-            client: Name of the other party.
+            private_key: The private key of the session.
         Returns:
             The Diffie-Hellman public key.
         """
-        if client not in cls.private_keys:
-            cls.add_private_key(client, 120)
-        return str(pow(cls.g, cls.private_keys[client], cls.p_s))
+        return str(pow(cls.g, private_key, cls.p_s))
 
     @classmethod
-    async def receive_diffie_hellman_from_client(cls, client, received_key):
+    def receive_diffie_hellman_from_client(cls, private_key, received_key):
         """Returns the shared key that is computed from the received Diffie-Hellman public key.
 
         Args:
-            client: Name of the other party.
+            private_key: The private key of the session.
             received_key: The public key received from the other party.
         Returns:
             The Diffie-Hellman shared key.
         """
-        if client not in cls.private_keys:
-            await cls.add_private_key(client, 120)
-        return pow(int(received_key), cls.private_keys[client], cls.p_s)
+        return pow(int(received_key), private_key, cls.p_s)
+
+    @staticmethod
+    def new_private_key():
+        """Returns a random 960-bit private key for the Diffie-Hellman key exchange with a client."""
+        return int.from_bytes(urandom(120), sys.byteorder)
+
+    @classmethod
+    def diffie_hellman_exchange(cls, received_key):
+        """Performs the server side of a finite-field Diffie-Hellman key exchange with a client.
+
+        Args:
+            received_key: The public key received from the client.
+        Returns:
+            A tuple of the shared key and the public key that is sent to the client.
+        """
+        private_key = cls.new_private_key()
+        shared_key = cls.receive_diffie_hellman_from_client(private_key, received_key)
+        return shared_key, cls.get_diffie_hellman_key(private_key)
 
     @classmethod
-    async def add_private_key(cls, client, n_bits):
-        """Adds a random private key for the Diffie-Hellman key exchange between a client.
+    def x25519_exchange(cls, received_key):
+        """Performs the server side of an X25519 key exchange with a client.
 
         Args:
-            client: Name of the other party.
-            n_bits: The length of the key in bits.
+            received_key: The public key received from the client. See x25519_public_key.
+        Returns:
+            A tuple of the shared key and the public key that is sent to the client.
         """
-        cls.private_keys[client] = int.from_bytes(urandom(n_bits), sys.byteorder)
+        private_key = X25519PrivateKey.generate()
+        return cls.x25519_shared_key(private_key, received_key), cls.x25519_public_key(private_key)
 
     @staticmethod
-    def decrypt(message, client_key):
+    def derive_shared_key(key, info, salt=None):
+        """Derives a new shared key from a shared key with HKDF-SHA256.
+
+        Args:
+            key: The shared key.
+            info: The purpose of the derived key as bytes.
+            salt: Optional salt bytes.
+        Returns:
+            The derived key.
+        """
+        hkdf = HKDF(algorithm=hashes.SHA256(), length=32, salt=salt, info=info, backend=default_backend())
+        return int.from_bytes(hkdf.derive(key.to_bytes((key.bit_length() + 7) // 8, "big")), "big")
+
+    @classmethod
+    def resumption_secret(cls, key):
+        """Returns the secret of a session resumption ticket that is issued for a session.
+
+        Args:
+            key: The shared key of the session.
+        """
+        return cls.derive_shared_key(key, b"chat resumption")
+
+    @classmethod
+    def resumed_key(cls, secret, client_nonce, server_nonce):
+        """Returns the shared key of a session that is resumed with a ticket.
+
+        Args:
+            secret: The secret of the ticket.
+            client_nonce: The random bytes sent by the client.
+            server_nonce: The random bytes sent by the server.
+        """
+        return cls.derive_shared_key(secret, b"chat session key", client_nonce + server_nonce)
+
+    @classmethod
+    def key_exchanges(cls):
+        """Returns the supported key exchanges besides finite-field Diffie-Hellman.
+
+        Returns:
+            The names of the key exchanges separated by ",", an empty string if there are none.
+        """
+        return cls.x25519 if default_backend().x25519_supported() else ""
+
+    @classmethod
+    def supports_x25519(cls, offer):
+        """Checks whether X25519 can be used with a party that offered the given key exchanges.
+
+        Args:
+            offer: The key exchanges of the other party separated by ",".
+        Returns:
+            True if both parties support X25519, False otherwise.
+        """
+        return cls.x25519 in offer.split(",") and cls.x25519 in cls.key_exchanges().split(",")
+
+    @classmethod
+    def x25519_public_key(cls, private_key):
+        """Returns the X25519 public key that is sent to the other party.
+
+        Args:
+            private_key: An X25519PrivateKey.
+        Returns:
+            The public key as "x25519:" followed by the key in base64.
+        """
+        public_bytes = private_key.public_key().public_bytes(Encoding.Raw, PublicFormat.Raw)
+        return cls.x25519 + ":" + base64.urlsafe_b64encode(public_bytes).decode()
+
+    @classmethod
+    def x25519_shared_key(cls, private_key, received_key):
+        """Computes the shared key from a received X25519 public key.
+
+        The shared secret is returned as an integer so that it is used like a Diffie-Hellman shared key.
+
+        Args:
+            private_key: The own X25519PrivateKey.
+            received_key: The public key received from the other party. See x25519_public_key.
+        Returns:
+            The shared key.
+        """
+        public_key = X25519PublicKey.from_public_bytes(base64.urlsafe_b64decode(received_key[len(cls.x25519) + 1:]))
+        return int.from_bytes(private_key.exchange(public_key), "big")
+
+    @classmethod
+    def decrypt(cls, message, client_key):
         """Decrypts and returns the message with a given key.
 
+        Messages from older clients that do not use the derived key are decrypted with the legacy key.
+
         Args:
             message: The encrypted message.
             client_key: The key used for the decryption.
         Returns:
             The decrypted message.
         """
-        random.seed(client_key)
-        k = base64.urlsafe_b64encode(bytearray(random.getrandbits(8) for _ in range(32)))
-        f = Fernet(k)
-        return f.decrypt(message.encode("UTF-8")).decode()
+        token = message.encode("UTF-8")
+        try:
+            return cls.ciphers.get(client_key).decrypt(token).decode()
+        except InvalidToken:
+            return CipherCache.legacy_cipher(client_key).decrypt(token).decode()
 
     @staticmethod
     def hash_password(password, salt=None):
@@ -95,14 +304,865 @@ class Encryption:
         return binascii.hexlify(hashed_password), salt
 
 
+class Session:
+    """The state of one client, which is kept under the connection id until the client logs in and under the
+    username after that."""
+
+    __slots__ = ("websocket", "outbox", "key", "last_active")
+
+    def __init__(self, key=None):
+        """Constructor.
+
+        Args:
+            key: The shared key of the session.
+        """
+        self.websocket = None
+        self.outbox = None
+        self.key = key
+        self.last_active = time.monotonic()
+
+
+class SessionRegistry:
+    """Keeps the sessions of the clients by connection id or username.
+
+    A session whose user is connected holds the websocket and the outbox of the connection. The other sessions are
+    between the key exchange and the connection message, and are removed when they have been idle for
+    handshake_timeout seconds. When the registry is full, the least recently active of them is removed to make room.
+
+    The sessions of the clients that have not logged in are named with pending, so that a connection id sent by a
+    client can never name the session of a user.
+    """
+
+    def __init__(self, max_sessions=100000, handshake_timeout=600):
+        """Constructor.
+
+        Args:
+            max_sessions: The maximum number of sessions.
+            handshake_timeout: The time in seconds after which an idle session without a connection is removed.
+        """
+        self.max_sessions = max_sessions
+        self.handshake_timeout = handshake_timeout
+        # Ordered from the least recently active session
+        self.sessions = OrderedDict()
+        self.online = 0
+
+    def __len__(self):
+        return len(self.sessions)
+
+    @staticmethod
+    def pending(connection_id):
+        """Returns the name of the session of a client that has not logged in.
+
+        Args:
+            connection_id: The connection id of the client.
+        """
+        return "pending", connection_id
+
+    def get(self, name):
+        """Returns a session and marks it active.
+
+        Args:
+            name: The pending name of the connection id or the lowercased username.
+        Returns:
+            The session, None if there is no such session.
+        """
+        session = self.sessions.get(name)
+        if session is not None:
+            session.last_active = time.monotonic()
+            self.sessions.move_to_end(name)
+        return session
+
+    def add(self, name, session):
+        """Adds a session, removing the least recently active unconnected session if the registry is full.
+
+        Args:
+            name: The pending name of the connection id or the lowercased username.
+            session: The session.
+        Returns:
+            True if the session was added, False if the name is taken by a connected session or the registry is full
+            of connected sessions.
+        """
+        existing = self.sessions.get(name)
+        if existing is not None and existing.websocket is not None:
+            return False
+        self.remove(name)
+        if len(self.sessions) >= self.max_sessions:
+            for old_name, old_session in self.sessions.items():
+                if old_session.websocket is None:
+                    self.remove(old_name)
+                    break
+            else:
+                return False
+        session.last_active = time.monotonic()
+        self.sessions[name] = session
+        if session.websocket is not None:
+            self.online += 1
+        return True
+
+    def rename(self, name, new_name):
+        """Moves a session to a new name, for example from the pending name to the username.
+
+        Args:
+            name: The current name.
+            new_name: The new name.
+        Returns:
+            The session, None if there is no such session.
+        """
+        session = self.sessions.pop(name, None)
+        if session is None:
+            return None
+        existing = self.get(new_name)
+        if existing is not None:
+            # The user is already connected from another client, which keeps its connection
+            existing.key = session.key
+            return existing
+        self.add(new_name, session)
+        return session
+
+    def connect(self, name, websocket):
+        """Attaches the connection of a user to the user's session, creating the session if needed.
+
+        Args:
+            name: The lowercased username.
+            websocket: The connection.
+        Returns:
+            The session, None if the user was already connected or the registry is full.
+        """
+        session = self.get(name)
+        if session is None:
+            session = Session()
+            if not self.add(name, session):
+                return None
+        if session.websocket is not None:
+            return None
+        session.websocket = websocket
+        self.online += 1
+        return session
+
+    def connection(self, name):
+        """Returns the connection of a user.
+
+        Args:
+            name: The lowercased username.
+        Returns:
+            The websocket, None if the user is not connected to this process.
+        """
+        session = self.sessions.get(name)
+        return session.websocket if session is not None else None
+
+    def outbox(self, name):
+        """Returns the outbox of a user's connection.
+
+        Args:
+            name: The lowercased username.
+        Returns:
+            The Outbox, None if the user is not connected to this process.
+        """
+        session = self.sessions.get(name)
+        return session.outbox if session is not None else None
+
+    def remove(self, name, websocket=None):
+        """Removes a session.
+
+        Args:
+            name: The pending name of the connection id or the lowercased username.
+            websocket: If given, the session is only removed if this is its connection.
+        Returns:
+            The removed session, None if nothing was removed.
+        """
+        session = self.sessions.get(name)
+        if session is None or (websocket is not None and session.websocket is not websocket):
+            return None
+        del self.sessions[name]
+        if session.websocket is not None:
+            self.online -= 1
+        return session
+
+    def expired(self):
+        """Removes the idle sessions without a connection and finds the closed connections.
+
+        A connection is not closed for being idle, because a client may only receive messages. Connections whose
+        client has gone away without closing them are closed by the keepalive pings of the websockets.
+
+        Returns:
+            A list of (name, session) tuples of the connected sessions whose connection is closed.
+        """
+        now = time.monotonic()
+        for name in [name for name, session in self.sessions.items()
+                     if session.websocket is None and now - session.last_active > self.handshake_timeout]:
+            self.remove(name)
+        return [(name, session) for name, session in self.sessions.items()
+                if session.websocket is not None and not session.websocket.open]
+
+    def memory_usage(self):
+        """Estimates the memory that the sessions use.
+
+        Returns:
+            The size in bytes.
+        """
+        size = sys.getsizeof(self.sessions)
+        for name, session in self.sessions.items():
+            size += sys.getsizeof(name) + sys.getsizeof(session)
+            size += sys.getsizeof(session.key)
+        return size
+
+    def report(self, queues=10):
+        """Returns a summary of the sessions, their memory use and the connections with the deepest queues.
+
+        Args:
+            queues: The number of connections whose queue statistics are listed.
+        """
+        lines = ["%d sessions, %d connected, %.1f KiB" % (len(self.sessions), self.online,
+                                                          self.memory_usage() / 1024)]
+        outboxes = [(name, session.outbox.stats()) for name, session in self.sessions.items()
+                    if session.outbox is not None]
+        outboxes.sort(key=lambda item: (item[1]["depth"], item[1]["max_depth"]), reverse=True)
+        for name, stats in outboxes[:queues]:
+            lines.append("  %s: depth %d, max %d, sent %d, dropped %d, spilled %d" % (
+                name, stats["depth"], stats["max_depth"], stats["sent"], stats["dropped"], stats["spilled"]))
+        return "\n".join(lines)
+
+
+class TicketCache:
+    """Keeps the session resumption tickets in a bounded cache. A ticket expires after a fixed lifetime and can
+    be redeemed once."""
+
+    def __init__(self, size=100000, lifetime=86400):
+        """Constructor.
+
+        Args:
+            size: The maximum number of tickets.
+            lifetime: The time in seconds after which a ticket expires.
+        """
+        self.size = size
+        self.lifetime = lifetime
+        self.tickets = OrderedDict()
+
+    def issue(self, key):
+        """Issues a ticket for a session.
+
+        Args:
+            key: The shared key of the session.
+        Returns:
+            The ticket id.
+        """
+        now = time.monotonic()
+        # The tickets are ordered by expiry, so the expired and the oldest tickets are removed from the front
+        while self.tickets and (len(self.tickets) >= self.size or next(iter(self.tickets.values()))[1] < now):
+            self.tickets.popitem(last=False)
+        ticket = base64.urlsafe_b64encode(urandom(18)).decode()
+        self.tickets[ticket] = (Encryption.resumption_secret(key), now + self.lifetime)
+        return ticket
+
+    def redeem(self, ticket):
+        """Removes a ticket and returns its secret.
+
+        Args:
+            ticket: The ticket id.
+        Returns:
+            The secret of the ticket, None if the ticket is unknown or has expired.
+        """
+        secret, expiry = self.tickets.pop(ticket, (None, 0))
+        if expiry < time.monotonic():
+            return None
+        return secret
+
+
+class RateLimiter:
+    """Token buckets keyed by a peer address or a username.
+
+    Each key may spend burst tokens at once, and its bucket is refilled at rate tokens per second. The buckets of
+    the least recently seen keys are forgotten when there are too many of them.
+    """
+
+    def __init__(self, rate, burst, size=100000):
+        """Constructor.
+
+        Args:
+            rate: The number of tokens added to a bucket per second.
+            burst: The size of a bucket.
+            size: The maximum number of buckets.
+        """
+        self.rate = rate
+        self.burst = burst
+        self.size = size
+        # Ordered from the least recently seen key
+        self.buckets = OrderedDict()
+
+    def allow(self, key):
+        """Takes a token from the bucket of the key.
+
+        Args:
+            key: The peer address or the lowercased username.
+        Returns:
+            True if there was a token, False if the key is over its limit.
+        """
+        now = time.monotonic()
+        tokens, last = self.buckets.pop(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        self.buckets[key] = (tokens, now)
+        if len(self.buckets) > self.size:
+            self.buckets.popitem(last=False)
+        return allowed
+
+
+class PasswordHasher:
+    """Hashes passwords and performs finite-field Diffie-Hellman key exchanges in a process pool, so that the event
+    loop is not blocked by PBKDF2 or modular exponentiation.
+
+    The number of these operations that are queued or running is capped, and the operations over the cap are
+    rejected at once instead of waiting.
+    """
+
+    def __init__(self, workers=None, max_pending=256, observe=None):
+        """Constructor.
+
+        Args:
+            workers: The number of hashing processes. If None, the number of CPUs is used.
+            max_pending: The maximum number of operations that can be queued or running at the same time.
+            observe: A function that is called with the name and the duration in seconds of each operation,
+                including the time it waited for a process.
+        """
+        self.pool = ProcessPoolExecutor(workers)
+        self.max_pending = max_pending
+        self.pending = 0
+        self.observe = observe
+
+    async def hash_password(self, password, salt=None):
+        """Hashes the password in the process pool.
+
+        Args:
+            password: The password that will be hashed.
+            salt: The salt used to hash the password. If None, a random salt is generated.
+        Returns:
+            A tuple of the hashed password and the used salt.
+        Raises:
+            HasherBusy: If too many operations are pending.
+        """
+        return await self.run(Encryption.hash_password, password, salt)
+
+    async def key_exchange(self, received_key):
+        """Performs the server side of a finite-field Diffie-Hellman key exchange in the process pool.
+
+        Args:
+            received_key: The public key received from the client.
+        Returns:
+            A tuple of the shared key and the public key that is sent to the client.
+        Raises:
+            HasherBusy: If too many operations are pending.
+        """
+        return await self.run(Encryption.diffie_hellman_exchange, received_key)
+
+    async def run(self, function, *args):
+        """Runs a function in the process pool unless too many operations are pending.
+
+        Args:
+            function: The function.
+            args: The arguments of the function.
+        Returns:
+            The return value of the function.
+        Raises:
+            HasherBusy: If too many operations are pending.
+        """
+        if self.pending >= self.max_pending:
+            raise HasherBusy()
+        self.pending += 1
+        try:
+            return await timed(asyncio.get_event_loop().run_in_executor(self.pool, function, *args), self.observe,
+                               function.__name__)
+        finally:
+            self.pending -= 1
+
+    async def verify_password(self, password, hashed_password, salt):
+        """Checks whether the password matches the stored hash.
+
+        Args:
+            password: The unhashed password.
+            hashed_password: The stored hash of the password.
+            salt: The salt used for the stored hash.
+        Returns:
+            True if the password is correct, False otherwise.
+        Raises:
+            HasherBusy: If too many operations are pending.
+        """
+        new_hashed_password, _ = await self.hash_password(password, salt)
+        return hmac.compare_digest(new_hashed_password, hashed_password)
+
+
+class TextProtocol:
+    """The original protocol, where the fields of a message are separated by ";"."""
+
+    name = None
+
+    @staticmethod
+    def parse(message):
+        """Parses the received message into 4 parts that are separated by ";".
+
+        Args:
+            message: The message to be parsed.
+        Returns:
+            A tuple of the message type, the receiver, the sender and the message.
+        """
+        split_message = message.split(";", 3)
+        return split_message[0], split_message[1], split_message[2], split_message[3]
+
+    @staticmethod
+    def ciphertext(payload):
+        """Returns the encrypted payload as a Fernet token string.
+
+        Args:
+            payload: The encrypted payload as a token string or as raw bytes.
+        """
+        if isinstance(payload, bytes):
+            return base64.urlsafe_b64encode(payload).decode()
+        return payload
+
+    @staticmethod
+    def reply(value):
+        """Returns the frame of a reply to a request.
+
+        Args:
+            value: The reply as a string.
+        """
+        return value
+
+    @staticmethod
+    def friend_list(friends):
+        """Returns the frame of a friend list.
+
+        Args:
+            friends: A dict with the usernames as keys and values 1 denoting online and 0 denoting offline.
+        """
+        return pickle.dumps(friends)
+
+    @classmethod
+    def encode_event(cls, event):
+        """Returns the frame of an event that is sent to a user.
+
+        Args:
+            event: ("c", user, online), ("a", user, info), ("d", user, key) or ("m", sender, chat, ciphertext).
+        """
+        if event[0] == "m":
+            return event[1] + ">" + event[2] + ";" + cls.ciphertext(event[3])
+        return event[0] + "+" + event[1] + ";" + str(event[2])
+
+    @classmethod
+    def encode_events(cls, events):
+        """Returns the frames of several events that are sent to one user at once. Each event is its own frame.
+
+        Args:
+            events: A list of events. See encode_event.
+        Returns:
+            A list of frames.
+        """
+        return [cls.encode_event(event) for event in events]
+
+
+class BinaryProtocol:
+    """A binary protocol where a frame is a type byte followed by fields that are prefixed with their length.
+
+    The encrypted payloads are sent as raw bytes. The protocol is negotiated as a websocket subprotocol.
+    """
+
+    name = "chat.v2"
+
+    # The message types whose payload is encrypted
+    encrypted = ("l", "r", "m")
+
+    # The maximum size of a batch frame in bytes, well below the default message size limit of the clients
+    max_batch_size = 2 ** 19
+
+    @staticmethod
+    def encode(frame_type, *fields):
+        """Encodes a frame.
+
+        Args:
+            frame_type: A one character string.
+            fields: The fields as strings or bytes.
+        Returns:
+            The frame as bytes.
+        """
+        parts = [frame_type.encode()]
+        for field in fields:
+            if isinstance(field, str):
+                field = field.encode()
+            parts.append(struct.pack(">I", len(field)))
+            parts.append(field)
+        return b"".join(parts)
+
+    @staticmethod
+    def decode(frame):
+        """Decodes a frame.
+
+        Args:
+            frame: The frame as bytes.
+        Returns:
+            A tuple of the frame type and a list of the fields as bytes.
+        Raises:
+            ValueError: If the frame is malformed.
+        """
+        if not isinstance(frame, bytes) or not frame:
+            raise ValueError("Not a binary frame")
+        fields = []
+        offset = 1
+        while offset < len(frame):
+            if offset + 4 > len(frame):
+                raise ValueError("Truncated frame")
+            length, = struct.unpack_from(">I", frame, offset)
+            offset += 4
+            if offset + length > len(frame):
+                raise ValueError("Truncated frame")
+            fields.append(frame[offset:offset + length])
+            offset += length
+        return chr(frame[0]), fields
+
+    @classmethod
+    def parse(cls, message):
+        """Parses a frame that a client sent.
+
+        Args:
+            message: The frame.
+        Returns:
+            A tuple of the message type, the receiver, the sender and the message. The message is bytes for the
+            encrypted message types and a string otherwise.
+        """
+        msg_type, (receiver, sender, payload) = cls.decode(message)
+        if msg_type not in cls.encrypted:
+            payload = payload.decode()
+        return msg_type, receiver.decode(), sender.decode(), payload
+
+    @staticmethod
+    def ciphertext(payload):
+        """Returns the encrypted payload as raw bytes.
+
+        Args:
+            payload: The encrypted payload as a token string or as raw bytes.
+        """
+        if isinstance(payload, str):
+            return base64.urlsafe_b64decode(payload)
+        return payload
+
+    @classmethod
+    def reply(cls, value):
+        """See TextProtocol.reply."""
+        return cls.encode("R", value)
+
+    @classmethod
+    def friend_list(cls, friends):
+        """See TextProtocol.friend_list."""
+        fields = []
+        for friend, online in friends.items():
+            fields += [friend, str(online)]
+        return cls.encode("F", *fields)
+
+    @classmethod
+    def encode_event(cls, event):
+        """See TextProtocol.encode_event."""
+        if event[0] == "m":
+            return cls.encode("m", event[1], event[2], cls.ciphertext(event[3]))
+        return cls.encode(event[0], event[1], str(event[2]))
+
+    @classmethod
+    def batch(cls, frames):
+        """Returns a batch frame whose fields are the given frames.
+
+        Args:
+            frames: A list of frames.
+        """
+        return cls.encode("b", *frames)
+
+    @classmethod
+    def encode_events(cls, events):
+        """See TextProtocol.encode_events. The events are packed into as few batch frames as possible."""
+        frames = []
+        batch = []
+        size = 0
+        for event in events:
+            frame = cls.encode_event(event)
+            if batch and size + len(frame) + 4 > cls.max_batch_size:
+                frames.append(cls.batch(batch))
+                batch = []
+                size = 0
+            batch.append(frame)
+            size += len(frame) + 4
+        if batch:
+            frames.append(cls.batch(batch))
+        return frames
+
+
+# The protocols by the negotiated subprotocol
+PROTOCOLS = {TextProtocol.name: TextProtocol, BinaryProtocol.name: BinaryProtocol}
+
+
+class Outbox:
+    """A bounded queue of the events sent to one connection, drained by a writer task of its own.
+
+    A receiver with a slow network only fills its own queue, so the handlers of the users who send to it are not
+    blocked. When the queue is full, the oldest queued presence update is dropped to make room, because a later
+    update of the same user supersedes it. If there is none, the overflow policy decides what happens:
+
+    - "drop": the new event is dropped.
+    - "spill": a chat message is stored for delivery on the next connection and other events are dropped.
+    - "disconnect": the connection is closed and the queued chat messages are stored.
+    """
+
+    policies = ("drop", "spill", "disconnect")
+
+    def __init__(self, websocket, spill, max_size=1024, policy="spill", max_batch=128, paused=False):
+        """Constructor.
+
+        Args:
+            websocket: The connection.
+            spill: A coroutine function that stores a chat message event for the next connection.
+            max_size: The maximum number of queued events.
+            policy: The overflow policy. See the class documentation.
+            max_batch: The maximum number of events sent at once.
+            paused: If True, the events are queued but not sent until start is called.
+        """
+        if policy not in self.policies:
+            raise ValueError("Unknown overflow policy " + policy)
+        self.websocket = websocket
+        self.protocol = PROTOCOLS[websocket.subprotocol]
+        self.spill = spill
+        self.max_size = max_size
+        self.policy = policy
+        self.max_batch = max_batch
+        self.events = deque()
+        self.ready = asyncio.Event()
+        self.closed = False
+        self.sent = 0
+        self.dropped = 0
+        self.spilled = 0
+        self.max_depth = 0
+        self.writer = None
+        if not paused:
+            self.start()
+
+    def start(self):
+        """Starts the writer, which sends the queued events and the events queued later."""
+        if self.writer is None:
+            self.writer = asyncio.ensure_future(self.write())
+
+    def put(self, event):
+        """Queues an event that is sent to the connection.
+
+        Args:
+            event: The event. See TextProtocol.encode_event.
+        """
+        if self.closed:
+            self.discard(event)
+            return
+        if len(self.events) >= self.max_size and not self.drop_presence():
+            if self.policy == "disconnect":
+                self.close()
+                # 1013: try again later
+                asyncio.ensure_future(self.websocket.close(1013))
+            self.discard(event)
+            return
+        self.events.append(event)
+        self.max_depth = max(self.max_depth, len(self.events))
+        self.ready.set()
+
+    def drop_presence(self):
+        """Drops the oldest queued presence update.
+
+        Returns:
+            True if an update was dropped, False if there are none in the queue.
+        """
+        for i, event in enumerate(self.events):
+            if event[0] == "c":
+                del self.events[i]
+                self.dropped += 1
+                return True
+        return False
+
+    def discard(self, event):
+        """Stores an event that cannot be sent if it is a chat message from another user and drops it otherwise.
+
+        The copies of the user's own messages cannot be stored, because stored messages are delivered as messages
+        from their sender.
+
+        Args:
+            event: The event.
+        """
+        if self.policy != "drop" and event[0] == "m" and event[1] == event[2]:
+            self.spilled += 1
+            asyncio.ensure_future(self.spill(event))
+        else:
+            self.dropped += 1
+
+    def close(self):
+        """Stops the writer and stores the queued chat messages."""
+        if self.closed:
+            return
+        self.closed = True
+        self.ready.set()
+        while self.events:
+            self.discard(self.events.popleft())
+
+    async def write(self):
+        """Sends the queued events until the outbox is closed. Frames to binary protocol connections are sent as
+        batch frames."""
+        batch = []
+        try:
+            while not self.closed:
+                await self.ready.wait()
+                self.ready.clear()
+                while self.events and not self.closed:
+                    batch = [self.events.popleft() for _ in range(min(len(self.events), self.max_batch))]
+                    for frame in self.protocol.encode_events(batch):
+                        await self.websocket.send(frame)
+                    self.sent += len(batch)
+                    batch = []
+        except websockets.ConnectionClosed:
+            # The events whose sending was interrupted may be delivered twice, like interrupted offline pages
+            for event in batch:
+                self.discard(event)
+            self.close()
+
+    def stats(self):
+        """Returns the queue statistics of the connection.
+
+        Returns:
+            A dict with the current and the maximum queue depth and the numbers of sent, dropped and stored events.
+        """
+        return {"depth": len(self.events), "max_depth": self.max_depth, "sent": self.sent, "dropped": self.dropped,
+                "spilled": self.spilled}
+
+
+class SmallMessageBypass:
+    """Wraps a permessage-deflate extension so that messages below a size threshold are sent uncompressed.
+
+    Compressing a short message costs more time than it saves bandwidth. The receiver handles uncompressed
+    messages because the extension only compresses messages that have the RSV1 bit set.
+    """
+
+    def __init__(self, extension, min_size):
+        """Constructor.
+
+        Args:
+            extension: The negotiated permessage-deflate extension.
+            min_size: The size in bytes below which messages are not compressed.
+        """
+        self.extension = extension
+        self.min_size = min_size
+
+    @property
+    def name(self):
+        """The name of the extension."""
+        return self.extension.name
+
+    def decode(self, frame, *, max_size=None):
+        """Decodes an incoming frame."""
+        return self.extension.decode(frame, max_size=max_size)
+
+    def encode(self, frame):
+        """Encodes an outgoing frame, leaving small unfragmented data frames uncompressed."""
+        if frame.fin and frame.opcode in DATA_OPCODES and len(frame.data) < self.min_size:
+            return frame
+        return self.extension.encode(frame)
+
+
+class Compression(ServerPerMessageDeflateFactory):
+    """Negotiates permessage-deflate with tunable settings for the server."""
+
+    def __init__(self, min_size=512, max_window_bits=None, level=6, mem_level=8):
+        """Constructor.
+
+        Args:
+            min_size: The size in bytes below which messages are not compressed.
+            max_window_bits: The base two logarithm of the compression window of the server. Smaller windows use
+                less memory per connection. If None, the maximum of 15 is used.
+            level: The zlib compression level.
+            mem_level: The zlib memory level.
+        """
+        ServerPerMessageDeflateFactory.__init__(self, server_max_window_bits=max_window_bits,
+                                                compress_settings={"level": level, "memLevel": mem_level})
+        self.min_size = min_size
+
+    def process_request_params(self, params, accepted_extensions):
+        """Negotiates the extension and wraps it so that small messages are not compressed."""
+        response_params, extension = ServerPerMessageDeflateFactory.process_request_params(
+            self, params, accepted_extensions)
+        return response_params, SmallMessageBypass(extension, self.min_size)
+
+
+class PresenceNotifier:
+    """Sends presence changes to the online friends of a user.
+
+    The changes of one user within a short window are merged, so that the friends receive only the final state,
+    and the frames to the friends are sent concurrently.
+    """
+
+    def __init__(self, deliver, online_friends, window=0.5):
+        """Constructor.
+
+        Args:
+            deliver: A coroutine function that sends an event to the given user.
+            online_friends: A function that returns the online friends of the given user.
+            window: The time in seconds during which the changes of one user are merged.
+        """
+        self.deliver = deliver
+        self.online_friends = online_friends
+        self.window = window
+        self.pending = {}
+
+    def notify(self, user, online):
+        """Schedules a presence change to be sent to the friends of the user.
+
+        Args:
+            user: The username.
+            online: 1 if the user connected, 0 if the user disconnected.
+        """
+        user = user.lower()
+        if user not in self.pending:
+            asyncio.get_event_loop().call_later(self.window, self.flush, user)
+        self.pending[user] = online
+
+    def flush(self, user):
+        """Sends the latest presence state of the user to the friends that are online.
+
+        Args:
+            user: The username.
+        """
+        event = ("c", user, self.pending.pop(user))
+        friends = self.online_friends(user)
+        if friends:
+            asyncio.ensure_future(asyncio.gather(*(self.deliver(friend, event) for friend in friends),
+                                                 return_exceptions=True))
+
+
 class Database:
     """Contains database operations that the server needs."""
 
-    def __init__(self):
-        """Constructor."""
-        self.user_db = sqlite3.connect("user_info.db")
+    def __init__(self, path="user_info.db", autocommit=True):
+        """Constructor.
+
+        Args:
+            path: The location of the database file.
+            autocommit: If False, writes are not committed until the connection's commit() is called.
+        """
+        self.autocommit = autocommit
+        self.user_db = sqlite3.connect(path, cached_statements=64)
+        self.user_db.execute("PRAGMA journal_mode=WAL")
+        self.user_db.execute("PRAGMA synchronous=NORMAL")
         self.user_db.execute("CREATE TABLE IF NOT EXISTS user_info (username TEXT PRIMARY KEY,password BLOB,salt BLOB)")
         self.user_db.execute("CREATE TABLE IF NOT EXISTS friends (user1 TEXT, user2 TEXT, PRIMARY KEY (user1, user2))")
+        self.user_db.execute("CREATE INDEX IF NOT EXISTS friends_user2 ON friends (user2)")
+        self.user_db.commit()
+
+    @property
+    def connection(self):
+        """The sqlite3 connection of the database."""
+        return self.user_db
+
+    def commit(self):
+        """Commits the pending writes unless autocommit is disabled."""
+        if self.autocommit:
+            self.user_db.commit()
 
     def add_user(self, username, password):
         """Adds a user to the database.
@@ -111,12 +1171,20 @@ class Database:
             username: The name of the added user.
             password: The unhashed password of the user.
         """
-        username = username.lower()
         hashed_password, salt = Encryption.hash_password(password)
+        self.add_hashed_user(username, hashed_password, salt)
 
-        c = self.user_db.cursor()
-        c.execute("INSERT INTO user_info VALUES (?, ?, ?)", (username, hashed_password, salt))
-        self.user_db.commit()
+    def add_hashed_user(self, username, hashed_password, salt):
+        """Adds a user whose password has already been hashed to the database.
+
+        Args:
+            username: The name of the added user.
+            hashed_password: The hashed password of the user.
+            salt: The salt used to hash the password.
+        """
+        username = username.lower()
+        self.user_db.execute("INSERT INTO user_info VALUES (?, ?, ?)", (username, hashed_password, salt))
+        self.commit()
 
     def find_user(self, username):
         """Checks if the user is in the database.
@@ -127,13 +1195,22 @@ class Database:
             None if the username is not in the database, row id if the user is found.
         """
         username = username.lower()
-        c = self.user_db.cursor()
-        c.execute("SELECT rowid FROM user_info WHERE username=?", (username,))
-        ret = c.fetchone()
+        ret = self.user_db.execute("SELECT rowid FROM user_info WHERE username=?", (username,)).fetchone()
         if not ret:
             return None
         return ret[0]
 
+    def find_credentials(self, username):
+        """Finds the stored password hash and salt of the user.
+
+        Args:
+            username: The name of the searched user.
+        Returns:
+            A tuple of the hashed password and the salt, None if the user is not found.
+        """
+        username = username.lower()
+        return self.user_db.execute("SELECT password, salt FROM user_info WHERE username=?", (username,)).fetchone()
+
     def verify_user(self, username, password):
         """Verifies that the given username and password are in the database.
 
@@ -143,15 +1220,10 @@ class Database:
         Returns:
             True if the username and password are correct, False otherwise.
         """
-        username = username.lower()
-        c = self.user_db.cursor()
-        c.execute("SELECT password, salt FROM user_info WHERE username=?", (username,))
         try:
-            found_hashed_password, salt = c.fetchone()
+            found_hashed_password, salt = self.find_credentials(username)
             hashed_password, _ = Encryption.hash_password(password, salt)
-            if found_hashed_password == hashed_password:
-                return True
-            return False
+            return hmac.compare_digest(found_hashed_password, hashed_password)
         except TypeError:
             return False
 
@@ -163,10 +1235,9 @@ class Database:
             user_2: The username of the second user.
         """
         user_1, user_2 = user_1.lower(), user_2.lower()
-        c = self.user_db.cursor()
         if not self.are_friends(user_1, user_2):
-            c.execute("INSERT INTO friends VALUES (?, ?)", (user_1, user_2))
-            self.user_db.commit()
+            self.user_db.execute("INSERT INTO friends VALUES (?, ?)", (user_1, user_2))
+            self.commit()
 
     def are_friends(self, user_1, user_2):
         """Checks whether the two users are friends.
@@ -178,10 +1249,10 @@ class Database:
             True if the users are friends, False if they are not.
         """
         user_1, user_2 = user_1.lower(), user_2.lower()
-        c = self.user_db.cursor()
-        c.execute("SELECT rowid FROM friends WHERE (user1=? AND user2=?) OR (user1=? AND user2=?)",
-                  (user_1, user_2, user_2, user_1))
-        if c.fetchone():
+        # Two separate lookups so that both directions can use the primary key
+        if self.user_db.execute("SELECT 1 FROM friends WHERE user1=? AND user2=? "
+                                "UNION ALL SELECT 1 FROM friends WHERE user1=? AND user2=? LIMIT 1",
+                                (user_1, user_2, user_2, user_1)).fetchone():
             return True
         return False
 
@@ -194,14 +1265,377 @@ class Database:
             A list containing all of the friends of the user.
         """
         user = user.lower()
-        friends = []
-        c = self.user_db.cursor()
-        c.execute("SELECT user1 FROM friends WHERE user2=?", (user,))
-        res = c.fetchall()
-        if res:
-            friends += [friend[0] for friend in res]
-        c.execute("SELECT user2 FROM friends WHERE user1=?", (user,))
-        res = c.fetchall()
-        if res:
-            friends += [friend[0] for friend in res]
-        return friends
+        return [friend[0] for friend in self.user_db.execute(
+            "SELECT user1 FROM friends WHERE user2=? UNION ALL SELECT user2 FROM friends WHERE user1=?", (user, user))]
+
+    def all_friends(self):
+        """Returns an iterator over every friendship in the database.
+
+        Returns:
+            An iterator of (user_1, user_2) tuples.
+        """
+        return self.user_db.execute("SELECT user1, user2 FROM friends")
+
+
+class OfflineDatabase:
+    """Stores the chat messages sent to offline users until they are delivered.
+
+    Messages are only appended and, once delivered, removed as a range, so each user's queue is read with
+    cursor-based paging over the (receiver, id) index.
+    """
+
+    def __init__(self, path="offline_messages.db", autocommit=True):
+        """Constructor.
+
+        Args:
+            path: The location of the database file.
+            autocommit: If False, writes are not committed until the connection's commit() is called.
+        """
+        self.autocommit = autocommit
+        self.offline_db = sqlite3.connect(path, cached_statements=64)
+        self.offline_db.execute("PRAGMA journal_mode=WAL")
+        self.offline_db.execute("PRAGMA synchronous=NORMAL")
+        self.offline_db.execute("CREATE TABLE IF NOT EXISTS messages "
+                                "(id INTEGER PRIMARY KEY AUTOINCREMENT, receiver TEXT, sender TEXT, message BLOB)")
+        self.offline_db.execute("CREATE INDEX IF NOT EXISTS messages_receiver ON messages (receiver, id)")
+        self.offline_db.commit()
+        # The number of queued messages by lowercased receiver, read from the database on first use
+        self.queued = {}
+
+    @property
+    def connection(self):
+        """The sqlite3 connection of the database."""
+        return self.offline_db
+
+    def commit(self):
+        """Commits the pending writes unless autocommit is disabled."""
+        if self.autocommit:
+            self.offline_db.commit()
+
+    def add_message(self, receiver, sender, message, limit=None):
+        """Appends a message to the queue of the receiver unless the queue is full.
+
+        The counts of the queues are cached. A count is read again before a message is refused, because other
+        server processes may have delivered the messages, so with several processes a queue can exceed the limit
+        by the messages that the other processes added.
+
+        Args:
+            receiver: The username of the receiver.
+            sender: The username of the sender.
+            message: The encrypted message as raw bytes.
+            limit: The maximum number of queued messages of one receiver, None for no limit.
+        Returns:
+            True if the message was queued, False if the queue of the receiver is full.
+        """
+        receiver = receiver.lower()
+        if limit is not None:
+            count = self.queued.get(receiver)
+            if count is None or count >= limit:
+                count = self.count_messages(receiver)
+            if count >= limit:
+                self.queued[receiver] = count
+                return False
+            self.queued[receiver] = count + 1
+        self.offline_db.execute("INSERT INTO messages (receiver, sender, message) VALUES (?, ?, ?)",
+                                (receiver, sender, message))
+        self.commit()
+        return True
+
+    def count_messages(self, receiver):
+        """Returns the number of queued messages of the receiver.
+
+        Args:
+            receiver: The username of the receiver.
+        """
+        return self.offline_db.execute("SELECT COUNT(*) FROM messages WHERE receiver=?",
+                                       (receiver.lower(),)).fetchone()[0]
+
+    def find_messages(self, receiver, after=0, limit=256):
+        """Finds one page of the queued messages of the receiver.
+
+        Args:
+            receiver: The username of the receiver.
+            after: The id of the last message of the previous page, 0 for the first page.
+            limit: The maximum number of messages in the page.
+        Returns:
+            A list of (id, sender, message) tuples in the order the messages were sent.
+        """
+        return self.offline_db.execute("SELECT id, sender, message FROM messages WHERE receiver=? AND id>? "
+                                       "ORDER BY id LIMIT ?", (receiver.lower(), after, limit)).fetchall()
+
+    def remove_messages(self, receiver, last):
+        """Removes the delivered messages of the receiver.
+
+        Args:
+            receiver: The username of the receiver.
+            last: The id of the last delivered message.
+        """
+        self.offline_db.execute("DELETE FROM messages WHERE receiver=? AND id<=?", (receiver.lower(), last))
+        self.commit()
+        self.queued.pop(receiver.lower(), None)
+
+
+class FriendGraph:
+    """Keeps the friendships in memory as adjacency sets keyed by lowercased usernames."""
+
+    def __init__(self, friendships=()):
+        """Constructor.
+
+        Args:
+            friendships: An iterable of (user_1, user_2) tuples that are added to the graph.
+        """
+        self.friends = {}
+        for user_1, user_2 in friendships:
+            self.add(user_1, user_2)
+
+    def add(self, user_1, user_2):
+        """Adds a friendship to the graph.
+
+        Args:
+            user_1: The username of the first user.
+            user_2: The username of the second user.
+        """
+        user_1, user_2 = sys.intern(user_1.lower()), sys.intern(user_2.lower())
+        self.friends.setdefault(user_1, set()).add(user_2)
+        self.friends.setdefault(user_2, set()).add(user_1)
+
+    def are_friends(self, user_1, user_2):
+        """Checks whether the two users are friends.
+
+        Args:
+            user_1: The username of the first user.
+            user_2: The username of the second user.
+        Returns:
+            True if the users are friends, False if they are not.
+        """
+        return user_2.lower() in self.friends.get(user_1.lower(), ())
+
+    def find_friends(self, user):
+        """Finds all friends of the given user.
+
+        Args:
+            user: The name of the given user.
+        Returns:
+            A set containing all of the friends of the user. The set must not be modified.
+        """
+        return self.friends.get(user.lower(), frozenset())
+
+
+class DatabaseWriter(threading.Thread):
+    """A thread that owns the only writing connection and commits queued writes in batches."""
+
+    def __init__(self, path, max_batch=64, database=Database):
+        """Constructor.
+
+        Args:
+            path: The location of the database file.
+            max_batch: The maximum number of writes committed together.
+            database: The database class whose methods are called.
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.path = path
+        self.max_batch = max_batch
+        self.database = database
+        self.writes = queue.Queue()
+
+    def submit(self, method, *args):
+        """Queues a call to a method of the database class.
+
+        Args:
+            method: The name of the method.
+            args: The arguments of the method.
+        Returns:
+            A concurrent.futures.Future that is resolved after the write has been committed.
+        """
+        future = Future()
+        self.writes.put((future, method, args))
+        return future
+
+    def stop(self):
+        """Stops the thread after the queued writes have been committed."""
+        self.writes.put(None)
+        self.join()
+
+    def run(self):
+        """Executes the queued writes and commits each batch with a single transaction."""
+        db = self.database(self.path, autocommit=False)
+        while True:
+            batch = [self.writes.get()]
+            while batch[-1] is not None and len(batch) < self.max_batch:
+                try:
+                    batch.append(self.writes.get_nowait())
+                except queue.Empty:
+                    break
+            results = []
+            for write in batch:
+                if write is None:
+                    continue
+                future, method, args = write
+                try:
+                    results.append((future, getattr(db, method)(*args), None))
+                except Exception as e:
+                    results.append((future, None, e))
+            try:
+                db.connection.commit()
+            except sqlite3.Error as e:
+                db.connection.rollback()
+                results = [(future, None, e) for future, _, _ in results]
+            for future, result, error in results:
+                if error is None:
+                    future.set_result(result)
+                else:
+                    future.set_exception(error)
+            if batch[-1] is None:
+                db.connection.close()
+                return
+
+
+class AsyncDatabase:
+    """Runs the Database operations outside the event loop.
+
+    Reads run in a small thread pool where each thread has its own connection and writes go through a
+    single DatabaseWriter. The friendships are loaded into a FriendGraph at startup and written through to the
+    database, so friendship lookups never touch the disk.
+    """
+
+    def __init__(self, path="user_info.db", readers=4, observe=None):
+        """Constructor.
+
+        Args:
+            path: The location of the database file.
+            readers: The number of threads used for reading.
+            observe: A function that is called with the method name and the duration in seconds of each query,
+                including the time it was queued.
+        """
+        self.path = path
+        self.observe = observe
+        self.writer = DatabaseWriter(path)
+        self.writer.start()
+        self.readers = ThreadPoolExecutor(readers)
+        self.local = threading.local()
+
+        db = Database(path)
+        self.graph = FriendGraph(db.all_friends())
+        db.user_db.close()
+
+    def close(self):
+        """Commits the queued writes and stops the threads."""
+        self.writer.stop()
+        self.readers.shutdown()
+
+    def reader(self):
+        """Returns the reading connection of the current thread, opening it on first use."""
+        if not hasattr(self.local, "db"):
+            self.local.db = Database(self.path)
+        return self.local.db
+
+    async def read(self, method, *args):
+        """Runs a Database method in the reader pool.
+
+        Args:
+            method: The name of the Database method.
+            args: The arguments of the method.
+        Returns:
+            The return value of the method.
+        """
+        return await timed(asyncio.get_event_loop().run_in_executor(
+            self.readers, lambda: getattr(self.reader(), method)(*args)), self.observe, method)
+
+    async def write(self, method, *args):
+        """Runs a Database method in the writer thread.
+
+        Args:
+            method: The name of the Database method.
+            args: The arguments of the method.
+        Returns:
+            The return value of the method once the write has been committed.
+        """
+        return await timed(asyncio.wrap_future(self.writer.submit(method, *args)), self.observe, method)
+
+    async def add_hashed_user(self, username, hashed_password, salt):
+        """See Database.add_hashed_user."""
+        return await self.write("add_hashed_user", username, hashed_password, salt)
+
+    async def find_user(self, username):
+        """See Database.find_user."""
+        return await self.read("find_user", username)
+
+    async def find_credentials(self, username):
+        """See Database.find_credentials."""
+        return await self.read("find_credentials", username)
+
+    async def add_friends(self, user_1, user_2):
+        """See Database.add_friends. The friend graph is updated after the write has been committed."""
+        await self.write("add_friends", user_1, user_2)
+        self.graph.add(user_1, user_2)
+
+    def are_friends(self, user_1, user_2):
+        """See FriendGraph.are_friends."""
+        return self.graph.are_friends(user_1, user_2)
+
+    def find_friends(self, user):
+        """See FriendGraph.find_friends."""
+        return self.graph.find_friends(user)
+
+
+class OfflineStore:
+    """Queues the chat messages of offline users on disk and pages them out when the users connect.
+
+    All operations go through one DatabaseWriter, so a page read always sees the messages queued before it.
+    """
+
+    def __init__(self, path="offline_messages.db", page_size=256, observe=None, max_messages=None):
+        """Constructor.
+
+        Args:
+            path: The location of the database file.
+            page_size: The maximum number of messages read at once.
+            observe: A function that is called with the method name and the duration in seconds of each query,
+                including the time it was queued.
+            max_messages: The maximum number of queued messages of one receiver, None for no limit.
+        """
+        self.page_size = page_size
+        self.max_messages = max_messages
+        self.observe = observe
+        self.writer = DatabaseWriter(path, database=OfflineDatabase)
+        self.writer.start()
+
+    def close(self):
+        """Commits the queued writes and stops the writer thread."""
+        self.writer.stop()
+
+    async def call(self, method, *args):
+        """Runs an OfflineDatabase method in the writer thread.
+
+        Args:
+            method: The name of the OfflineDatabase method.
+            args: The arguments of the method.
+        Returns:
+            The return value of the method once it has been committed.
+        """
+        return await timed(asyncio.wrap_future(self.writer.submit(method, *args)), self.observe, method)
+
+    async def add_message(self, receiver, sender, message):
+        """See OfflineDatabase.add_message. The limit is max_messages."""
+        return await self.call("add_message", receiver, sender, message, self.max_messages)
+
+    async def pages(self, receiver):
+        """Yields the queued messages of the receiver one page at a time.
+
+        A page is removed from the queue when the next page is requested, so messages whose delivery is
+        interrupted are delivered again on the next connection.
+
+        Args:
+            receiver: The username of the receiver.
+        Returns:
+            An asynchronous generator of lists of (sender, message) tuples.
+        """
+        cursor = 0
+        while True:
+            rows = await self.call("find_messages", receiver, cursor, self.page_size)
+            if not rows:
+                return
+            yield [(sender, message) for _, sender, message in rows]
+            cursor = rows[-1][0]
+            await self.call("remove_messages", receiver, cursor)
@@ -0,0 +1,53 @@
+"""
+Compares the messages per second of the legacy per-message key setup with the cached ciphers.
+
+Run from the repository root: python -m tests.cipher_benchmark --messages 2000
+"""
+
+import time
+import random
+import base64
+import argparse
+from os import urandom
+from cryptography.fernet import Fernet
+
+from client.tools import Encryption
+
+
+def legacy_encrypt(message, key):
+    """Encrypts the message like older versions, which reseeded random and built a new Fernet each time."""
+    random.seed(key)
+    k = base64.urlsafe_b64encode(bytearray(random.getrandbits(8) for _ in range(32)))
+    return Fernet(k).encrypt(bytes(message, encoding="UTF-8")).decode("UTF-8")
+
+
+def legacy_decrypt(message, key):
+    """Decrypts the message like older versions."""
+    random.seed(key)
+    k = base64.urlsafe_b64encode(bytearray(random.getrandbits(8) for _ in range(32)))
+    return Fernet(k).decrypt(message.encode("UTF-8")).decode()
+
+
+def measure(encrypt, decrypt, message, key, n):
+    """Returns the number of encrypted and decrypted messages per second."""
+    start = time.perf_counter()
+    for _ in range(n):
+        decrypt(encrypt(message, key), key)
+    return n / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--messages", type=int, default=2000, help="the number of messages per measurement")
+    args = parser.parse_args()
+
+    key = int.from_bytes(urandom(192), "big")
+    for size in (16, 256, 4096):
+        message = "x" * size
+        legacy = measure(legacy_encrypt, legacy_decrypt, message, key, args.messages)
+        cached = measure(Encryption.encrypt, Encryption.decrypt, message, key, args.messages)
+        print("%5d bytes   legacy %8.0f msg/s   cached %8.0f msg/s   %5.1fx" % (size, legacy, cached, cached / legacy))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+import os
+import asyncio
+import tempfile
+import unittest
+from server.server_tools import AsyncDatabase, Database, OfflineStore
+
+
+class TestAsyncDatabase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "user_info.db")
+        self.db = AsyncDatabase(self.path, readers=2)
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.db.close()
+        self.loop.close()
+        self.directory.cleanup()
+
+    def run_async(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    def test_users(self):
+        """Tests that users written by the writer thread are visible to the readers"""
+
+        self.run_async(self.db.add_hashed_user("Alice", b"hash", b"salt"))
+
+        self.assertIsNotNone(self.run_async(self.db.find_user("alice")))
+        self.assertIsNone(self.run_async(self.db.find_user("bob")))
+        self.assertEqual(self.run_async(self.db.find_credentials("ALICE")), (b"hash", b"salt"))
+
+    def test_duplicate_user(self):
+        """Tests that a failing write is reported without breaking the other writes of the batch"""
+
+        async def add_twice():
+            return await asyncio.gather(self.db.add_hashed_user("alice", b"1", b"1"),
+                                        self.db.add_hashed_user("alice", b"2", b"2"),
+                                        self.db.add_hashed_user("bob", b"3", b"3"), return_exceptions=True)
+
+        results = self.run_async(add_twice())
+
+        self.assertIsNone(results[0])
+        self.assertIsInstance(results[1], Exception)
+        self.assertIsNone(results[2])
+        self.assertIsNotNone(self.run_async(self.db.find_user("bob")))
+
+    def test_friends(self):
+        """Tests that friendships are found in both directions from memory and from the database"""
+
+        self.run_async(self.db.add_friends("alice", "Bob"))
+        self.run_async(self.db.add_friends("bob", "alice"))
+        self.run_async(self.db.add_friends("carol", "alice"))
+
+        self.assertTrue(self.db.are_friends("bob", "alice"))
+        self.assertFalse(self.db.are_friends("bob", "carol"))
+        self.assertEqual(sorted(self.db.find_friends("alice")), ["bob", "carol"])
+
+        db = Database(self.path)
+        self.assertTrue(db.are_friends("bob", "alice"))
+        self.assertFalse(db.are_friends("bob", "carol"))
+        self.assertEqual(sorted(db.find_friends("Alice")), ["bob", "carol"])
+        db.user_db.close()
+
+    def test_friend_graph_loading(self):
+        """Tests that the friend graph is loaded from the database at startup"""
+
+        self.run_async(self.db.add_friends("alice", "bob"))
+        db = AsyncDatabase(self.path, readers=1)
+
+        self.assertTrue(db.are_friends("Bob", "alice"))
+        self.assertEqual(db.find_friends("bob"), {"alice"})
+        db.close()
+
+    def test_wal(self):
+        """Tests that the database uses write-ahead logging"""
+
+        db = Database(self.path)
+        self.assertEqual(db.user_db.execute("PRAGMA journal_mode").fetchone()[0], "wal")
+        db.user_db.close()
+
+
+class TestOfflineStore(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "offline_messages.db")
+        self.store = OfflineStore(self.path, page_size=100)
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.store.close()
+        self.loop.close()
+        self.directory.cleanup()
+
+    def run_async(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    async def read_pages(self, receiver, limit=None):
+        pages = []
+        async for page in self.store.pages(receiver):
+            pages.append(page)
+            if len(pages) == limit:
+                break
+        return pages
+
+    def test_paging(self):
+        """Tests that the queued messages are read in order one page at a time and removed after delivery"""
+
+        for i in range(250):
+            self.run_async(self.store.add_message("Bob", "alice", str(i).encode()))
+        self.run_async(self.store.add_message("carol", "alice", b"other"))
+
+        pages = self.run_async(self.read_pages("bob"))
+
+        self.assertEqual([len(page) for page in pages], [100, 100, 50])
+        self.assertEqual([message for page in pages for _, message in page], [str(i).encode() for i in range(250)])
+        self.assertEqual(self.run_async(self.read_pages("bob")), [])
+        self.assertEqual(self.run_async(self.read_pages("carol")), [[("alice", b"other")]])
+
+    def test_queue_limit(self):
+        """Tests that the messages over the limit of a receiver's queue are refused until the queue is delivered"""
+
+        self.store.max_messages = 3
+        added = [self.run_async(self.store.add_message("bob", "alice", str(i).encode())) for i in range(5)]
+        self.assertEqual(added, [True, True, True, False, False])
+        self.assertTrue(self.run_async(self.store.add_message("carol", "alice", b"other")))
+
+        self.assertEqual(sum(len(page) for page in self.run_async(self.read_pages("bob"))), 3)
+        self.assertTrue(self.run_async(self.store.add_message("bob", "alice", b"later")))
+
+    def test_interrupted_delivery(self):
+        """Tests that a page whose delivery was interrupted is delivered again"""
+
+        for i in range(150):
+            self.run_async(self.store.add_message("bob", "alice", str(i).encode()))
+
+        first = self.run_async(self.read_pages("bob", limit=1))
+        pages = self.run_async(self.read_pages("bob"))
+
+        self.assertEqual(pages[0], first[0])
+        self.assertEqual(sum(len(page) for page in pages), 150)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,5 +1,10 @@
+import random
+import base64
+import asyncio
 import unittest
-from client.tools import Encryption
+from cryptography.fernet import Fernet
+from client.tools import Encryption, CipherCache
+from server import server_tools
 
 
 class TestEncryption(unittest.TestCase):
@@ -25,6 +30,94 @@ class TestEncryption(unittest.TestCase):
 
         self.assertEqual(received_message, message)
 
+    def test_x25519(self):
+        """Tests that the X25519 key exchange gives the same key to both users and to the client and the server"""
+
+        public_key_e1 = Encryption.get_diffie_hellman("x2", x25519=True)
+        public_key_e2 = Encryption.get_diffie_hellman("x1", x25519=True)
+
+        self.assertTrue(Encryption.is_x25519(public_key_e1))
+        self.assertEqual(Encryption.receive_diffie_hellman("x2", public_key_e2),
+                         Encryption.receive_diffie_hellman("x1", public_key_e1))
+        self.assertFalse(Encryption.has_private_key("x1"))
+
+        private_key = Encryption.private_keys["client"] = server_tools.X25519PrivateKey.generate()
+        server_key, public_key = server_tools.Encryption.x25519_exchange(Encryption.x25519_public_key(private_key))
+        self.assertEqual(Encryption.receive_diffie_hellman("client", public_key), server_key)
+
+    def test_server_key_exchange_retry(self):
+        """Tests that the client retries a rejected key exchange and gets the same key as the server"""
+
+        replies = ["2", "3"]
+        server_keys = []
+
+        async def send_request(msg_type, receiver, sender, message):
+            if replies:
+                return replies.pop(0)
+            server_key, public_key = server_tools.Encryption.diffie_hellman_exchange(message)
+            server_keys.append(server_key)
+            return public_key
+
+        loop = asyncio.new_event_loop()
+        try:
+            key = loop.run_until_complete(Encryption.diffie_hellman_to_server("id", 12345, send_request,
+                                                                              retry_delay=0))
+        finally:
+            loop.close()
+
+        self.assertEqual(server_keys, [key])
+
+    def test_key_exchange_offer(self):
+        """Tests that X25519 is only chosen when the other party offers it"""
+
+        self.assertTrue(Encryption.supports_x25519(Encryption.key_exchanges()))
+        self.assertFalse(Encryption.supports_x25519(""))
+
+    def test_session_resumption(self):
+        """Tests that a resumed session gets the same new key on both sides and that a ticket works only once"""
+
+        cache = server_tools.TicketCache()
+        ticket = cache.issue(123456789)
+        secret = cache.redeem(ticket)
+
+        self.assertEqual(secret, Encryption.resumption_secret(123456789))
+        self.assertIsNone(cache.redeem(ticket))
+        self.assertEqual(server_tools.Encryption.resumed_key(secret, b"client", b"server"),
+                         Encryption.resumed_key(Encryption.resumption_secret(123456789), b"client", b"server"))
+        self.assertNotEqual(Encryption.resumed_key(secret, b"client", b"server"),
+                            Encryption.resumed_key(secret, b"client", b"other"))
+
+    def test_ticket_cache_bounds(self):
+        """Tests that the ticket cache drops expired tickets and keeps within its size"""
+
+        cache = server_tools.TicketCache(size=2)
+        tickets = [cache.issue(i + 1) for i in range(3)]
+        self.assertEqual(list(cache.tickets), tickets[1:])
+
+        expired = server_tools.TicketCache(lifetime=-1)
+        self.assertIsNone(expired.redeem(expired.issue(1)))
+
+    def test_legacy_decryption(self):
+        """Tests that messages encrypted by older versions can still be decrypted"""
+
+        key = 123456789
+        random.seed(key)
+        legacy_key = base64.urlsafe_b64encode(bytearray(random.getrandbits(8) for _ in range(32)))
+        sent_message = Fernet(legacy_key).encrypt(b"test123").decode()
+
+        self.assertEqual(Encryption.decrypt(sent_message, key), "test123")
+
+    def test_cipher_cache(self):
+        """Tests that the cipher cache reuses ciphers and stays within its size"""
+
+        cache = CipherCache(2)
+        cipher = cache.get(1)
+        cache.get(2)
+        self.assertIs(cache.get(1), cipher)
+        cache.get(3)
+
+        self.assertEqual(list(cache.ciphers), [1, 3])
+
 
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
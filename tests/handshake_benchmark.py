@@ -0,0 +1,52 @@
+"""
+Compares the server side cost of the finite-field Diffie-Hellman handshake with the X25519 handshake.
+
+The handshakes run in one process, so the results are handshakes per second per core. The client public keys
+are generated before the measurement. Run from the repository root: python -m tests.handshake_benchmark
+"""
+
+import time
+import argparse
+from os import urandom
+
+from client import tools as client_tools
+from server.server_tools import Encryption
+
+
+def diffie_hellman_handshakes(public_keys):
+    """Runs the server side of the finite-field Diffie-Hellman handshakes like the hashing processes do."""
+    for public_key in public_keys:
+        Encryption.diffie_hellman_exchange(public_key)
+
+
+def x25519_handshakes(public_keys):
+    """Runs the server side of the X25519 handshakes like the "s" message handler does."""
+    for public_key in public_keys:
+        Encryption.x25519_exchange(public_key)
+
+
+def measure(function, n):
+    """Returns the number of handshakes per second."""
+    start = time.perf_counter()
+    function()
+    return n / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--handshakes", type=int, default=500, help="the number of handshakes per measurement")
+    args = parser.parse_args()
+
+    dh_keys = [str(pow(Encryption.g, int.from_bytes(urandom(120), "big"), Encryption.p_s))
+               for _ in range(args.handshakes)]
+    x25519_keys = [client_tools.Encryption.x25519_public_key(client_tools.X25519PrivateKey.generate())
+                   for _ in range(args.handshakes)]
+
+    dh = measure(lambda: diffie_hellman_handshakes(dh_keys), args.handshakes)
+    x25519 = measure(lambda: x25519_handshakes(x25519_keys), args.handshakes)
+    print("Diffie-Hellman %8.0f handshakes/s" % dh)
+    print("X25519         %8.0f handshakes/s   %5.1fx" % (x25519, x25519 / dh))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""
+Measures message relay latency while password hashes are in flight.
+
+Run from the repository root: python -m tests.hashing_benchmark --logins 200
+"""
+
+import time
+import asyncio
+import argparse
+
+from server.server_tools import Encryption, PasswordHasher
+
+
+async def relay(queue, interval, end):
+    """Puts a message into the queue at a fixed interval until the end time is reached.
+
+    Each message is stamped with the time it was due, so a blocked event loop shows up as latency.
+
+    Args:
+        queue: The queue the messages are put into.
+        interval: The time between messages in seconds.
+        end: A list whose only item is the end time. It can be moved while the relay runs.
+    """
+    due = time.perf_counter()
+    while due < end[0]:
+        queue.put_nowait(due)
+        due += interval
+        await asyncio.sleep(max(0, due - time.perf_counter()))
+    queue.put_nowait(None)
+
+
+async def deliver(queue, latencies):
+    """Receives the relayed messages and records how long each one waited."""
+    while True:
+        sent = await queue.get()
+        if sent is None:
+            return
+        latencies.append(time.perf_counter() - sent)
+
+
+async def inline_login(password):
+    """Hashes the password on the event loop like the old login handler."""
+    await asyncio.sleep(0)
+    Encryption.hash_password(password)
+
+
+async def pooled_login(hasher, password):
+    """Hashes the password in the process pool."""
+    await hasher.hash_password(password)
+
+
+async def run(logins, make_login, interval):
+    """Runs the relay while the given logins are processed and returns the relay latencies."""
+    queue = asyncio.Queue()
+    end = [float("inf")]
+    latencies = []
+    tasks = [asyncio.ensure_future(relay(queue, interval, end)), asyncio.ensure_future(deliver(queue, latencies))]
+    await asyncio.sleep(interval * 10)
+    start = time.perf_counter()
+    await asyncio.gather(*(make_login("password%d" % i) for i in range(logins)))
+    end[0] = time.perf_counter()
+    duration = end[0] - start
+    await asyncio.gather(*tasks)
+    return latencies, duration
+
+
+def percentile(values, p):
+    """Returns the p:th percentile of the values."""
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def report(name, latencies, duration, logins):
+    """Prints the latency percentiles of one run."""
+    print("%-8s %4d logins in %6.2f s   relay latency p50 %7.2f ms   p99 %7.2f ms   max %7.2f ms" % (
+        name, logins, duration, percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000,
+        max(latencies) * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--logins", type=int, default=200, help="the number of concurrent logins")
+    parser.add_argument("--workers", type=int, default=None, help="the number of hashing processes")
+    parser.add_argument("--interval", type=float, default=0.005, help="the relay interval in seconds")
+    args = parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+    hasher = PasswordHasher(args.workers, max_pending=args.logins)
+
+    latencies, duration = loop.run_until_complete(run(args.logins, inline_login, args.interval))
+    report("inline", latencies, duration, args.logins)
+    latencies, duration = loop.run_until_complete(
+        run(args.logins, lambda password: pooled_login(hasher, password), args.interval))
+    report("pool", latencies, duration, args.logins)
+    hasher.pool.shutdown()
+
+
+if __name__ == "__main__":
+    main()
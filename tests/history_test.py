@@ -0,0 +1,99 @@
+import os
+import pickle
+import tempfile
+import unittest
+from types import SimpleNamespace
+from client.tools import FileManager
+
+
+class TestFileManager(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cwd = os.getcwd()
+        os.chdir(self.directory.name)
+        self.controller = SimpleNamespace(username="Alice", keys={}, chats={})
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.directory.cleanup()
+
+    def test_lazy_loading(self):
+        """Tests that the keys are loaded at startup and only the most recent page of an opened chat is loaded"""
+
+        file_manager = FileManager(self.controller)
+        file_manager.load()
+        file_manager.add_key("bob", 12345)
+        for i in range(FileManager.page_size + 10):
+            file_manager.add_line("bob", "bob: " + str(i))
+        file_manager.save()
+
+        file_manager.load()
+        self.assertEqual(self.controller.keys, {"bob": 12345})
+        self.assertEqual(self.controller.chats, {})
+
+        lines = file_manager.load_chat("bob")
+        self.assertEqual(len(lines), FileManager.page_size)
+        self.assertEqual(lines[-1], "bob: " + str(FileManager.page_size + 9))
+
+        file_manager.add_line("bob", "alice: hi")
+        self.assertEqual(self.controller.chats["bob"][-1], "alice: hi")
+        file_manager.save()
+
+    def test_scrollback(self):
+        """Tests that older pages are loaded in front of the loaded lines until the whole chat has been loaded"""
+
+        file_manager = FileManager(self.controller)
+        file_manager.load()
+        for i in range(2 * FileManager.page_size + 10):
+            file_manager.add_line("bob", str(i))
+        file_manager.save()
+        file_manager.load()
+
+        file_manager.load_chat("bob")
+        self.assertEqual(len(file_manager.load_older("bob")), FileManager.page_size)
+        self.assertEqual(file_manager.load_older("bob"), [str(i) for i in range(10)])
+        self.assertEqual(file_manager.load_older("bob"), [])
+        self.assertEqual(self.controller.chats["bob"], [str(i) for i in range(2 * FileManager.page_size + 10)])
+        file_manager.save()
+
+    def test_flush(self):
+        """Tests that only the pending changes are written on a flush and that pending lines are shown when a chat
+        is opened"""
+
+        file_manager = FileManager(self.controller)
+        file_manager.load()
+        file_manager.add_key("bob", 12345)
+        file_manager.add_line("bob", "bob: hello")
+
+        self.assertEqual(file_manager.db.execute("SELECT COUNT(*) FROM lines").fetchone()[0], 0)
+        self.assertEqual(file_manager.load_chat("bob"), ["bob: hello"])
+
+        file_manager.flush()
+        self.assertEqual(file_manager.pending_lines, {})
+        self.assertEqual(file_manager.db.execute("SELECT COUNT(*) FROM lines").fetchone()[0], 1)
+
+        file_manager.add_line("bob", "alice: hi")
+        file_manager.save()
+        file_manager.load()
+        self.assertEqual(file_manager.load_chat("bob"), ["bob: hello", "alice: hi"])
+        self.assertEqual(self.controller.keys, {"bob": 12345})
+        file_manager.save()
+
+    def test_migration(self):
+        """Tests that the keys and chats of an old pickle file are moved into the database"""
+
+        with open("alice.pickle", "wb") as file:
+            pickle.dump(({"bob": 6789}, {"bob": ["bob: hello", "alice: hi"]}), file)
+
+        file_manager = FileManager(self.controller)
+        file_manager.load()
+
+        self.assertEqual(self.controller.keys, {"bob": 6789})
+        self.assertEqual(file_manager.load_chat("bob"), ["bob: hello", "alice: hi"])
+        self.assertFalse(os.path.exists("alice.pickle"))
+        file_manager.save()
+
+
+if __name__ == "__main__":
+    unittest.main()
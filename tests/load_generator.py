@@ -0,0 +1,357 @@
+"""
+Simulates headless clients against the chat server and reports the connect rate, the delivery latency of the chat
+messages and the errors.
+
+Each client goes through the same steps as the real client: the key exchange with the server, registration and
+login, the connection message and the key exchange with a friend. The clients are paired, and each client sends
+chat messages to its friend at a fixed rate while random clients disconnect and connect again. The delivery
+latency of a message that was sent while its receiver was reconnecting includes the time it spent in the offline
+queue.
+
+Without --uri, a server is started in a temporary directory. Run from the repository root:
+python -m tests.load_generator --clients 200 --duration 30
+"""
+
+import os
+import sys
+import time
+import random
+import signal
+import base64
+import asyncio
+import argparse
+import tempfile
+import subprocess
+import websockets
+from os import urandom
+from collections import Counter, deque
+
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
+
+from client.tools import KEY_EXCHANGE_HEADER, REJECTED, Encryption, BinaryProtocol, Compression
+
+SERVER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "server", "server.py")
+
+# The names of the errors that the server's rejection replies are counted as
+REJECTION_ERRORS = {"2": "busy", "3": "rate limited"}
+
+
+class Stats:
+    """The measurements of all simulated clients."""
+
+    def __init__(self):
+        self.connect_times = []
+        self.latencies = []
+        self.sent = 0
+        self.received = 0
+        self.errors = Counter()
+
+
+class LoadClient:
+    """A headless client that speaks the binary protocol."""
+
+    def __init__(self, uri, username, stats, x25519=True, timeout=30):
+        """Constructor.
+
+        Args:
+            uri: The location of the server.
+            username: The username, which is also the password.
+            stats: The Stats instance the measurements are recorded in.
+            x25519: If False, finite-field Diffie-Hellman is used even if the server supports X25519.
+            timeout: The time in seconds after which a request without a reply fails.
+        """
+        self.uri = uri
+        self.username = username
+        self.stats = stats
+        self.x25519 = x25519
+        self.timeout = timeout
+        self.websocket = None
+        self.reader = None
+        self.replies = deque()
+        self.registered = False
+        self.friend = None
+        self.friend_key = None
+        self.pairing_key = None
+        self.paired = None
+
+    @property
+    def connected(self):
+        """True if the client is connected as its user."""
+        return self.websocket is not None and self.websocket.open
+
+    async def connect(self):
+        """Connects to the server and logs in, registering the user on the first connection.
+
+        Returns:
+            True if the client connected, False if a step failed. The failures are counted as errors.
+        """
+        start = time.perf_counter()
+        if not await self.log_in():
+            await self.close()
+            return False
+        self.stats.connect_times.append(time.perf_counter() - start)
+        return True
+
+    async def log_in(self):
+        """Performs the steps of connect.
+
+        Returns:
+            True if the client connected, False otherwise.
+        """
+        try:
+            self.websocket = await websockets.connect(self.uri, subprotocols=[BinaryProtocol.name], compression=None,
+                                                      extensions=[Compression()], max_queue=None)
+            self.reader = asyncio.ensure_future(self.read())
+            sender = connection_id()
+            x25519 = self.x25519 and Encryption.supports_x25519(
+                self.websocket.response_headers.get(KEY_EXCHANGE_HEADER, ""))
+            key = await Encryption.diffie_hellman_to_server(
+                sender, int.from_bytes(urandom(120), sys.byteorder), self.counted_request, x25519)
+            credentials = Encryption.encrypt(self.username + "@" + self.username, key)
+            if not self.registered:
+                if await self.retried_request("r", sender, credentials) != "1":
+                    self.stats.errors["registration failed"] += 1
+                    return False
+                self.registered = True
+            if await self.retried_request("l", sender, credentials) != "1":
+                self.stats.errors["login failed"] += 1
+                return False
+            await self.request("c", "", self.username)
+        except (websockets.ConnectionClosed, asyncio.CancelledError, OSError):
+            self.stats.errors["connection closed"] += 1
+            return False
+        except asyncio.TimeoutError:
+            self.stats.errors["timeout"] += 1
+            return False
+        return True
+
+    async def close(self):
+        """Sends the disconnection message and closes the connection."""
+        if self.connected:
+            try:
+                await self.websocket.send(BinaryProtocol.encode("g", "", self.username, ""))
+                await self.websocket.close()
+            except websockets.ConnectionClosed:
+                pass
+        if self.reader is not None:
+            self.reader.cancel()
+        self.websocket = None
+
+    async def request(self, msg_type, receiver, sender, message=""):
+        """Sends a request and returns the reply of the server.
+
+        Raises:
+            asyncio.TimeoutError: If there is no reply within the timeout.
+        """
+        reply = asyncio.get_event_loop().create_future()
+        self.replies.append(reply)
+        await self.websocket.send(BinaryProtocol.encode(msg_type, receiver, sender, message))
+        return await asyncio.wait_for(reply, self.timeout)
+
+    async def counted_request(self, msg_type, receiver, sender, message=""):
+        """Sends a request and counts a rejection of it as an error. See request."""
+        reply = await self.request(msg_type, receiver, sender, message)
+        if reply in REJECTION_ERRORS:
+            self.stats.errors[REJECTION_ERRORS[reply]] += 1
+        return reply
+
+    async def retried_request(self, msg_type, sender, message, attempts=5):
+        """Sends a request and retries it with a backoff while the server rejects it. See request."""
+        delay = 0.5
+        reply = await self.counted_request(msg_type, "", sender, message)
+        while reply in REJECTED and attempts > 1:
+            await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+            delay *= 2
+            attempts -= 1
+            reply = await self.counted_request(msg_type, "", sender, message)
+        return reply
+
+    async def read(self):
+        """Handles the incoming frames until the connection is closed."""
+        try:
+            while True:
+                for frame in BinaryProtocol.unpack(await self.websocket.recv()):
+                    self.handle(BinaryProtocol.parse(frame))
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            while self.replies:
+                self.replies.popleft().cancel()
+
+    def handle(self, message):
+        """Handles one incoming message like ConnectionThread.handle, recording the latency of chat messages."""
+        kind = message[0]
+        if kind == "reply":
+            self.replies.popleft().set_result(message[1])
+        elif kind == "a":
+            self.send_pairing_key(message[1], Encryption.supports_x25519(message[2]))
+        elif kind == "d":
+            if self.pairing_key is None:
+                self.send_pairing_key(message[1], Encryption.is_x25519(message[2]))
+            if Encryption.is_x25519(message[2]):
+                self.friend_key = Encryption.x25519_shared_key(self.pairing_key, message[2])
+            else:
+                self.friend_key = pow(int(message[2]), self.pairing_key, Encryption.p)
+            self.pairing_key = None
+            self.friend = message[1]
+            if self.paired is not None and not self.paired.done():
+                self.paired.set_result(True)
+        elif kind == "m" and message[1] == message[2] == self.friend and self.friend_key is not None:
+            sent = float(Encryption.decrypt(message[3], self.friend_key).split(" ")[1])
+            self.stats.latencies.append(time.time() - sent)
+            self.stats.received += 1
+
+    def send_pairing_key(self, friend, x25519):
+        """Sends the own public key of the key exchange with the friend."""
+        if x25519:
+            self.pairing_key = X25519PrivateKey.generate()
+            public_key = Encryption.x25519_public_key(self.pairing_key)
+        else:
+            self.pairing_key = int.from_bytes(urandom(160), sys.byteorder)
+            public_key = str(pow(Encryption.g, self.pairing_key, Encryption.p))
+        asyncio.ensure_future(self.websocket.send(BinaryProtocol.encode("d", friend, self.username, public_key)))
+
+    async def pair(self, other):
+        """Adds the other client as a friend and waits until both have the shared key.
+
+        Returns:
+            True if the pairing succeeded, False otherwise.
+        """
+        self.paired = asyncio.get_event_loop().create_future()
+        other.paired = asyncio.get_event_loop().create_future()
+        try:
+            offer = Encryption.key_exchanges() if self.x25519 else ""
+            if await self.counted_request("a", other.username, self.username, offer) != "1":
+                self.stats.errors["pairing failed"] += 1
+                return False
+            await asyncio.wait_for(asyncio.gather(self.paired, other.paired), self.timeout)
+        except (websockets.ConnectionClosed, asyncio.CancelledError):
+            self.stats.errors["connection closed"] += 1
+            return False
+        except asyncio.TimeoutError:
+            self.stats.errors["pairing failed"] += 1
+            return False
+        return True
+
+    async def send_messages(self, rate, end):
+        """Sends chat messages to the friend at the given rate until the end time. Each message carries its send
+        time, so the receiver can compute the delivery latency."""
+        sequence = 0
+        due = time.perf_counter()
+        while due < end:
+            if self.connected and self.friend_key is not None:
+                token = Encryption.encrypt("%d %.6f" % (sequence, time.time()), self.friend_key)
+                try:
+                    await self.websocket.send(BinaryProtocol.encode("m", self.friend, self.username, token))
+                    self.stats.sent += 1
+                    sequence += 1
+                except websockets.ConnectionClosed:
+                    pass
+            due += random.expovariate(rate)
+            await asyncio.sleep(max(0, due - time.perf_counter()))
+
+
+def connection_id():
+    """Returns a random connection id like Controller does."""
+    return base64.urlsafe_b64encode(urandom(30)).decode()
+
+
+async def churn(clients, rate, end):
+    """Disconnects random clients at the given rate and connects them again, until the end time."""
+    while rate > 0 and time.perf_counter() < end:
+        await asyncio.sleep(random.expovariate(rate))
+        client = random.choice(clients)
+        if client.connected:
+            await client.close()
+            asyncio.ensure_future(client.connect())
+
+
+async def run(uri, args):
+    """Runs the load.
+
+    Returns:
+        A tuple of the Stats, the number of clients that connected in the connection phase and its duration in
+        seconds.
+    """
+    stats = Stats()
+    prefix = "load%d" % random.randrange(10 ** 6)
+    clients = [LoadClient(uri, "%s%d" % (prefix, i), stats, not args.dh)
+               for i in range(args.clients - args.clients % 2)]
+    concurrency = asyncio.Semaphore(args.concurrency)
+
+    async def connect(client):
+        async with concurrency:
+            return await client.connect()
+
+    start = time.perf_counter()
+    connected = await asyncio.gather(*(connect(client) for client in clients))
+    connect_duration = time.perf_counter() - start
+
+    pairs = [(clients[i], clients[i + 1]) for i in range(0, len(clients), 2) if connected[i] and connected[i + 1]]
+    await asyncio.gather(*(a.pair(b) for a, b in pairs))
+    paired = [client for pair in pairs for client in pair if client.friend_key is not None]
+
+    end = time.perf_counter() + args.duration
+    await asyncio.gather(churn(paired, args.churn, end), *(client.send_messages(args.rate, end) for client in paired))
+    # The messages in flight and in the offline queues of reconnecting clients are waited for
+    await asyncio.sleep(args.drain)
+    stats.errors["lost messages"] += stats.sent - stats.received
+    await asyncio.gather(*(client.close() for client in clients))
+    return stats, sum(connected), connect_duration
+
+
+def percentile(values, p):
+    """Returns the p:th percentile of the values."""
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))] if values else float("nan")
+
+
+def report(stats, clients, initial, connect_duration):
+    """Prints the results."""
+    print("connect   %d/%d clients in %.2f s   %.1f connects/s   p50 %.1f ms   p99 %.1f ms" % (
+        initial, clients, connect_duration, initial / connect_duration,
+        percentile(stats.connect_times, 50) * 1000, percentile(stats.connect_times, 99) * 1000))
+    print("delivery  %d/%d messages   p50 %.2f ms   p99 %.2f ms   p999 %.2f ms" % (
+        stats.received, stats.sent, percentile(stats.latencies, 50) * 1000, percentile(stats.latencies, 99) * 1000,
+        percentile(stats.latencies, 99.9) * 1000))
+    errors = ", ".join("%s %d" % item for item in sorted(stats.errors.items()) if item[1])
+    print("errors    " + (errors or "none"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--uri", help="the server to load. If not given, a server is started")
+    parser.add_argument("--port", type=int, default=8791, help="the port of the started server")
+    parser.add_argument("--workers", type=int, default=1, help="the number of worker processes of the started server")
+    parser.add_argument("--clients", type=int, default=100, help="the number of simulated clients, rounded down to "
+                                                                  "an even number")
+    parser.add_argument("--concurrency", type=int, default=50, help="the number of clients connecting at once")
+    parser.add_argument("--duration", type=float, default=10, help="the time in seconds messages are sent")
+    parser.add_argument("--rate", type=float, default=1, help="the messages per second sent by each client")
+    parser.add_argument("--churn", type=float, default=0, help="the reconnections per second of all clients")
+    parser.add_argument("--drain", type=float, default=2,
+                        help="the time in seconds the last messages are waited for")
+    parser.add_argument("--dh", action="store_true", help="use finite-field Diffie-Hellman instead of X25519")
+    args = parser.parse_args()
+
+    server = None
+    uri = args.uri
+    if uri is None:
+        # All clients connect from one address, so the address rate limit of the started server is lifted
+        server = subprocess.Popen([sys.executable, SERVER, "--port", str(args.port), "--workers", str(args.workers),
+                                   "--address-rate", "1e9", "--address-burst", "1000000000"], cwd=tempfile.mkdtemp(),
+                                  start_new_session=True)
+        time.sleep(2)
+        uri = "ws://localhost:%d" % args.port
+    try:
+        stats, initial, connect_duration = asyncio.get_event_loop().run_until_complete(run(uri, args))
+    finally:
+        if server is not None:
+            # The hashing processes of the server are stopped with it
+            os.killpg(server.pid, signal.SIGTERM)
+            server.wait()
+    report(stats, args.clients - args.clients % 2, initial, connect_duration)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+import asyncio
+import unittest
+from server.metrics import Metrics, Counter, Histogram, message_type
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_text_format(self):
+        """Tests that counters, histograms and gauges are rendered in the Prometheus text format"""
+
+        metrics = Metrics()
+        metrics.messages.inc(message_type("m"))
+        metrics.messages.inc(message_type("m"))
+        metrics.messages.inc(message_type("x;drop"))
+        metrics.db_seconds.observe("find_user", 0.002)
+        metrics.db_seconds.observe("find_user", 20)
+        metrics.gauge("chat_connections", "Users connected to this process.", lambda: 3)
+        lines = metrics.render().splitlines()
+
+        self.assertIn("# TYPE chat_messages_total counter", lines)
+        self.assertIn('chat_messages_total{type="m"} 2', lines)
+        self.assertIn('chat_messages_total{type="other"} 1', lines)
+        self.assertIn('chat_db_seconds_bucket{query="find_user",le="0.001"} 0', lines)
+        self.assertIn('chat_db_seconds_bucket{query="find_user",le="0.0025"} 1', lines)
+        self.assertIn('chat_db_seconds_bucket{query="find_user",le="10"} 1', lines)
+        self.assertIn('chat_db_seconds_bucket{query="find_user",le="+Inf"} 2', lines)
+        self.assertIn('chat_db_seconds_sum{query="find_user"} 20.002', lines)
+        self.assertIn('chat_db_seconds_count{query="find_user"} 2', lines)
+        self.assertIn("chat_connections 3", lines)
+
+    def test_histogram_timer(self):
+        """Tests that a timed block is recorded even if it raises"""
+
+        histogram = Histogram("h", "Test.", "type")
+        with self.assertRaises(ValueError):
+            with histogram.time("m"):
+                raise ValueError()
+        self.assertEqual(histogram.samples()[-1], ("h_count", [("type", "m")], 1))
+        self.assertEqual(Counter("c", "Test.").samples(), [])
+
+    def test_endpoint(self):
+        """Tests that the metrics are served over HTTP"""
+
+        async def scrape(metrics, path):
+            server = await metrics.serve(0)
+            port = server.sockets[0].getsockname()[1]
+            reader, writer = await asyncio.open_connection("localhost", port)
+            writer.write(b"GET " + path + b" HTTP/1.1\r\nHost: localhost\r\n\r\n")
+            response = await reader.read()
+            writer.close()
+            server.close()
+            await server.wait_closed()
+            return response
+
+        metrics = Metrics()
+        metrics.bytes_in.inc(amount=10)
+        loop = asyncio.new_event_loop()
+        try:
+            response = loop.run_until_complete(scrape(metrics, b"/metrics"))
+            missing = loop.run_until_complete(scrape(metrics, b"/other"))
+        finally:
+            loop.close()
+
+        self.assertTrue(response.startswith(b"HTTP/1.1 200 OK\r\n"))
+        self.assertIn(b"chat_received_bytes_total 10\n", response)
+        self.assertTrue(missing.startswith(b"HTTP/1.1 404"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,316 @@
+"""
+Times the cryptographic and database hot paths one at a time and compares the results with a saved baseline.
+
+Each benchmark is run until one round takes at least --min-time seconds, and the fastest of --repeat rounds is
+reported as the time per operation. The database benchmarks run against tables of each --sizes number of users
+and friendships.
+
+Save a baseline before a change and compare with it after the change, on the same machine:
+
+    python -m tests.micro_benchmark --save baseline.json
+    python -m tests.micro_benchmark --compare baseline.json --margin 0.2
+
+The comparison exits with status 1 if a benchmark is slower than its baseline by more than the margin.
+"""
+
+import re
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+from os import path, urandom
+
+from client.tools import Encryption
+from server.server_tools import Database, Encryption as ServerEncryption
+
+# The sizes of the encrypted chat messages in bytes
+MESSAGE_SIZES = (16, 256, 4096, 65536)
+
+# The database benchmarks, named after the Database methods
+DATABASE_BENCHMARKS = ("add_user", "add_hashed_user", "find_user", "find_user.missing", "find_credentials",
+                       "verify_user", "add_friends", "are_friends", "are_friends.missing", "find_friends",
+                       "all_friends")
+
+
+def autorange(operation, min_time):
+    """Returns the number of operations that take at least min_time seconds, doubling from one."""
+    n = 1
+    while True:
+        start = time.perf_counter()
+        operation(n)
+        if time.perf_counter() - start >= min_time:
+            return n
+        n *= 2
+
+
+def measure(operation, min_time, repeat):
+    """Returns the time of one operation in seconds.
+
+    Args:
+        operation: A function that performs the given number of operations.
+        min_time: The minimum duration of one round in seconds.
+        repeat: The number of rounds, of which the fastest is used.
+    """
+    n = autorange(operation, min_time)
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        operation(n)
+        best = min(best, (time.perf_counter() - start) / n)
+    return best
+
+
+def counter():
+    """Returns a function that returns consecutive integers, used for names that must not repeat."""
+    state = [0]
+
+    def next_value():
+        state[0] += 1
+        return state[0]
+    return next_value
+
+
+def key_exchange_benchmarks():
+    """Yields the key exchange benchmarks as (name, operation) tuples."""
+    names = counter()
+
+    def client_public(n):
+        # The 2048-bit prime of the key exchanges between users
+        for _ in range(n):
+            friend = "f%d" % names()
+            Encryption.get_diffie_hellman(friend)
+            Encryption.private_keys.pop(friend)
+    yield "dh2048.get_diffie_hellman", client_public
+
+    received_key = str(pow(Encryption.g, int.from_bytes(urandom(160), sys.byteorder), Encryption.p))
+
+    def client_shared(n):
+        for _ in range(n):
+            Encryption.receive_diffie_hellman("f%d" % names(), received_key)
+    yield "dh2048.receive_diffie_hellman", client_shared
+
+    private_key = ServerEncryption.new_private_key()
+    client_key = str(pow(ServerEncryption.g, int.from_bytes(urandom(120), sys.byteorder), ServerEncryption.p_s))
+
+    def server_public(n):
+        # The 1536-bit prime of the key exchanges between a client and the server
+        for _ in range(n):
+            ServerEncryption.get_diffie_hellman_key(private_key)
+    yield "dh1536.get_diffie_hellman_key", server_public
+
+    def server_shared(n):
+        for _ in range(n):
+            ServerEncryption.receive_diffie_hellman_from_client(private_key, client_key)
+    yield "dh1536.receive_diffie_hellman_from_client", server_shared
+
+    x25519_key = Encryption.get_diffie_hellman("x25519 peer", x25519=True)
+    Encryption.private_keys.pop("x25519 peer")
+
+    def x25519_exchange(n):
+        for _ in range(n):
+            friend = "x%d" % names()
+            Encryption.get_diffie_hellman(friend, x25519=True)
+            Encryption.receive_diffie_hellman(friend, x25519_key)
+    yield "x25519.exchange", x25519_exchange
+
+
+def cipher_benchmarks():
+    """Yields the encryption benchmarks as (name, operation) tuples."""
+    key = int.from_bytes(urandom(192), "big")
+    for size in MESSAGE_SIZES:
+        message = "x" * size
+        token = Encryption.encrypt(message, key)
+
+        def encrypt(n, message=message):
+            for _ in range(n):
+                Encryption.encrypt(message, key)
+
+        def decrypt(n, token=token):
+            for _ in range(n):
+                Encryption.decrypt(token, key)
+        yield "encrypt.%d" % size, encrypt
+        yield "decrypt.%d" % size, decrypt
+
+
+def hashing_benchmarks():
+    """Yields the password hashing benchmark as a (name, operation) tuple."""
+    def hash_password(n):
+        for _ in range(n):
+            ServerEncryption.hash_password("correct horse battery staple")
+    yield "hash_password", hash_password
+
+
+def populate(db, users):
+    """Fills the database with the given number of users and as many random friendships."""
+    hashed_password, salt = ServerEncryption.hash_password("password")
+    connection = db.connection
+    connection.executemany("INSERT INTO user_info VALUES (?, ?, ?)",
+                           (("user%d" % i, hashed_password, salt) for i in range(users)))
+    pairs = set()
+    while len(pairs) < users:
+        user_1, user_2 = random.randrange(users), random.randrange(users)
+        if user_1 != user_2 and (user_2, user_1) not in pairs:
+            pairs.add((user_1, user_2))
+    connection.executemany("INSERT INTO friends VALUES (?, ?)",
+                           (("user%d" % user_1, "user%d" % user_2) for user_1, user_2 in pairs))
+    connection.commit()
+    return sorted(pairs)
+
+
+def database_benchmarks(users, directory):
+    """Yields the benchmarks of every Database method as (name, operation) tuples.
+
+    Args:
+        users: The number of users and friendships in the database.
+        directory: The directory the database file is created in.
+    """
+    db = Database(path.join(directory, "users%d.db" % users))
+    pairs = populate(db, users)
+    names = counter()
+
+    def random_user():
+        return "user%d" % random.randrange(users)
+
+    def random_pair():
+        user_1, user_2 = random.choice(pairs)
+        return "user%d" % user_1, "user%d" % user_2
+
+    def add_user(n):
+        for _ in range(n):
+            db.add_user("new%d" % names(), "password")
+
+    def add_hashed_user(n):
+        for _ in range(n):
+            db.add_hashed_user("new%d" % names(), b"hash", b"salt")
+
+    def find_user(n):
+        for _ in range(n):
+            db.find_user(random_user())
+
+    def find_user_missing(n):
+        for _ in range(n):
+            db.find_user("missing%d" % names())
+
+    def find_credentials(n):
+        for _ in range(n):
+            db.find_credentials(random_user())
+
+    def verify_user(n):
+        for _ in range(n):
+            db.verify_user(random_user(), "password")
+
+    def add_friends(n):
+        for _ in range(n):
+            db.add_friends(random_user(), "new%d" % names())
+
+    def are_friends(n):
+        for _ in range(n):
+            db.are_friends(*random_pair())
+
+    def are_friends_missing(n):
+        for _ in range(n):
+            db.are_friends(random_user(), "missing")
+
+    def find_friends(n):
+        for _ in range(n):
+            db.find_friends(random_user())
+
+    def all_friends(n):
+        for _ in range(n):
+            for _ in db.all_friends():
+                pass
+
+    operations = locals()
+    for name in DATABASE_BENCHMARKS:
+        yield "db%d.%s" % (users, name), operations[name.replace(".missing", "_missing")]
+    db.connection.close()
+
+
+def benchmarks(sizes, directory):
+    """Yields every benchmark as a (name, operation) tuple."""
+    yield from key_exchange_benchmarks()
+    yield from cipher_benchmarks()
+    yield from hashing_benchmarks()
+    for users in sizes:
+        yield from database_benchmarks(users, directory)
+
+
+def compare(results, baseline, margin):
+    """Prints the change of each benchmark from the baseline.
+
+    Args:
+        results: A dict of the measured times by benchmark name.
+        baseline: A dict of the baseline times by benchmark name.
+        margin: The allowed slowdown as a fraction of the baseline time.
+    Returns:
+        The names of the benchmarks that are slower than the baseline by more than the margin.
+    """
+    regressions = []
+    for name, seconds in results.items():
+        if name not in baseline:
+            print("%-45s %12s   no baseline" % (name, format_time(seconds)))
+            continue
+        change = seconds / baseline[name] - 1
+        regressed = change > margin
+        if regressed:
+            regressions.append(name)
+        print("%-45s %12s   %+7.1f%%%s" % (name, format_time(seconds), change * 100, "   SLOWER" if regressed else ""))
+    return regressions
+
+
+def format_time(seconds):
+    """Formats the time of one operation with a readable unit."""
+    for unit, scale in (("s", 1), ("ms", 1e-3), ("us", 1e-6)):
+        if seconds >= scale:
+            return "%.2f %s" % (seconds / scale, unit)
+    return "%.0f ns" % (seconds / 1e-9)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000],
+                        help="the numbers of users and friendships in the benchmarked databases, up to 1000000")
+    parser.add_argument("--filter", default="", help="a regular expression that the benchmark names must match")
+    parser.add_argument("--min-time", type=float, default=0.2, help="the minimum duration of one round in seconds")
+    parser.add_argument("--repeat", type=int, default=3, help="the number of rounds per benchmark")
+    parser.add_argument("--save", help="the file the results are saved in as the new baseline")
+    parser.add_argument("--compare", help="the baseline file the results are compared with")
+    parser.add_argument("--margin", type=float, default=0.2,
+                        help="the allowed slowdown from the baseline as a fraction, 0.2 meaning 20%%")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+
+    pattern = re.compile(args.filter)
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        # Only the databases that some selected benchmark uses are built
+        sizes = [users for users in args.sizes
+                 if any(pattern.search("db%d.%s" % (users, name)) for name in DATABASE_BENCHMARKS)]
+        for name, operation in benchmarks(sizes, directory):
+            if not pattern.search(name):
+                continue
+            results[name] = measure(operation, args.min_time, args.repeat)
+            if baseline is None:
+                print("%-45s %12s" % (name, format_time(results[name])), flush=True)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({"python": platform.python_version(), "machine": platform.platform(), "results": results},
+                      f, indent=2, sort_keys=True)
+    if baseline is not None:
+        regressions = compare(results, baseline, args.margin)
+        if regressions:
+            print("%d benchmark(s) slower than the baseline by more than %.0f%%" % (len(regressions),
+                                                                                    args.margin * 100))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+import os
+import time
+import asyncio
+import tempfile
+import unittest
+from server.monitor import Monitor
+
+
+def busy(seconds):
+    """Blocks the calling thread like a slow synchronous call in a handler."""
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        pass
+
+
+class TestMonitor(unittest.TestCase):
+
+    def run_handler(self, monitor, msg_type, phase, seconds):
+        """Runs a handler that blocks the event loop in the given phase while the monitor watches."""
+
+        async def handler():
+            monitor.handling(msg_type)
+            await asyncio.sleep(0.05)
+            monitor.phase(phase)
+            busy(seconds)
+            # The heartbeat runs again, which ends the stall
+            await asyncio.sleep(0.1)
+
+        loop = asyncio.new_event_loop()
+        try:
+            monitor.start(loop)
+            loop.run_until_complete(handler())
+        finally:
+            monitor.stop()
+            loop.run_until_complete(asyncio.sleep(0))
+            loop.close()
+
+    def test_stall_report(self):
+        """Tests that a blocked event loop is reported with the message type, the phase and the stack"""
+
+        reports = []
+        lags = []
+        monitor = Monitor(threshold=0.05, interval=0.01, sample_interval=0.002, observe_lag=lags.append,
+                          log=reports.append)
+        self.run_handler(monitor, "l", "hash", 0.3)
+        time.sleep(0.05)
+
+        self.assertEqual(len(reports), 1)
+        self.assertTrue(reports[0].startswith("Event loop blocked for 0."))
+        self.assertIn("handling \"l\" in phase \"hash\"", reports[0])
+        self.assertIn("in busy", reports[0])
+        self.assertGreater(max(lags), 0.25)
+
+    def test_profiler(self):
+        """Tests that the profiler writes the samples as folded stacks under the message type and the phase"""
+
+        with tempfile.TemporaryDirectory() as directory:
+            profile_path = os.path.join(directory, "profile.folded")
+            monitor = Monitor(profile_path=profile_path, sample_interval=0.002)
+            monitor.toggle_profiling()
+            self.run_handler(monitor, "m", "fan-out", 0.2)
+            monitor.toggle_profiling()
+            with open(profile_path) as f:
+                lines = f.read().splitlines()
+
+        self.assertTrue(lines)
+        for line in lines:
+            stack, count = line.rsplit(" ", 1)
+            self.assertGreater(int(count), 0)
+            self.assertNotIn(" ", stack.split(";")[0])
+        self.assertTrue(any(line.startswith("m;fan-out;") and "monitor_test.py:busy " in line for line in lines))
+
+    def test_disabled(self):
+        """Tests that a monitor without a threshold or a profile path does nothing"""
+
+        monitor = Monitor()
+        self.assertFalse(monitor.enabled)
+        loop = asyncio.new_event_loop()
+        try:
+            monitor.start(loop)
+            monitor.handling("m")
+            monitor.phase("db")
+        finally:
+            loop.close()
+        self.assertEqual(len(monitor.contexts), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,135 @@
+import asyncio
+import unittest
+import websockets
+from client import tools as client_tools
+from server.server_tools import Outbox, BinaryProtocol
+
+
+class FakeConnection:
+    """A binary protocol connection whose sending waits until it is unblocked."""
+
+    subprotocol = BinaryProtocol.name
+
+    def __init__(self):
+        self.open = True
+        self.frames = []
+        self.unblocked = asyncio.Event()
+        self.unblocked.set()
+
+    async def send(self, frame):
+        await self.unblocked.wait()
+        if not self.open:
+            raise websockets.ConnectionClosed(1006, "")
+        self.frames.append(frame)
+
+    async def close(self, code=1000):
+        self.open = False
+
+    def events(self):
+        return [client_tools.BinaryProtocol.parse(f) for frame in self.frames
+                for f in client_tools.BinaryProtocol.unpack(frame)]
+
+
+class TestOutbox(unittest.TestCase):
+
+    token = "gAAAAABq1RYXuwEIiuEkaGVsbG8gd29ybGQgdGhpcyBpcyBhIHRlc3Q="
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.spilled = []
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    async def spill(self, event):
+        self.spilled.append(event)
+
+    def run_outbox(self, policy, events, max_size=3):
+        """Queues the events for a blocked connection, unblocks it and returns the connection and the outbox."""
+
+        async def run():
+            websocket = FakeConnection()
+            websocket.unblocked.clear()
+            outbox = Outbox(websocket, self.spill, max_size, policy)
+            for event in events:
+                outbox.put(event)
+            websocket.unblocked.set()
+            for _ in range(10):
+                await asyncio.sleep(0)
+            outbox.close()
+            return websocket, outbox
+        return self.loop.run_until_complete(run())
+
+    def test_batching(self):
+        """Tests that the queued events are sent in order as one batch frame"""
+
+        events = [("c", "bob", 1), ("m", "bob", "bob", self.token)]
+        websocket, outbox = self.run_outbox("spill", events)
+
+        self.assertEqual(len(websocket.frames), 1)
+        self.assertEqual(websocket.events(), [("c", "bob", "1"), ("m", "bob", "bob", self.token)])
+        self.assertEqual(outbox.stats(), {"depth": 0, "max_depth": 2, "sent": 2, "dropped": 0, "spilled": 0})
+
+    def test_overflow(self):
+        """Tests that a full queue drops the oldest presence update first and then applies the policy"""
+
+        events = [("c", "bob", 0), ("m", "bob", "bob", self.token), ("c", "bob", 1),
+                  ("m", "bob", "bob", self.token), ("m", "carol", "carol", self.token),
+                  ("m", "alice", "bob", self.token)]
+
+        websocket, outbox = self.run_outbox("spill", events)
+        self.assertEqual([event[:2] for event in websocket.events()], [("m", "bob"), ("m", "bob"), ("m", "carol")])
+        self.assertEqual(self.spilled, [])
+        self.assertEqual((outbox.dropped, outbox.spilled), (3, 0))
+
+        websocket, outbox = self.run_outbox("spill", events, max_size=2)
+        self.assertEqual([event[1] for event in self.spilled], ["carol"])
+        self.assertEqual((outbox.sent, outbox.dropped, outbox.spilled), (2, 3, 1))
+
+        self.spilled = []
+        websocket, outbox = self.run_outbox("drop", events, max_size=2)
+        self.assertEqual((outbox.sent, outbox.dropped, outbox.spilled, self.spilled), (2, 4, 0, []))
+
+    def test_disconnect(self):
+        """Tests that the disconnect policy closes the connection and stores the queued chat messages"""
+
+        events = [("m", "bob", "bob", self.token), ("m", "carol", "carol", self.token),
+                  ("m", "dave", "dave", self.token)]
+        websocket, outbox = self.run_outbox("disconnect", events, max_size=2)
+
+        self.assertFalse(websocket.open)
+        self.assertEqual(websocket.frames, [])
+        self.assertEqual([event[1] for event in self.spilled], ["bob", "carol", "dave"])
+
+    def test_paused(self):
+        """Tests that a paused outbox sends nothing until it is started and then sends the queued events in order"""
+
+        async def run():
+            websocket = FakeConnection()
+            outbox = Outbox(websocket, self.spill, paused=True)
+            outbox.put(("m", "bob", "bob", self.token))
+            await asyncio.sleep(0)
+            for frame in BinaryProtocol.encode_events([("m", "carol", "carol", self.token)]):
+                await websocket.send(frame)
+            outbox.put(("c", "bob", 1))
+            outbox.start()
+            for _ in range(10):
+                await asyncio.sleep(0)
+            outbox.close()
+            return websocket
+
+        websocket = self.loop.run_until_complete(run())
+        self.assertEqual(websocket.events(), [("m", "carol", "carol", self.token), ("m", "bob", "bob", self.token),
+                                              ("c", "bob", "1")])
+
+    def test_unknown_policy(self):
+        """Tests that an unknown overflow policy is rejected"""
+
+        with self.assertRaises(ValueError):
+            Outbox(FakeConnection(), self.spill, policy="block")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,32 @@
+import asyncio
+import unittest
+from server.server_tools import PresenceNotifier
+
+
+class TestPresenceNotifier(unittest.TestCase):
+
+    def test_coalescing(self):
+        """Tests that rapid presence changes are merged into the final state for every online friend"""
+
+        delivered = []
+
+        async def deliver(user, frame):
+            delivered.append((user, frame))
+
+        async def flap(notifier):
+            notifier.notify("Alice", 1)
+            notifier.notify("Alice", 0)
+            notifier.notify("Alice", 1)
+            await asyncio.sleep(0.1)
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        notifier = PresenceNotifier(deliver, lambda user: ["bob", "carol"], window=0.01)
+        loop.run_until_complete(flap(notifier))
+        loop.close()
+
+        self.assertEqual(sorted(delivered), [("bob", ("c", "alice", 1)), ("carol", ("c", "alice", 1))])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,70 @@
+import unittest
+from client import tools as client_tools
+from server import server_tools
+
+
+class TestProtocols(unittest.TestCase):
+
+    token = "gAAAAABq1RYXuwEIiuEkaGVsbG8gd29ybGQgdGhpcyBpcyBhIHRlc3Q="
+
+    def test_client_to_server(self):
+        """Tests that the server parses the messages of both client protocols into the same fields"""
+
+        for client, server in ((client_tools.TextProtocol, server_tools.TextProtocol),
+                               (client_tools.BinaryProtocol, server_tools.BinaryProtocol)):
+            frame = client.encode("m", "bob", "alice", self.token)
+            msg_type, receiver, sender, message = server.parse(frame)
+
+            self.assertEqual((msg_type, receiver, sender), ("m", "bob", "alice"))
+            self.assertEqual(server_tools.TextProtocol.ciphertext(message), self.token)
+            self.assertEqual(server.parse(client.encode("s", "", "id", "12345")), ("s", "", "id", "12345"))
+
+    def test_server_to_client(self):
+        """Tests that the clients parse the events, replies and friend lists of both server protocols"""
+
+        for client, server in ((client_tools.TextProtocol, server_tools.TextProtocol),
+                               (client_tools.BinaryProtocol, server_tools.BinaryProtocol)):
+            self.assertEqual(client.parse(server.encode_event(("m", "alice", "alice", self.token))),
+                             ("m", "alice", "alice", self.token))
+            self.assertEqual(client.parse(server.encode_event(("c", "alice", 1))), ("c", "alice", "1"))
+            self.assertEqual(client.parse(server.encode_event(("d", "alice", "6789"))), ("d", "alice", "6789"))
+            self.assertEqual(client.parse(server.reply("1")), ("reply", "1"))
+            self.assertEqual(client.parse(server.friend_list({"alice": 1, "bob": 0})),
+                             ("reply", {"alice": 1, "bob": 0}))
+
+    def test_batch(self):
+        """Tests that the client splits a batch frame into the batched events"""
+
+        events = [("c", "alice", 1), ("m", "alice", "alice", self.token)]
+        frame = server_tools.BinaryProtocol.batch([server_tools.BinaryProtocol.encode_event(e) for e in events])
+        frames = client_tools.BinaryProtocol.unpack(frame)
+
+        self.assertEqual([client_tools.BinaryProtocol.parse(f) for f in frames],
+                         [("c", "alice", "1"), ("m", "alice", "alice", self.token)])
+        self.assertEqual(client_tools.TextProtocol.unpack("c;alice;1"), ["c;alice;1"])
+
+    def test_encode_events(self):
+        """Tests that the binary protocol packs many events into size limited batch frames"""
+
+        events = [("m", "alice", "alice", self.token)] * 1000
+        binary = server_tools.BinaryProtocol
+        binary.max_batch_size, size = 4096, binary.max_batch_size
+        try:
+            frames = binary.encode_events(events)
+        finally:
+            binary.max_batch_size = size
+
+        self.assertTrue(all(len(frame) <= 4096 + 1 for frame in frames))
+        self.assertEqual(sum(len(client_tools.BinaryProtocol.unpack(frame)) for frame in frames), 1000)
+        self.assertEqual(len(server_tools.TextProtocol.encode_events(events)), 1000)
+
+    def test_truncated_frame(self):
+        """Tests that a truncated binary frame is rejected"""
+
+        frame = client_tools.BinaryProtocol.encode("m", "bob", "alice", self.token)
+        with self.assertRaises(ValueError):
+            server_tools.BinaryProtocol.parse(frame[:-1])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,97 @@
+import unittest
+from unittest import mock
+from types import SimpleNamespace
+from server.server_tools import Session, SessionRegistry, RateLimiter
+
+
+class TestSessionRegistry(unittest.TestCase):
+
+    def test_login_and_connection(self):
+        """Tests that a session moves from the connection id to the username and is removed on disconnect"""
+
+        sessions = SessionRegistry()
+        websocket = SimpleNamespace(open=True)
+        sessions.add(SessionRegistry.pending("id"), Session(key=123))
+        sessions.rename(SessionRegistry.pending("id"), "alice")
+
+        self.assertIsNone(sessions.get(SessionRegistry.pending("id")))
+        self.assertTrue(sessions.connect("alice", websocket))
+        self.assertFalse(sessions.connect("alice", SimpleNamespace(open=True)))
+        self.assertIs(sessions.connection("alice"), websocket)
+        self.assertEqual(sessions.get("alice").key, 123)
+
+        self.assertIsNone(sessions.remove("alice", SimpleNamespace(open=True)))
+        self.assertIsNotNone(sessions.remove("alice", websocket))
+        self.assertEqual((len(sessions), sessions.online), (0, 0))
+
+    def test_connected_session_kept(self):
+        """Tests that a session sent with a connected user's name does not replace the user's session"""
+
+        sessions = SessionRegistry()
+        websocket = SimpleNamespace(open=True)
+        sessions.connect("alice", websocket)
+
+        self.assertFalse(sessions.add("alice", Session(key=1)))
+        self.assertTrue(sessions.add(SessionRegistry.pending("alice"), Session(key=2)))
+        self.assertIs(sessions.connection("alice"), websocket)
+        self.assertEqual(sessions.online, 1)
+
+    def test_size_cap(self):
+        """Tests that the least recently active unconnected session makes room and connected sessions are kept"""
+
+        sessions = SessionRegistry(max_sessions=2)
+        sessions.connect("alice", SimpleNamespace(open=True))
+        sessions.add("id1", Session())
+        sessions.add("id2", Session())
+
+        self.assertEqual(list(sessions.sessions), ["alice", "id2"])
+
+        full = SessionRegistry(max_sessions=1)
+        full.connect("alice", SimpleNamespace(open=True))
+        self.assertFalse(full.add("id", Session()))
+        self.assertFalse(full.connect("bob", SimpleNamespace(open=True)))
+
+    def test_reaping(self):
+        """Tests that idle unconnected sessions are removed and only closed connections are returned"""
+
+        sessions = SessionRegistry(handshake_timeout=-1)
+        closed = SimpleNamespace(open=False)
+        sessions.add("id", Session())
+        sessions.connect("alice", SimpleNamespace(open=True))
+        sessions.connect("bob", closed)
+        # A client that only receives messages is not disconnected
+        sessions.sessions["alice"].last_active -= 10 ** 6
+
+        self.assertEqual([name for name, _ in sessions.expired()], ["bob"])
+        self.assertEqual(list(sessions.sessions), ["alice", "bob"])
+        self.assertIn("2 sessions, 2 connected", sessions.report())
+
+
+class TestRateLimiter(unittest.TestCase):
+
+    def test_token_bucket(self):
+        """Tests that a key can spend its burst at once and is then limited to the refill rate"""
+
+        limiter = RateLimiter(rate=2, burst=3)
+        with mock.patch("time.monotonic", return_value=100.0) as monotonic:
+            self.assertEqual([limiter.allow("1.2.3.4") for _ in range(4)], [True, True, True, False])
+            self.assertTrue(limiter.allow("5.6.7.8"))
+
+            monotonic.return_value = 100.5
+            self.assertEqual([limiter.allow("1.2.3.4") for _ in range(2)], [True, False])
+
+            monotonic.return_value = 1000.0
+            self.assertEqual([limiter.allow("1.2.3.4") for _ in range(4)], [True, True, True, False])
+
+    def test_bucket_bound(self):
+        """Tests that the buckets of the least recently seen keys are forgotten"""
+
+        limiter = RateLimiter(rate=1, burst=1, size=2)
+        for key in ("a", "b", "a", "c"):
+            limiter.allow(key)
+
+        self.assertEqual(list(limiter.buckets), ["a", "c"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,150 @@
+"""
+Compares the chat message throughput of the server with one worker process and with several worker processes.
+
+The clients are split into sender and receiver pairs, so with several workers most messages are routed between
+the worker processes. Each client exchanges a key with the server, registers, logs in and connects, and the pairs
+are made friends before the messages are timed. Run from the repository root:
+python -m tests.sharding_benchmark --workers 1 4
+"""
+
+import os
+import sys
+import time
+import base64
+import signal
+import asyncio
+import argparse
+import tempfile
+import subprocess
+import websockets
+import multiprocessing
+from os import urandom
+
+from client.tools import REJECTED, Encryption
+
+SERVER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "server", "server.py")
+
+
+async def request(websocket, msg_type, receiver, sender, message=""):
+    """Sends a request and returns the reply, retrying with a backoff while the server rejects it."""
+    delay = 0.5
+    while True:
+        await websocket.send(msg_type + ";" + receiver + ";" + sender + ";" + message)
+        reply = await websocket.recv()
+        if reply not in REJECTED:
+            return reply
+        await asyncio.sleep(delay)
+        delay *= 2
+
+
+async def open_client(uri, username):
+    """Connects a client, logs in as the user, registering the user first, and sends the connection message."""
+    websocket = await websockets.connect(uri)
+    connection_id = base64.urlsafe_b64encode(urandom(30)).decode()
+
+    async def send_request(msg_type, receiver, sender, message):
+        return await request(websocket, msg_type, receiver, sender, message)
+    key = await Encryption.diffie_hellman_to_server(
+        connection_id, int.from_bytes(urandom(120), sys.byteorder), send_request, x25519=True)
+    credentials = Encryption.encrypt(username + "@" + username, key)
+    for msg_type in ("r", "l"):
+        await request(websocket, msg_type, "", connection_id, credentials)
+    await request(websocket, "c", "", username)
+    return websocket
+
+
+async def add_friend(sender_websocket, receiver_websocket, sender, receiver):
+    """Makes the users of a pair friends and takes the friend request event from the receiver."""
+    if await request(sender_websocket, "a", receiver, sender) != "1":
+        raise RuntimeError("Could not add " + receiver + " as a friend of " + sender)
+    await receiver_websocket.recv()
+
+
+async def receive(websocket, sender, messages):
+    """Waits until all messages from the sender have been received."""
+    received = 0
+    while received < messages:
+        frame = await websocket.recv()
+        if isinstance(frame, str) and frame.startswith(sender + ">"):
+            received += 1
+    return received
+
+
+async def send(websocket, sender, receiver, messages, payload):
+    """Sends the chat messages to the receiver."""
+    for _ in range(messages):
+        await websocket.send("m;" + receiver + ";" + sender + ";" + payload)
+
+
+async def run_pairs(uri, name, pairs, messages, payload, barrier):
+    """Connects the client pairs, waits for the other client processes and sends the messages."""
+    users = [(name + "s%d" % i, name + "r%d" % i) for i in range(pairs)]
+    senders = [await open_client(uri, sender) for sender, _ in users]
+    receivers = [await open_client(uri, receiver) for _, receiver in users]
+    for sender_websocket, receiver_websocket, (sender, receiver) in zip(senders, receivers, users):
+        await add_friend(sender_websocket, receiver_websocket, sender, receiver)
+    await asyncio.sleep(0.5)
+    barrier.wait()
+
+    start = time.perf_counter()
+    receiving = [asyncio.ensure_future(receive(ws, sender, messages)) for ws, (sender, _) in zip(receivers, users)]
+    await asyncio.gather(*(send(ws, sender, receiver, messages, payload)
+                           for ws, (sender, receiver) in zip(senders, users)))
+    received = sum(await asyncio.gather(*receiving))
+    end = time.perf_counter()
+
+    for websocket in senders + receivers:
+        await websocket.close()
+    return received, start, end
+
+
+def client_process(uri, name, pairs, messages, payload, barrier, results):
+    """Runs one client process and reports the delivered messages and the time span."""
+    results.put(asyncio.new_event_loop().run_until_complete(
+        run_pairs(uri, name, pairs, messages, payload, barrier)))
+
+
+def measure(workers, port, args):
+    """Starts the server with the given number of workers and returns the delivered messages per second."""
+    directory = tempfile.mkdtemp()
+    # All clients connect from one address, so the address rate limit is lifted
+    server = subprocess.Popen([sys.executable, SERVER, "--port", str(port), "--workers", str(workers),
+                               "--address-rate", "1e9", "--address-burst", "1000000000"], cwd=directory,
+                              start_new_session=True)
+    try:
+        time.sleep(2)
+        uri = "ws://localhost:%d" % port
+        barrier = multiprocessing.Barrier(args.client_processes)
+        results = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=client_process, args=(
+            uri, "w%dp%d" % (workers, i), args.pairs // args.client_processes, args.messages, "x" * args.size,
+            barrier, results)) for i in range(args.client_processes)]
+        for process in processes:
+            process.start()
+        spans = [results.get() for _ in processes]
+        for process in processes:
+            process.join()
+    finally:
+        # The hashing processes of the server are stopped with it
+        os.killpg(server.pid, signal.SIGTERM)
+        server.wait()
+    received = sum(span[0] for span in spans)
+    return received / (max(span[2] for span in spans) - min(span[1] for span in spans))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4], help="the worker counts that are compared")
+    parser.add_argument("--pairs", type=int, default=200, help="the number of sender and receiver pairs")
+    parser.add_argument("--messages", type=int, default=100, help="the number of messages per pair")
+    parser.add_argument("--size", type=int, default=200, help="the size of one message in bytes")
+    parser.add_argument("--client-processes", type=int, default=4, help="the number of load generating processes")
+    parser.add_argument("--port", type=int, default=8790, help="the port the server is started on")
+    args = parser.parse_args()
+
+    for workers in args.workers:
+        print("%2d worker(s): %9.0f messages/s" % (workers, measure(workers, args.port, args)))
+
+
+if __name__ == "__main__":
+    main()
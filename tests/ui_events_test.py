@@ -0,0 +1,36 @@
+import unittest
+from client.tools import UIEvents
+
+
+class TestUIEvents(unittest.TestCase):
+
+    def test_merging(self):
+        """Tests that events of the same kind are merged until they are taken"""
+
+        events = UIEvents()
+        for i in range(100):
+            events.post_sidebar()
+            events.post_line("bob", str(i))
+        events.post_line("carol", "hi")
+
+        sidebar, chat, lines = events.take()
+        self.assertTrue(sidebar)
+        self.assertFalse(chat)
+        self.assertEqual(list(lines), ["bob", "carol"])
+        self.assertEqual(lines["bob"], [str(i) for i in range(100)])
+
+        self.assertEqual(events.take(), (False, False, {}))
+
+    def test_calls(self):
+        """Tests that the requested calls are returned once in order"""
+
+        events = UIEvents()
+        events.post_call(print, "a")
+        events.post_call(len, "bc")
+
+        self.assertEqual(events.take_calls(), [(print, ("a",)), (len, ("bc",))])
+        self.assertEqual(events.take_calls(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()